@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of pianodb's ingestion, HTTP and scraping paths.
+
+    python benchmarks/bench.py run [--database URL]... [-o results.json]
+    python benchmarks/bench.py compare baseline.json results.json
+
+``run`` measures a temporary SQLite database, in the write-optimized mode, and
+any other database given by URL. Each database is benchmarked from empty over
+several stages so that the cost of ingestion can be seen to grow, or not, with
+the size of the library:
+
+- ``update_db`` one songfinish at a time, then ``bulk_update_db`` in batches
+- ``POST /songfinish`` through the Falcon application, in process
+- ``ScrapeWorkerPool`` draining the queued jobs from a local feature server
+
+Results, with the commit and versions they were measured at, are written as
+JSON. ``compare`` reports the change between two results and exits non-zero
+on regressions, so that runs at different commits can be checked in CI.
+
+Databases given by URL must be scratch databases: their pianodb tables are
+dropped first.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import subprocess
+from datetime import datetime
+
+import click
+import falcon
+import msgpack
+import peewee
+from falcon import testing
+
+import pianodb
+import pianodb.model as model
+from pianodb.auth import Tokens
+from pianodb.cache import FeatureCache, identity_map
+from pianodb.pianodb import (TABLES, chunked, connect_database,
+                             create_database, update_db, bulk_update_db)
+from pianodb.routes import ConnectionComponent, ValidatorComponent, SongFinish
+from pianodb.scraper import ScrapeWorkerPool
+
+from workload import Library, FeatureServer
+
+TOKEN = 'benchmark'
+SONGFINISH_ROUTE = '/api/v1/songfinish'
+
+# Metrics compared by ``compare`` and whether a higher value is better.
+METRICS = {
+    'per_second': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'queries_per_operation': False,
+}
+
+
+class QueryCounter:
+    """
+    Count the statements sent through ``execute_sql`` of ``database``, from
+    any thread, while in use as a context manager.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+        self._lock = threading.Lock()
+        self._execute_sql = None
+
+    def execute_sql(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+        return self._execute_sql(*args, **kwargs)
+
+    def __enter__(self):
+        self._execute_sql = self.database.execute_sql
+        self.database.execute_sql = self.execute_sql
+        return self
+
+    def __exit__(self, *exc_info):
+        self.database.execute_sql = self._execute_sql
+
+
+def percentile(values, q):
+    """
+    The nearest-rank ``q``th percentile of ``values``.
+    """
+    values = sorted(values)
+    return values[max(0, int(round(q / 100 * len(values))) - 1)]
+
+
+def measure(operation, batches):
+    """
+    Time ``operation`` on each of ``batches`` of songfinish records.
+    """
+    latencies, plays = [], 0
+    with QueryCounter(model.db.obj) as queries:
+        start = time.perf_counter()
+        for batch in batches:
+            began = time.perf_counter()
+            operation(batch)
+            latencies.append(time.perf_counter() - began)
+            plays += len(batch)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'operations': len(latencies),
+        'plays': plays,
+        'seconds': round(elapsed, 4),
+        'per_second': round(plays / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'queries': queries.count,
+        'queries_per_operation': round(queries.count / len(latencies), 2),
+    }
+
+
+def post_songfinish(client):
+    headers = {'X-Auth-Token': TOKEN, 'Content-Type': 'application/msgpack'}
+
+    def post(batch):
+        result = client.simulate_post(SONGFINISH_ROUTE, headers=headers,
+                                      body=msgpack.packb(batch[0]))
+        if result.status_code != 201:
+            raise click.ClickException(
+                "POST {} answered {}".format(SONGFINISH_ROUTE, result.status))
+
+    return post
+
+
+def bench_ingestion(library, plays, batch_size, stages):
+    api = falcon.API(middleware=[
+        ValidatorComponent(Tokens({'default': TOKEN})), ConnectionComponent()])
+    api.add_route(SONGFINISH_ROUTE, SongFinish())
+    post = post_songfinish(testing.TestClient(api))
+
+    results = []
+    for stage in range(stages):
+        click.echo("  stage {}/{}".format(stage + 1, stages), err=True)
+        library_size = {
+            'plays': model.Play.select().count(),
+            'songs': model.Song.select().count(),
+        }
+        results.append({
+            'library': library_size,
+            'update_db': measure(lambda batch: update_db(batch[0]),
+                                 chunked(library.songfinishes(plays), 1)),
+            'bulk_update_db': measure(bulk_update_db,
+                                      chunked(library.songfinishes(plays),
+                                              batch_size)),
+            'http_songfinish': measure(post,
+                                       chunked(library.songfinishes(plays), 1)),
+        })
+    return results
+
+
+def bench_scraping(workers):
+    jobs = (model.ScrapeJob.select()
+            .where(model.ScrapeJob.finished >> None)
+            .count())
+    pool = ScrapeWorkerPool(workers=workers, cache=FeatureCache())
+
+    with QueryCounter(model.db.obj) as queries:
+        start = time.perf_counter()
+        pool.run(once=True)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'jobs': jobs,
+        'unfinished': (model.ScrapeJob.select()
+                       .where(model.ScrapeJob.finished >> None)
+                       .count()),
+        'workers': workers,
+        'seconds': round(elapsed, 4),
+        'per_second': round(jobs / elapsed, 1),
+        'queries': queries.count,
+        'queries_per_operation': round(queries.count / max(jobs, 1), 2),
+    }
+
+
+def bench_database(url, options, feature_server):
+    """
+    Run every benchmark against the database at ``url``, emptied first.
+    """
+    # SQLite is used in the write-optimized mode, without which the
+    # scraper's threads can't write concurrently.
+    database = connect_database(url, sqlite={})
+    model.db.initialize(database)
+    model.db.drop_tables(list(reversed(TABLES)), safe=True)
+    create_database(database)
+    identity_map.invalidate()
+
+    library = Library(artists=options['artists'],
+                      stations=options['stations'], skew=options['skew'],
+                      seed=options['seed'], detail_url=feature_server.url)
+    try:
+        return {
+            'ingestion': bench_ingestion(library, options['plays'],
+                                         options['batch_size'],
+                                         options['stages']),
+            'scraping': bench_scraping(options['scrape_workers']),
+        }
+    finally:
+        if not model.db.is_closed():
+            model.db.close()
+
+
+def describe_environment():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=here,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'pianodb': pianodb.__version__,
+        'python': platform.python_version(),
+        'peewee': peewee.__version__,
+        'falcon': falcon.__version__,
+        'platform': platform.platform(),
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(short_help='run the benchmarks')
+@click.option('--database', 'databases', multiple=True,
+              help=('URL of a scratch database to benchmark as well as '
+                    'SQLite, e.g. postgres://postgres@127.0.0.1/pianodb_bench. '
+                    'Repeatable.'))
+@click.option('--plays', default=1000, show_default=True,
+              help='Plays written by each benchmark in each stage.')
+@click.option('--stages', default=3, show_default=True,
+              help='Rounds of ingestion into the growing library.')
+@click.option('--batch-size', default=100, show_default=True)
+@click.option('--artists', default=2000, show_default=True)
+@click.option('--stations', default=25, show_default=True)
+@click.option('--skew', default=1.1, show_default=True,
+              help='Exponent of the Zipf popularity of artists and stations.')
+@click.option('--scrape-workers', default=4, show_default=True)
+@click.option('--scrape-latency', default=0.0, show_default=True,
+              help='Seconds the fake feature server takes per page.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='File to write the results to instead of stdout.')
+def run(databases, output, scrape_latency, **options):
+    import tempfile
+
+    results = {'environment': describe_environment(), 'options': options,
+               'databases': {}}
+
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            FeatureServer(scrape_latency) as feature_server:
+        targets = [('sqlite', "sqlite:///{}".format(
+            os.path.join(tmpdir, 'bench.db')))]
+        targets += [(url.split('://', 1)[0], url) for url in databases]
+
+        for name, url in targets:
+            click.echo("Benchmarking {}".format(name), err=True)
+            try:
+                result = bench_database(url, options, feature_server)
+            except (peewee.OperationalError,
+                    peewee.ImproperlyConfigured) as exc:
+                # Databases that aren't running are reported, not fatal.
+                click.echo("  skipped: {}".format(exc), err=True)
+                result = {'skipped': str(exc)}
+            results['databases'][name] = result
+
+    with click.open_file(output or '-', 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+
+
+def flatten(result, prefix=''):
+    """
+    Map the dotted path of every compared metric in ``result`` to its value.
+    """
+    metrics = {}
+    if isinstance(result, list):
+        result = {str(i): value for i, value in enumerate(result)}
+    if not isinstance(result, dict):
+        return metrics
+    for key, value in result.items():
+        path = prefix + key
+        if key in METRICS:
+            metrics[path] = value
+        else:
+            metrics.update(flatten(value, path + '.'))
+    return metrics
+
+
+@cli.command(short_help='compare two results')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', default=10.0, show_default=True,
+              help='Percentage by which a metric may worsen.')
+def compare(baseline, current, threshold):
+    baseline = flatten(json.load(baseline)['databases'])
+    current = flatten(json.load(current)['databases'])
+
+    regressions = 0
+    for path in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[path], current[path]
+        change = (after - before) / before * 100 if before else 0.0
+        higher_is_better = METRICS[path.rsplit('.', 1)[1]]
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        click.echo("{:<60} {:>12} {:>12} {:>+8.1f}%{}".format(
+            path, before, after, change, flag))
+
+    if regressions:
+        sys.exit("{} metrics regressed by more than {}%".format(regressions,
+                                                                threshold))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,143 @@
+"""
+Synthetic workloads for the pianodb benchmarks.
+
+Listening is heavily skewed: a few artists and stations account for most
+plays. A ``Library`` draws stations and artists from Zipf distributions, with
+every station favoring different artists, so caches, indexes and rollups see
+the same mix of hot and cold keys as a real history does. Detail URLs point
+at a ``FeatureServer``, a local stand-in for Pandora's track pages.
+"""
+
+import time
+import random
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Music Genome features are drawn from a vocabulary this large.
+VOCABULARY_SIZE = 400
+
+
+def zipf_weights(n, exponent):
+    return [1 / rank ** exponent for rank in range(1, n + 1)]
+
+
+class Library:
+    """
+    A library of ``artists`` artists with ``albums`` albums of ``songs``
+    songs each, played on ``stations`` stations. Popularity follows a Zipf
+    distribution with the given ``skew``.
+    """
+
+    def __init__(self, artists=1000, albums=3, songs=10, stations=25,
+                 skew=1.1, seed=0, detail_url='http://127.0.0.1'):
+        self.artists = artists
+        self.albums = albums
+        self.songs = songs
+        self.stations = stations
+        self.detail_url = detail_url.rstrip('/')
+
+        self.random = random.Random(seed)
+        self.artist_weights = self.cumulative(artists, skew)
+        self.station_weights = self.cumulative(stations, skew)
+        self.timestamp = int(datetime(2016, 1, 1).timestamp())
+
+    @staticmethod
+    def cumulative(n, skew):
+        weights, total = [], 0
+        for weight in zipf_weights(n, skew):
+            total += weight
+            weights.append(total)
+        return weights
+
+    def songfinish(self):
+        choices = self.random.choices
+        station = choices(range(self.stations),
+                          cum_weights=self.station_weights)[0]
+        # Each station puts a different slice of the artists on top.
+        rank = choices(range(self.artists), cum_weights=self.artist_weights)[0]
+        artist = (rank + station * 37) % self.artists
+        album = self.random.randrange(self.albums)
+        song = self.random.randrange(self.songs)
+        duration = self.random.randint(120, 420)
+
+        track = (artist * self.albums + album) * self.songs + song
+        self.timestamp += duration
+
+        return {
+            'artist': "Artist {}".format(artist),
+            'title': "Song {}".format(song),
+            'album': "Album {} by Artist {}".format(album, artist),
+            'coverArt': "http://covers.example.com/{}-{}.jpg".format(artist,
+                                                                     album),
+            'stationName': "Station {}".format(station),
+            'songDuration': str(duration),
+            'songPlayed': str(duration),
+            'rating': str(self.random.choice((0, 0, 0, 1, 2))),
+            'detailUrl': "{}/track/{}".format(self.detail_url, track),
+            'timestamp': self.timestamp,
+        }
+
+    def songfinishes(self, n):
+        for _ in range(n):
+            yield self.songfinish()
+
+
+def feature_page(track):
+    """
+    A detail page shaped like Pandora's with the features of ``track``, which
+    are the same every time.
+    """
+    rng = random.Random(track)
+    features = rng.sample(range(VOCABULARY_SIZE), rng.randint(5, 15))
+    lines = ''.join("feature {}<br>\n".format(f) for f in features)
+    return ('<html><body><div class="song_features clearfix">\n{}</div>'
+            '</body></html>').format(lines).encode('utf-8')
+
+
+class FeatureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would
+    # hold up until the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        track = self.path.rsplit('/', 1)[-1]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = feature_page(track)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FeatureServer(ThreadingMixIn, HTTPServer):
+    """
+    Serve fake track detail pages on a free local port, each after
+    ``latency`` seconds. Use it as a context manager.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        super().__init__(('127.0.0.1', 0), FeatureHandler)
+        self.latency = latency
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,177 @@
+"""
+Admission control for the server.
+
+A burst of clients reconnecting after an outage used to occupy every worker
+until requests timed out wholesale. An ``AdmissionController`` instead
+decides up front, without touching the database, whether each request is
+served. Requests are turned away with 503 Service Unavailable while the
+worker is serving ``max_in_flight`` requests already, ``max_queue`` writes
+are waiting to be committed or writes have lately taken ``max_latency``
+seconds on average, and with 429 Too Many Requests once their client exceeds
+``rate`` requests per second. Either way they carry a ``Retry-After`` header
+telling clients when to try again.
+
+Every limit applies per worker and is off unless configured.
+"""
+
+import math
+import threading
+import time
+from collections import namedtuple
+
+from pianodb import metrics
+
+Rejection = namedtuple('Rejection',
+                       'status reason title description retry_after')
+
+
+class TokenBucket:
+    """
+    Allow ``rate`` requests a second on average and up to ``burst`` at once.
+    Not thread-safe.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Take a token if there is one. Returns how many seconds until there
+        is, which is zero if one was taken.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Latency:
+    """
+    A moving average of how long writes take, with each write weighing
+    ``weight``. It is forgotten once nothing has been written for ``window``
+    seconds, so a worker that stopped admitting writes because they were
+    slow admits one again now and then to find out whether they still are.
+    """
+
+    def __init__(self, weight=0.2, window=5):
+        self.weight = weight
+        self.window = window
+        self.average = 0
+        self.updated = None
+        self.lock = threading.Lock()
+
+    def stale(self, now):
+        return self.updated is None or now - self.updated > self.window
+
+    def observe(self, seconds):
+        now = time.monotonic()
+        with self.lock:
+            if self.stale(now):
+                self.average = seconds
+            else:
+                self.average += self.weight * (seconds - self.average)
+            self.updated = now
+
+    @property
+    def value(self):
+        with self.lock:
+            return 0 if self.stale(time.monotonic()) else self.average
+
+
+# Fed by ``pianodb.routes.store``.
+write_latency = Latency()
+
+
+class AdmissionController:
+    """
+    Decide whether requests are served. ``queue_depth``, if given, returns
+    the number of writes waiting to be committed. ``burst`` defaults to
+    ``rate``, but is at least one request, or a client limited to less than
+    one request a second would never be admitted.
+    """
+
+    def __init__(self, max_in_flight=None, max_queue=None, max_latency=None,
+                 rate=None, burst=None, retry_after=1, queue_depth=None,
+                 latency=write_latency):
+        if rate is not None and rate <= 0:
+            raise ValueError('admission rate must be positive')
+        if burst is not None and burst < 1:
+            raise ValueError('admission burst must be at least 1')
+
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue if queue_depth is not None else None
+        self.max_latency = max_latency
+        self.rate = rate
+        if burst is None and rate is not None:
+            burst = max(1, rate)
+        self.burst = burst
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+        self.latency = latency
+        self.in_flight = 0
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, queue_depth=None):
+        options = ('max_in_flight', 'max_queue', 'max_latency', 'rate',
+                   'burst', 'retry_after')
+        return cls(queue_depth=queue_depth,
+                   **{k: v for k, v in config.items() if k in options})
+
+    def overloaded(self):
+        """
+        Why the worker can't take another request, or ``None``.
+        """
+        if self.max_in_flight is not None and \
+                self.in_flight >= self.max_in_flight:
+            return 'in_flight', 'Too many requests in progress'
+        if self.max_queue is not None and \
+                self.queue_depth() >= self.max_queue:
+            return 'queue', 'Too many writes queued'
+        if self.max_latency is not None and \
+                self.latency.value > self.max_latency:
+            return 'latency', 'Writes are taking too long'
+        return None
+
+    def admit(self, client=None):
+        """
+        Admit a request made by ``client``, the name it authenticated as.
+        Returns ``None`` if the request is admitted, in which case it must be
+        released once served, and a ``Rejection`` otherwise.
+        """
+        with self.lock:
+            overloaded = self.overloaded()
+            if overloaded is not None:
+                reason, description = overloaded
+                rejection = Rejection(503, reason, 'Service unavailable',
+                                      description, self.retry_after)
+            elif self.rate is not None:
+                bucket = self.buckets.get(client)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst)
+                    self.buckets[client] = bucket
+                wait = bucket.take()
+                rejection = None if not wait else Rejection(
+                    429, 'rate', 'Too many requests',
+                    'Request rate limit exceeded', math.ceil(wait))
+            else:
+                rejection = None
+
+            if rejection is None:
+                self.in_flight += 1
+                return None
+
+        metrics.REJECTED_REQUESTS.inc(reason=rejection.reason)
+        return rejection
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
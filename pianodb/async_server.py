@@ -0,0 +1,438 @@
+"""
+The asyncio server engine, run by ``pianodb server --engine async``.
+
+A single process serves the songfinish routes from an aiohttp event loop
+instead of Gunicorn workers, so an idle client connection costs a coroutine
+rather than a whole worker. The ORM is synchronous, so database work runs on
+a bounded thread pool and requests beyond what the pool keeps up with wait
+their turn on the loop. Track features are scraped on the same loop with
+non-blocking fetches.
+
+aiohttp is an optional dependency, installed with ``pianodb[async]``.
+"""
+
+import gzip
+import time
+import asyncio
+import logging
+from functools import partial
+from collections import defaultdict
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+import pianodb.model as model
+from pianodb import metrics
+from pianodb.admission import AdmissionController
+from pianodb.auth import Tokens
+from pianodb.metrics import instrument_database
+from pianodb.cache import MISSING, FeatureCache
+from pianodb.pianodb import (ensure_connection, parse_track_features,
+                             warm_identity_map)
+from pianodb.routes import (find_duplicates, store, unpack_songfinish,
+                            unpack_songfinishes, validate_songfinish)
+from pianodb.scraper import (PERMANENT_STATUS_CODES, ScrapeError,
+                             CachedScrapeError, claim_job, complete_job,
+                             fail_job, defer_job)
+from pianodb.wire import InvalidPayload
+
+log = logging.getLogger(__name__)
+
+MSGPACK = 'application/msgpack'
+
+
+def error(status, title, description, headers=None):
+    """
+    An error response shaped like Falcon's, so clients can't tell the engines
+    apart.
+    """
+    return web.json_response({'title': title, 'description': description},
+                             status=status, headers=headers)
+
+
+def bad_request(description):
+    return error(400, 'Bad request', description)
+
+
+def created(body, status=201):
+    return web.Response(body=msgpack.packb(body), status=status,
+                        content_type=MSGPACK)
+
+
+def parse_features(content):
+    with metrics.STAGE_DURATION.time(stage='parse'):
+        return parse_track_features(content)
+
+
+@web.middleware
+async def instrument(request, handler):
+    """
+    ``pianodb.routes.MetricsComponent`` for aiohttp. Queries run on pool
+    threads, so they aren't counted per request.
+    """
+    started = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        route = request.match_info.route.name or 'none'
+        metrics.REQUEST_DURATION.observe(
+            time.perf_counter() - started,
+            route=route, method=request.method, status=status)
+
+
+def validation(tokens, public=()):
+    """
+    ``pianodb.routes.ValidatorComponent`` for aiohttp.
+    """
+    public = frozenset(public)
+
+    @web.middleware
+    async def validate(request, handler):
+        if request.path not in public:
+            client = tokens.authenticate(request.headers.get('X-Auth-Token'))
+            if client is None:
+                return error(401, 'Authentication required',
+                             'Missing or invalid authentication token')
+            if request.method == 'POST' and request.content_type != MSGPACK:
+                return error(415, 'Unsupported media type',
+                             'Payload must be msgpack')
+            request['client'] = client
+        return await handler(request)
+
+    return validate
+
+
+def admission_control(controller):
+    """
+    ``pianodb.routes.AdmissionComponent`` for aiohttp.
+    """
+
+    @web.middleware
+    async def admit(request, handler):
+        client = request.get('client')
+        if client is None:
+            return await handler(request)
+
+        rejection = controller.admit(client)
+        if rejection is not None:
+            return error(rejection.status, rejection.title,
+                         rejection.description,
+                         {'Retry-After': str(rejection.retry_after)})
+        try:
+            return await handler(request)
+        finally:
+            controller.release()
+
+    return admit
+
+
+class AsyncServer:
+    """
+    The songfinish routes. Database work runs on at most ``workers`` threads
+    with at most ``max_pending`` calls queued or running at once.
+    """
+
+    def __init__(self, workers=4, max_pending=1000, ping=False, writer=None,
+                 profiler=None, dedup=None):
+        self.dedup = dedup
+        self.profiler = profiler
+        self.ping = ping
+        self.writer = writer
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.calls = 0
+
+    def with_connection(self, func, *args):
+        ensure_connection(self.ping)
+        if self.profiler is None:
+            return func(*args)
+
+        # Requests are spread over calls, so each call is profiled alone.
+        self.profiler.start()
+        try:
+            return func(*args)
+        finally:
+            self.profiler.stop(getattr(func, '__name__', repr(func)))
+
+    async def call(self, func, *args):
+        """
+        Run ``func`` on a pool thread with a database connection.
+        """
+        loop = asyncio.get_event_loop()
+        self.calls += 1
+        try:
+            async with self.pending:
+                return await loop.run_in_executor(
+                    self.executor, partial(self.with_connection, func, *args))
+        finally:
+            self.calls -= 1
+
+    def depth(self):
+        """
+        The number of database calls queued or running.
+        """
+        return self.calls
+
+    async def read_body(self, request):
+        """
+        Read the body of ``request``, gunzipped if need be. Returns the body
+        or an error response.
+        """
+        data = await request.read()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            try:
+                data = gzip.decompress(data)
+            except (OSError, EOFError):
+                return bad_request('Could not decompress gzip data')
+        return data
+
+    async def songfinish(self, request):
+        data = await self.read_body(request)
+        if isinstance(data, web.Response):
+            return data
+
+        try:
+            songfinish = unpack_songfinish(data)
+        except InvalidPayload as exc:
+            return bad_request(str(exc))
+        except ValueError:
+            return bad_request('Could not unpack msgpack data')
+
+        reason = validate_songfinish(songfinish)
+        if reason:
+            return bad_request(reason)
+
+        key = request.headers.get('Idempotency-Key')
+        if key is not None:
+            songfinish['key'] = key
+
+        duplicate, = await self.call(find_duplicates, self.dedup, [songfinish])
+        if duplicate:
+            return created({'created': False, 'duplicate': True}, status=200)
+
+        await self.call(store, self.writer, [songfinish], self.dedup)
+        return created({'created': True})
+
+    async def songfinish_batch(self, request):
+        data = await self.read_body(request)
+        if isinstance(data, web.Response):
+            return data
+
+        try:
+            records = unpack_songfinishes(data)
+        except InvalidPayload as exc:
+            return bad_request(str(exc))
+        except ValueError:
+            return bad_request('Could not unpack msgpack data')
+
+        results, valid = [], []
+        for songfinish in records:
+            reason = validate_songfinish(songfinish)
+            if reason:
+                results.append({'created': False, 'error': reason})
+            else:
+                results.append({'created': True})
+                valid.append((len(results) - 1, songfinish))
+
+        songfinishes = []
+        duplicates = await self.call(find_duplicates, self.dedup,
+                                     [s for _, s in valid])
+        for (i, songfinish), duplicate in zip(valid, duplicates):
+            if duplicate:
+                results[i] = {'created': False, 'duplicate': True}
+            else:
+                songfinishes.append(songfinish)
+
+        await self.call(store, self.writer, songfinishes, self.dedup)
+        return created({'results': results})
+
+    async def serve_metrics(self, request):
+        return web.Response(text=metrics.registry.exposition(),
+                            headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    async def startup(self, app):
+        await self.call(warm_identity_map)
+
+    async def cleanup(self, app):
+        self.executor.shutdown()
+
+
+class AsyncScraper:
+    """
+    ``pianodb.scraper.ScrapeWorkerPool`` for the event loop: ``workers``
+    coroutines drain the ``ScrapeJob`` queue, fetching pages without blocking
+    and leaving the database to ``call``.
+    """
+
+    def __init__(self, call, workers=4, per_host=2, max_attempts=5,
+                 backoff=30, lease=300, poll_interval=5, timeout=10,
+                 cache=None):
+        self.call = call
+        self.workers = workers
+        self.cache = cache if cache is not None else FeatureCache()
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.timeout = ClientTimeout(total=timeout)
+
+        self.session = None
+        self._tasks = []
+        self._host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+
+    @classmethod
+    def from_config(cls, call, config):
+        config = config or {}
+        options = ('workers', 'per_host', 'max_attempts', 'backoff', 'lease',
+                   'poll_interval', 'timeout')
+        return cls(call, cache=FeatureCache.from_config(config.get('cache')),
+                   **{k: v for k, v in config.items() if k in options})
+
+    async def fetch(self, detail_url, session):
+        entry = await self.call(self.cache.get, detail_url)
+        if entry is not MISSING:
+            metrics.SCRAPE_CACHE_LOOKUPS.inc(result='hit')
+            features, reason = entry
+            if reason is not None:
+                raise CachedScrapeError(reason)
+            return features
+
+        metrics.SCRAPE_CACHE_LOOKUPS.inc(result='miss')
+        try:
+            async with self._host_limits[urlparse(detail_url).netloc]:
+                started = time.perf_counter()
+                try:
+                    async with session.get(detail_url,
+                                           timeout=self.timeout) as page:
+                        status, content = page.status, await page.read()
+                except (ClientError, asyncio.TimeoutError) as exc:
+                    raise ScrapeError(str(exc) or type(exc).__name__) from exc
+                finally:
+                    metrics.STAGE_DURATION.observe(
+                        time.perf_counter() - started, stage='fetch')
+
+            if status == 200:
+                features = await asyncio.get_event_loop().run_in_executor(
+                    None, parse_features, content)
+            elif status in PERMANENT_STATUS_CODES:
+                features = []
+            else:
+                raise ScrapeError("HTTP {}".format(status))
+        except ScrapeError as exc:
+            metrics.SCRAPE_ERRORS.inc()
+            await self.call(partial(self.cache.set, detail_url,
+                                    error=str(exc)))
+            raise
+
+        await self.call(self.cache.set, detail_url, features)
+        return features
+
+    async def attempt(self, job, session):
+        try:
+            features = await self.fetch(job.detail_url, session)
+        except CachedScrapeError:
+            await self.call(defer_job, job, self.cache.negative_ttl)
+        except ScrapeError as exc:
+            log.warning('scraping %s failed: %s', job.detail_url, exc)
+            await self.call(fail_job, job, exc, self.max_attempts,
+                            self.backoff)
+        else:
+            await self.call(complete_job, job, features)
+
+    async def scrape(self, job, session):
+        """
+        ``pianodb.scraper.ScrapeWorkerPool.scrape`` on the event loop.
+        """
+        try:
+            await self.attempt(job, session)
+        except Exception as exc:
+            log.exception('scraping %s failed', job.detail_url)
+            await self.call(fail_job, job, exc, self.max_attempts,
+                            self.backoff)
+
+    async def work(self, session):
+        while True:
+            try:
+                job = await self.call(claim_job, self.lease)
+                if job is not None:
+                    await self.scrape(job, session)
+                    continue
+            except Exception:
+                # A task that dies is never restarted, unlike a request.
+                log.exception('scraping failed')
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self, app):
+        self.session = ClientSession()
+        self._tasks = [asyncio.ensure_future(self.work(self.session))
+                       for _ in range(self.workers)]
+
+    async def stop(self, app):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.session.close()
+
+
+def create_app(config, writer=None, profiler=None, dedup=None):
+    prefix = config['api_prefix']
+    options = config.get('async') or {}
+    pool = config.get('pool')
+
+    # SQLite has one writer at a time, which a single thread never waits on.
+    sqlite = config['database'].startswith('sqlite')
+
+    server = AsyncServer(workers=options.get('workers',
+                                             1 if sqlite else config['workers']),
+                         max_pending=options.get('max_pending', 1000),
+                         ping=pool is not None and pool.get('ping', True),
+                         writer=writer,
+                         profiler=profiler,
+                         dedup=dedup)
+
+    if model.db.obj is not None:
+        instrument_database(model.db.obj)
+        if profiler is not None:
+            profiler.instrument(model.db.obj)
+
+    public_metrics = (config.get('metrics') or {}).get('public', True)
+    public = ['/metrics'] if public_metrics else []
+    middlewares = [instrument, validation(Tokens.from_config(config), public)]
+
+    admission = config.get('admission')
+    if admission:
+        controller = AdmissionController.from_config(admission, server.depth)
+        middlewares.append(admission_control(controller))
+
+    app = web.Application(middlewares=middlewares)
+    app.router.add_post(prefix + '/songfinish', server.songfinish,
+                        name='SongFinish')
+    app.router.add_post(prefix + '/songfinish/batch', server.songfinish_batch,
+                        name='SongFinishBatch')
+    app.router.add_get('/metrics', server.serve_metrics,
+                       name='Metrics')
+    app.on_startup.append(server.startup)
+
+    scraper = config.get('scraper', {})
+    if scraper.get('workers', 1) > 0:
+        scraper = AsyncScraper.from_config(server.call, scraper)
+        app.on_startup.append(scraper.start)
+        app.on_cleanup.append(scraper.stop)
+
+    app.on_cleanup.append(server.cleanup)
+    return app
+
+
+def run(config, writer=None, profiler=None, dedup=None):
+    web.run_app(create_app(config, writer, profiler, dedup),
+                host=config['interface'], port=config['port'], print=None)
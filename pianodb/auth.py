@@ -0,0 +1,50 @@
+"""
+Authentication of the clients of the server.
+
+Besides the ``token`` of its configuration the server accepts one token per
+client named in an optional ``tokens`` mapping, so that clients can be told
+apart and their tokens replaced one at a time. Tokens are loaded once at
+startup and compared in constant time.
+"""
+
+import hmac
+
+
+class Tokens:
+    """
+    The tokens clients may authenticate with, by client name.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = [(name, str(token).encode('utf-8'))
+                       for name, token in tokens.items()]
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        The ``tokens`` of a server config, with its ``token``, if it has one,
+        as the client ``default``.
+        """
+        tokens = dict(config.get('tokens') or {})
+        if config.get('token') is not None:
+            tokens.setdefault('default', config['token'])
+        return cls(tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def authenticate(self, token):
+        """
+        The name of the client ``token`` belongs to, or ``None``. Every token
+        is compared in full, so the time taken says nothing about which of
+        them ``token`` resembles or how closely.
+        """
+        if token is None:
+            return None
+
+        token = token.encode('utf-8')
+        client = None
+        for name, candidate in self.tokens:
+            if hmac.compare_digest(token, candidate):
+                client = name
+        return client
@@ -0,0 +1,255 @@
+"""
+Caches for scraped track features.
+
+Features are cached by normalized detail URL in two tiers: a bounded LRU in
+each process and a table in the database that every process shares, so a
+page that has been scraped once is never fetched again until it expires.
+Failed fetches are cached too, with a shorter TTL, to keep dead pages from
+being hammered.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit
+
+from peewee import IntegrityError
+
+import pianodb.model as model
+
+MISSING = object()
+
+
+def normalize_url(url):
+    """
+    Normalize a detail URL so that trivially different spellings of the same
+    page share a cache entry. The query string and fragment are dropped.
+    """
+    parts = urlsplit(url.strip())
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, '', ''))
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded least recently used cache whose entries
+    expire after a TTL given in seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= datetime.now():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = datetime.now() + timedelta(seconds=ttl) if ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=MISSING):
+        """
+        Drop ``key`` from the cache, or every entry if no key is given.
+        """
+        with self._lock:
+            if key is MISSING:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class FeatureCache:
+    """
+    A two-tier cache of scraped track features. Entries are ``(features,
+    error)`` pairs where ``error`` is ``None`` unless the fetch failed.
+    Positive results live for ``ttl`` seconds, empty or failed results for
+    ``negative_ttl`` seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30 * 24 * 60 * 60,
+                 negative_ttl=60 * 60, purge_interval=100):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.purge_interval = purge_interval
+        self.local = LRUCache(maxsize=maxsize)
+        self._stores = 0
+
+    @classmethod
+    def from_config(cls, config):
+        options = ('maxsize', 'ttl', 'negative_ttl', 'purge_interval')
+        return cls(**{k: v for k, v in (config or {}).items() if k in options})
+
+    def get(self, detail_url):
+        """
+        Look up the ``(features, error)`` entry for ``detail_url``, returning
+        ``MISSING`` if neither tier has an unexpired entry.
+        """
+        url = normalize_url(detail_url)
+        entry = self.local.get(url)
+        if entry is not MISSING:
+            return entry
+
+        try:
+            row = (model.FeatureCacheEntry
+                   .select()
+                   .where(model.FeatureCacheEntry.url == url,
+                          model.FeatureCacheEntry.expires > datetime.now())
+                   .get())
+        except model.FeatureCacheEntry.DoesNotExist:
+            return MISSING
+
+        entry = (json.loads(row.features or '[]'), row.error)
+        self.local.set(url, entry, (row.expires - datetime.now()).total_seconds())
+        return entry
+
+    def set(self, detail_url, features=(), error=None):
+        url = normalize_url(detail_url)
+        features = list(features)
+        ttl = self.ttl if features and error is None else self.negative_ttl
+        expires = datetime.now() + timedelta(seconds=ttl)
+
+        values = {
+            'features': json.dumps(features),
+            'error': error[:255] if error else None,
+            'expires': expires,
+        }
+        update = (model.FeatureCacheEntry
+                  .update(**values)
+                  .where(model.FeatureCacheEntry.url == url))
+
+        # Another process may store the same URL between the UPDATE and the
+        # INSERT, in which case its entry is overwritten instead. The INSERT
+        # gets a savepoint of its own since a failed statement aborts the
+        # whole transaction on PostgreSQL.
+        with model.db.atomic():
+            if not update.execute():
+                try:
+                    with model.db.atomic():
+                        model.FeatureCacheEntry.create(url=url, **values)
+                except IntegrityError:
+                    update.execute()
+
+        self.local.set(url, (features, error), ttl)
+
+        self._stores += 1
+        if self._stores % self.purge_interval == 0:
+            self.purge()
+
+    def purge(self):
+        """
+        Delete expired entries from the shared tier.
+        """
+        (model.FeatureCacheEntry
+         .delete()
+         .where(model.FeatureCacheEntry.expires <= datetime.now())
+         .execute())
+
+    def invalidate(self, detail_url):
+        url = normalize_url(detail_url)
+        self.local.invalidate(url)
+        (model.FeatureCacheEntry
+         .delete()
+         .where(model.FeatureCacheEntry.url == url)
+         .execute())
+
+
+class IdentityMap:
+    """
+    A per-process map from natural keys to primary keys for the entities that
+    nearly every play touches, so that resolving their foreign keys usually
+    takes no SELECT at all. Each model gets its own bounded LRU.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def cache(self, model_class):
+        with self._lock:
+            if model_class not in self._caches:
+                self._caches[model_class] = LRUCache(maxsize=self.maxsize)
+            return self._caches[model_class]
+
+    def get_many(self, model_class, keys):
+        """
+        Map each of ``keys`` that is cached to its primary key.
+        """
+        cache = self.cache(model_class)
+        ids = {}
+        for key in keys:
+            pk = cache.get(key)
+            if pk is not MISSING:
+                ids[key] = pk
+        return ids
+
+    def set_many(self, model_class, ids):
+        cache = self.cache(model_class)
+        for key, pk in ids.items():
+            cache.set(key, pk)
+
+    def invalidate(self, model_class=None, key=MISSING):
+        """
+        Forget ``key`` for ``model_class``, every key for ``model_class``, or
+        everything if no model is given.
+        """
+        with self._lock:
+            caches = list(self._caches.values()) if model_class is None else \
+                [self._caches.get(model_class, LRUCache())]
+        for cache in caches:
+            cache.invalidate(key)
+
+    def warm(self, natural_keys):
+        """
+        Load the most recently created rows of each model in ``natural_keys``,
+        a mapping of model classes to their natural key fields.
+        """
+        for model_class, fields in natural_keys.items():
+            primary_key = model_class._meta.primary_key
+            query = (model_class
+                     .select(primary_key, *fields)
+                     .order_by(primary_key.desc())
+                     .limit(self.maxsize)
+                     .tuples())
+            # Insert oldest first so that the newest rows are the most recent.
+            rows = reversed(list(query))
+            self.set_many(model_class, {tuple(key): pk for pk, *key in rows})
+
+    def stats(self):
+        with self._lock:
+            caches = dict(self._caches)
+        return {model_class.__name__: {
+            'size': len(cache),
+            'hits': cache.hits,
+            'misses': cache.misses,
+        } for model_class, cache in caches.items()}
+
+
+identity_map = IdentityMap()
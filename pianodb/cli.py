@@ -0,0 +1,624 @@
+"""
+The pianodb command line interface.
+
+pianobar runs this for every song, so only click is imported up front. Each
+command imports what it needs, keeping the server stack, the ORM and the HTTP
+client out of the code paths that don't use them.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+import click
+
+from pianodb.config import load_config
+from pianodb.events import EVENTS, gen_dummy_cmd
+
+
+def open_database(config, check_schema=True):
+    from pianodb.pianodb import connect_database, create_database
+
+    database = connect_database(config['database'], config.get('sqlite'),
+                                config.get('pool'))
+    create_database(database)
+
+    if check_schema:
+        from pianodb.migrations import pending_migrations
+
+        if pending_migrations():
+            sys.exit("database schema is out of date, run `pianodb migrate'")
+
+
+@click.group(commands={e: gen_dummy_cmd(e) for e in EVENTS})
+@click.pass_context
+def cli(ctx):
+    cmd = ctx.invoked_subcommand
+
+    if cmd in ('songfinish', 'server', 'flush', 'daemon'):
+        config = load_config()
+        ctx.obj = config['server'] if cmd == 'server' else config['client']
+
+        if cmd == 'server' and 'database' in ctx.obj:
+            open_database(ctx.obj)
+    elif cmd in ('scrape', 'stats', 'migrate', 'import', 'export', 'similar',
+                 'search'):
+        ctx.obj = load_config()
+
+
+def spawn_detached(*args):
+    """
+    Run a pianodb subcommand in a new session so that it outlives, and never
+    blocks, the current process.
+    """
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen([sys.executable, '-m', 'pianodb'] + list(args),
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         start_new_session=True)
+
+
+@cli.command(help=("songfinish is the handler for pianobar's `songfinish' "
+                   "eventcmd. It reads event fields from stdin and, depending "
+                   "on configuration creates local database entries or sends "
+                   "data to a remote server."),
+             short_help='songfinish eventcmd handler')
+@click.option('--debug', is_flag=True,
+              help='Log the SQL of writing to a local database.')
+@click.pass_context
+def songfinish(ctx, debug):
+
+    config = ctx.obj
+
+    fields = dict(line.strip().split('=', 1) for line in sys.stdin)
+
+    if not fields['artist']:
+        sys.exit('Artist is empty. Refusing to continue.')
+
+    if int(fields['songPlayed']) >= config['threshold']:
+        songfinish_data = {
+            'artist': fields['artist'],
+            'title': fields['title'],
+            'album': fields['album'],
+            'coverArt': fields['coverArt'],
+            'stationName': fields['stationName'],
+            'songDuration': fields['songDuration'],
+            'songPlayed': fields['songPlayed'],
+            'rating': fields['rating'],
+            'detailUrl': fields['detailUrl'].split('?')[0]  # sans query string
+        }
+
+        # Spooled records may reach the server much later than they happened.
+        songfinish_data['timestamp'] = int(time.time())
+
+        if config.get('remote'):
+            from pianodb.client import default_socket_path, send_to_daemon
+            from pianodb.spool import Spool, default_spool_path
+
+            remote = config['remote']
+            if not ('host' in remote and 'port' in remote):
+                sys.exit('missing parameters for communication with remote')
+
+            # Never wait on the network here. Either a running client daemon
+            # takes the record or a detached flush ships the spool.
+            daemon = config.get('daemon') or {}
+            socket_path = daemon.get('socket', default_socket_path())
+            if not send_to_daemon(socket_path, songfinish_data):
+                Spool(config.get('spool', default_spool_path())).append(
+                    songfinish_data)
+                spawn_detached('flush')
+        elif 'database' in config:
+            import pianodb.model as model
+            from pianodb.pianodb import update_db
+
+            open_database(config)
+
+            profiler = None
+            if debug:
+                from pianodb.profiler import QueryProfiler
+
+                # Log every write, however fast.
+                profiler = QueryProfiler.from_config(
+                    dict(config.get('profiler') or {}, slow_request=0))
+                profiler.instrument(model.db.obj)
+                profiler.start()
+
+            update_db(songfinish_data)
+
+            if profiler is not None:
+                profiler.stop('songfinish')
+            spawn_detached('scrape', '--once')
+
+
+@cli.command(help=("flush sends songfinish data spooled by the songfinish "
+                   "eventcmd to the remote server in batches, discarding it "
+                   "once the server acknowledges it."),
+             short_help='send spooled songfinish data to the remote')
+@click.pass_context
+def flush(ctx):
+    from pianodb.client import RemoteClient, rejected_spool
+    from pianodb.spool import Spool, SpoolBusy, default_spool_path, flush_spool
+
+    config = ctx.obj
+    spool = Spool(config.get('spool', default_spool_path()))
+
+    try:
+        remote = RemoteClient(config, rejected=rejected_spool(spool))
+    except ValueError as exc:
+        sys.exit(str(exc))
+
+    batch_size = config['remote'].get('batch_size', 500)
+
+    try:
+        flush_spool(spool, remote.send, batch_size)
+    except SpoolBusy:
+        sys.exit('spool is already being flushed')
+
+    if any(True for _ in spool.records()):
+        click.echo('Something went wrong with the request.')
+
+
+@cli.command(help=("daemon starts a long-lived client that the songfinish "
+                   "eventcmd hands records to over a UNIX socket. It spools "
+                   "them and sends them to the remote server in batches over "
+                   "a persistent connection."),
+             short_help='start the pianodb client daemon')
+@click.pass_context
+def daemon(ctx):
+    from pianodb.client import ClientDaemon, default_socket_path
+    from pianodb.spool import Spool, default_spool_path
+
+    config = ctx.obj
+    options = config.get('daemon') or {}
+    spool = Spool(config.get('spool', default_spool_path()))
+
+    try:
+        client_daemon = ClientDaemon(
+            config, spool,
+            socket_path=options.get('socket', default_socket_path()),
+            linger=options.get('linger', 1),
+            retry=options.get('retry', 30))
+    except ValueError as exc:
+        sys.exit(str(exc))
+
+    try:
+        client_daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command(help=("server starts a Gunicorn webserver with a minimal Falcon "
+                   "WSGI application. It listens for POST requests of "
+                   "MessagePack data to create database entries."),
+             short_help='start a pianodb webserver')
+@click.option('--engine', type=click.Choice(['gunicorn', 'async']),
+              default='gunicorn', show_default=True,
+              help='Serve with Gunicorn workers or on an asyncio event loop.')
+@click.option('--debug', is_flag=True,
+              help='Profile the SQL of every request and log slow ones.')
+@click.pass_context
+def server(ctx, engine, debug):
+    import shutil
+    import tempfile
+    import multiprocessing
+    from functools import partial
+
+    from pianodb.cache import identity_map
+    from pianodb.dedup import DedupIndex
+    from pianodb.metrics import registry
+    from pianodb.pianodb import bulk_update_db, disconnect
+    from pianodb.server import (PianoDBApplication, create_app, post_fork,
+                                run_scraper)
+
+    config = ctx.obj
+
+    if not config.get('token') and not config.get('tokens'):
+        sys.exit('the server requires a token or tokens')
+
+    # Refuse impossible limits now rather than in every worker.
+    if config.get('admission'):
+        from pianodb.admission import AdmissionController
+
+        try:
+            AdmissionController.from_config(config['admission'])
+        except ValueError as exc:
+            sys.exit(str(exc))
+
+    if config.get('similarity'):
+        try:
+            import pianodb.similarity  # noqa: F401
+        except ImportError:
+            sys.exit('similarity queries require numpy, '
+                     'install pianodb[similarity]')
+
+    profiler = None
+    if debug:
+        from pianodb.profiler import QueryProfiler
+
+        profiler = QueryProfiler.from_config(config.get('profiler'))
+
+    identity_map.maxsize = config.get('identity_map', {}).get(
+        'maxsize', identity_map.maxsize)
+
+    # Retried records are only written once.
+    dedup = DedupIndex.from_config(config.get('dedup'))
+
+    options = {
+        'bind': "{}:{}".format(config['interface'], config['port']),
+        'workers': config['workers'],
+        'post_fork': post_fork,
+    }
+
+    # In SQLite mode every write goes through a single writer thread, so the
+    # workers become threads of one process sharing it.
+    writer = None
+    sqlite = config.get('sqlite')
+    if sqlite is not None and config['database'].startswith('sqlite') and \
+            sqlite.get('writer', True):
+        from pianodb.writer import WriteQueue
+
+        writer = WriteQueue(write=partial(bulk_update_db, dedup=dedup),
+                            max_batch=sqlite.get('max_batch', 500),
+                            linger=sqlite.get('linger', 0.005),
+                            profiler=profiler)
+        options.update(workers=1, worker_class='gthread',
+                       threads=config['workers'])
+
+    if engine == 'async':
+        try:
+            from pianodb import async_server
+        except ImportError:
+            sys.exit('the async engine requires aiohttp, '
+                     'install pianodb[async]')
+
+        # Pool threads open connections of their own.
+        disconnect()
+        async_server.run(config, writer, profiler, dedup)
+        return
+
+    # Workers and the scraper share their metrics through a directory, a
+    # temporary one unless configured.
+    metrics = config.get('metrics') or {}
+    metrics_dir = metrics.get('directory') or tempfile.mkdtemp(
+        prefix='pianodb-metrics-')
+    registry.configure(metrics_dir, metrics.get('interval', 5))
+
+    # Nothing forked from here on may share this process' connections.
+    disconnect()
+
+    scraper = config.get('scraper', {})
+    if scraper.get('workers', 1) > 0:
+        multiprocessing.Process(target=run_scraper,
+                                args=(scraper, config.get('similarity')),
+                                daemon=True).start()
+
+    master = os.getpid()
+    try:
+        PianoDBApplication(create_app(config, writer, profiler, dedup),
+                           options).run()
+    finally:
+        # Workers exit through here too.
+        if os.getpid() == master and not metrics.get('directory'):
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+@cli.command(help=("scrape drains the queue of Songs awaiting Music Genome "
+                   "features. By default it works on the client database; "
+                   "the server runs its own scraper unless configured with "
+                   "zero scraper workers."),
+             short_help='scrape queued track features')
+@click.option('--client', 'block', flag_value='client', default=True,
+              help='Use the client database (default).')
+@click.option('--server', 'block', flag_value='server',
+              help='Use the server database instead of the client database.')
+@click.option('--once', is_flag=True,
+              help='Exit once no more jobs are due instead of polling.')
+@click.pass_context
+def scrape(ctx, block, once):
+    from pianodb.scraper import ScrapeWorkerPool
+
+    config = ctx.obj[block]
+
+    if 'database' not in config:
+        sys.exit('no database configured')
+
+    open_database(config)
+    ScrapeWorkerPool.from_config(config.get('scraper')).run(once=once)
+
+    # A local client scrapes once per song, so keep its index current too.
+    if once and config.get('similarity'):
+        try:
+            from pianodb.similarity import update_index
+        except ImportError:
+            return
+        update_index(config['similarity']['path'])
+
+
+@cli.command(help=("stats prints the most played artists, stations and songs "
+                   "from the pre-aggregated listening statistics. With "
+                   "--rebuild the statistics are first recomputed from the "
+                   "raw play history."),
+             short_help='show listening statistics')
+@click.option('--client', 'block', flag_value='client', default=True,
+              help='Use the client database (default).')
+@click.option('--server', 'block', flag_value='server',
+              help='Use the server database instead of the client database.')
+@click.option('--rebuild', is_flag=True,
+              help='Recompute the statistics from every play.')
+@click.option('--station', help='Only show songs played on this station.')
+@click.option('--limit', default=10, show_default=True)
+@click.pass_context
+def stats(ctx, block, rebuild, station, limit):
+    from pianodb.stats import rebuild_stats, top_artists, top_songs, top_stations
+
+    config = ctx.obj[block]
+
+    if 'database' not in config:
+        sys.exit('no database configured')
+
+    open_database(config)
+
+    if rebuild:
+        rebuild_stats()
+
+    if not station:
+        click.echo('Top artists:')
+        for name, plays, _ in top_artists(limit):
+            click.echo("  {:>6}  {}".format(plays, name))
+
+        click.echo('Top stations:')
+        for name, plays, _ in top_stations(limit):
+            click.echo("  {:>6}  {}".format(plays, name))
+
+    click.echo('Top songs:')
+    for title, artist, plays, _ in top_songs(station, limit):
+        click.echo("  {:>6}  {} by {}".format(plays, title, artist))
+
+
+@cli.command('import',
+             help=("import loads past plays from pianobar-style key=value "
+                   "logs, JSON lines or CSV files in batches. An interrupted "
+                   "import picks up where it stopped when run again. Features "
+                   "of the imported songs are left for `pianodb scrape'."),
+             short_help='import past plays from files')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format',
+              type=click.Choice(['keyvalue', 'jsonl', 'csv']),
+              help='Format of the files, guessed from their extension.')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--restart', is_flag=True,
+              help='Import files from the start even if partly imported.')
+@click.option('--client', 'block', flag_value='client', default=True,
+              help='Use the client database (default).')
+@click.option('--server', 'block', flag_value='server',
+              help='Use the server database instead of the client database.')
+@click.pass_context
+def import_(ctx, paths, file_format, batch_size, restart, block):
+    from pianodb.importer import import_file
+
+    config = ctx.obj[block]
+
+    if 'database' not in config:
+        sys.exit('no database configured')
+
+    open_database(config)
+
+    for path in paths:
+        imported = skipped = 0
+        for imported, skipped in import_file(path, file_format, batch_size,
+                                             restart):
+            pass
+        click.echo("{}: imported {} plays, skipped {} records".format(
+            path, imported, skipped))
+
+
+@cli.command(help=("export writes every play, with its station, song, album, "
+                   "artist and features, as JSON lines, CSV or Parquet. With "
+                   "--since only plays from then on are exported."),
+             short_help='export plays for analysis')
+@click.option('--format', 'file_format',
+              type=click.Choice(['jsonl', 'csv', 'parquet']),
+              default='jsonl', show_default=True)
+@click.option('--since',
+              help='Only export plays at or after this ISO 8601 timestamp.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='File to write instead of stdout.')
+@click.option('--client', 'block', flag_value='client', default=True,
+              help='Use the client database (default).')
+@click.option('--server', 'block', flag_value='server',
+              help='Use the server database instead of the client database.')
+@click.pass_context
+def export(ctx, file_format, since, output, block):
+    from pianodb.exporter import ENCODERS, export_plays, write_parquet
+    from pianodb.queries import InvalidQuery, parse_datetime
+
+    config = ctx.obj[block]
+
+    if 'database' not in config:
+        sys.exit('no database configured')
+
+    if since:
+        try:
+            since = parse_datetime(since)
+        except InvalidQuery as exc:
+            sys.exit(str(exc))
+
+    open_database(config)
+    chunks = export_plays(since)
+
+    if file_format == 'parquet':
+        if not output:
+            sys.exit('parquet exports must be written to an --output file')
+        try:
+            write_parquet(chunks, output)
+        except ImportError:
+            sys.exit('parquet exports require pyarrow, '
+                     'install pianodb[parquet]')
+        return
+
+    with click.open_file(output or '-', 'w') as f:
+        for text in ENCODERS[file_format](chunks):
+            f.write(text)
+
+
+@cli.command(help=("similar lists the songs most like a song, or the artists "
+                   "most like an artist, by their Music Genome features. With "
+                   "--station it lists the features most common on a station "
+                   "instead. --update first adds newly scraped features to "
+                   "the similarity index."),
+             short_help='find similar songs and artists')
+@click.argument('artist', required=False)
+@click.argument('title', required=False)
+@click.option('--station', help='Profile the features of this station.')
+@click.option('--metric', type=click.Choice(['cosine', 'jaccard']),
+              default='cosine', show_default=True)
+@click.option('--limit', default=10, show_default=True)
+@click.option('--update', is_flag=True,
+              help='Update the index with new features first.')
+@click.option('--rebuild', is_flag=True,
+              help='Rebuild the index from scratch first.')
+@click.option('--client', 'block', flag_value='client', default=True,
+              help='Use the client database (default).')
+@click.option('--server', 'block', flag_value='server',
+              help='Use the server database instead of the client database.')
+@click.pass_context
+def similar(ctx, artist, title, station, metric, limit, update, rebuild,
+            block):
+    import pianodb.model as model
+
+    config = ctx.obj[block]
+
+    if 'database' not in config:
+        sys.exit('no database configured')
+    if not (config.get('similarity') or {}).get('path'):
+        sys.exit('no similarity index configured')
+    path = config['similarity']['path']
+
+    try:
+        from pianodb.similarity import NotIndexed, SimilarityIndex, update_index
+    except ImportError:
+        sys.exit('similarity queries require numpy, '
+                 'install pianodb[similarity]')
+    from pianodb.queries import scored_artists, scored_songs, station_song_ids
+
+    open_database(config)
+
+    if update or rebuild:
+        index = update_index(path, rebuild)
+    else:
+        try:
+            index = SimilarityIndex.load(path)
+        except FileNotFoundError:
+            sys.exit("similarity index not built, run `pianodb similar "
+                     "--update'")
+
+    try:
+        if station:
+            try:
+                station = model.Station.get(model.Station.name == station)
+            except model.Station.DoesNotExist:
+                sys.exit('no such station')
+            for text, share in index.feature_profile(
+                    station_song_ids(station.id), limit):
+                click.echo("  {:>4.0%}  {}".format(share, text))
+        elif artist:
+            try:
+                artist = model.Artist.get(model.Artist.name == artist)
+            except model.Artist.DoesNotExist:
+                sys.exit('no such artist')
+
+            if not title:
+                for row in scored_artists(
+                        index.similar_artists(artist.id, limit)):
+                    click.echo("  {score:.3f}  {name}".format(**row))
+                return
+
+            song = (model.Song
+                    .select()
+                    .join(model.Album)
+                    .where(model.Album.artist == artist.id,
+                           model.Song.title == title)
+                    .first())
+            if song is None:
+                sys.exit('no such song')
+            for row in scored_songs(
+                    index.similar_songs(song.id, limit, metric)):
+                click.echo("  {score:.3f}  {title} by {artist}".format(**row))
+        elif not (update or rebuild):
+            sys.exit('give an artist, an artist and title, or --station')
+    except NotIndexed as exc:
+        sys.exit(str(exc))
+
+
+@cli.command('search',
+             help=("search finds artists, albums, songs and features by "
+                   "name. Every word of QUERY must begin a word of the name, "
+                   "and the best matches are listed first."),
+             short_help='search the library by name')
+@click.argument('query', nargs=-1, required=True)
+@click.option('--type', 'kinds', multiple=True,
+              type=click.Choice(['artist', 'album', 'song', 'feature']),
+              help='Only find this kind of thing. May be repeated.')
+@click.option('--limit', default=20, show_default=True)
+@click.option('--rebuild', is_flag=True,
+              help='Index every name again first.')
+@click.option('--client', 'block', flag_value='client', default=True,
+              help='Use the client database (default).')
+@click.option('--server', 'block', flag_value='server',
+              help='Use the server database instead of the client database.')
+@click.pass_context
+def search_(ctx, query, kinds, limit, rebuild, block):
+    from pianodb.pianodb import atomic
+    from pianodb.search import KINDS, InvalidSearch, rebuild_search_index, search
+
+    config = ctx.obj[block]
+
+    if 'database' not in config:
+        sys.exit('no database configured')
+
+    open_database(config)
+
+    if rebuild:
+        with atomic():
+            rebuild_search_index()
+
+    try:
+        results = search(' '.join(query), kinds or tuple(KINDS), limit)
+    except InvalidSearch as exc:
+        sys.exit(str(exc))
+
+    for result in results:
+        if result['type'] in ('album', 'song'):
+            name = "{title} by {artist}".format(**result)
+        else:
+            name = result.get('name') or result['text']
+        click.echo("  {:<7}  {}".format(result['type'], name))
+
+
+@cli.command(help=("migrate upgrades the schema of an existing database to "
+                   "the one this version of pianodb expects, applying each "
+                   "pending migration in order. New databases are created "
+                   "up to date."),
+             short_help='upgrade the database schema')
+@click.option('--client', 'block', flag_value='client', default=True,
+              help='Use the client database (default).')
+@click.option('--server', 'block', flag_value='server',
+              help='Use the server database instead of the client database.')
+@click.pass_context
+def migrate(ctx, block):
+    from pianodb.migrations import migrate as apply_migrations
+
+    config = ctx.obj[block]
+
+    if 'database' not in config:
+        sys.exit('no database configured')
+
+    open_database(config, check_schema=False)
+
+    applied = apply_migrations()
+    if applied:
+        for version in applied:
+            click.echo("Applied migration {}".format(version))
+    else:
+        click.echo('Database schema is up to date.')
@@ -0,0 +1,237 @@
+"""
+The client side of pianodb's remote API, including the optional client daemon
+that the songfinish eventcmd can hand records to over a UNIX socket.
+
+``requests`` is only imported once something is actually sent, since handing
+a record to the daemon is on the eventcmd's hot path.
+"""
+
+import os
+import gzip
+import socket
+import logging
+import threading
+import socketserver
+
+import msgpack
+
+from pianodb.spool import HEADER, Spool, SpoolBusy, flush_spool, pack_frame
+from pianodb.wire import pack
+
+log = logging.getLogger(__name__)
+
+# Sent by the daemon once a record is safely in the spool.
+ACK = b'\x06'
+
+# Errors refusing the payload itself, which resending can never change. Any
+# other error may not recur: the token may be fixed, the server may be less
+# busy or upgraded to one that serves batches.
+REJECTED_STATUS_CODES = {400, 413, 415, 422}
+
+
+def default_socket_path():
+    return os.path.join(os.environ['HOME'], '.config', 'pianobar',
+                        'pianodb.sock')
+
+
+class RemoteClient:
+    """
+    Sends songfinish records to the server described by a client config's
+    ``remote`` mapping, authenticating with the config's ``token``.
+    """
+
+    def __init__(self, config, session=None, rejected=None):
+        try:
+            self.host = config['remote']['host']
+            self.port = config['remote']['port']
+        except (KeyError, TypeError):
+            raise ValueError('missing parameters for communication with remote')
+
+        self.prefix = config['remote'].get('api_prefix', '/api/v1')
+        self.timeout = config['remote'].get('timeout', 10)
+        self.compress = config['remote'].get('compress', False)
+        self.compact = config['remote'].get('format') == 'compact'
+        self.token = config['token']
+        self.session = session
+        # A spool that records the server will never accept are set aside in.
+        self.rejected = rejected
+        # Seconds the server last asked to wait before sending again.
+        self.retry_after = None
+
+    def url(self, route):
+        return "http://{}:{}{}{}".format(self.host, self.port, self.prefix,
+                                         route)
+
+    def post(self, route, data):
+        import requests
+
+        headers = {
+            'X-Auth-Token': self.token,
+            'Content-Type': 'application/msgpack'
+        }
+        if self.compress:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+
+        session = self.session or requests
+        return session.post(self.url(route), data=data, headers=headers,
+                            timeout=self.timeout)
+
+    def send(self, records):
+        """
+        Send a batch of songfinish records, returning whether the server
+        acknowledged them. Records the server rejects as invalid are
+        acknowledged too, since resending them can never succeed, and set
+        aside in the ``rejected`` spool if there is one.
+        """
+        import requests
+
+        data = pack(records) if self.compact else msgpack.packb(records)
+        self.retry_after = None
+        try:
+            r = self.post('/songfinish/batch', data)
+        except requests.RequestException:
+            return False
+
+        if r.ok:
+            try:
+                results = msgpack.unpackb(r.content,
+                                          encoding='utf-8')['results']
+            except (ValueError, TypeError, KeyError):
+                results = []
+            self.reject([record for record, result in zip(records, results)
+                         if 'error' in result])
+            return True
+
+        if r.status_code in REJECTED_STATUS_CODES:
+            self.reject(records)
+            return True
+
+        if 'Retry-After' in r.headers:
+            try:
+                self.retry_after = int(r.headers['Retry-After'])
+            except ValueError:
+                pass
+        return False
+
+    def reject(self, records):
+        if not records:
+            return
+        log.warning('the server rejected %s records', len(records))
+        if self.rejected is not None:
+            for record in records:
+                self.rejected.append(record)
+
+
+def rejected_spool(spool):
+    """
+    The spool the records of ``spool`` the server rejects are set aside in.
+    """
+    return Spool(spool.path + '.rejected')
+
+
+def send_to_daemon(path, record, timeout=1):
+    """
+    Hand ``record`` to the client daemon listening on ``path``. Returns
+    whether the daemon acknowledged it; callers fall back to the spool
+    otherwise.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(pack_frame(record))
+            sock.shutdown(socket.SHUT_WR)
+            return sock.recv(1) == ACK
+    except OSError:
+        return False
+
+
+def read_frames(rfile):
+    while True:
+        header = rfile.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        length, = HEADER.unpack(header)
+        payload = rfile.read(length)
+        if len(payload) < length:
+            return
+        yield msgpack.unpackb(payload, encoding='utf-8')
+
+
+class ClientDaemon:
+    """
+    A long-lived client process. Records arriving on a UNIX socket are
+    appended to the spool, acknowledged, and then shipped to the server in
+    coalesced batches over a single pooled ``requests.Session``.
+
+    Records wait up to ``linger`` seconds for company before a flush, and a
+    failed flush is retried every ``retry`` seconds, or after as many as the
+    server's ``Retry-After`` asks for.
+    """
+
+    def __init__(self, config, spool, socket_path, linger=1, retry=30):
+        import requests
+
+        self.spool = spool
+        self.socket_path = socket_path
+        self.linger = linger
+        self.retry = retry
+        self.batch_size = config['remote'].get('batch_size', 500)
+        self.session = requests.Session()
+        self.remote = RemoteClient(config, session=self.session,
+                                   rejected=rejected_spool(spool))
+        self.pending = threading.Event()
+        self.stopped = threading.Event()
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for record in read_frames(self.rfile):
+                    daemon.spool.append(record)
+                self.wfile.write(ACK)
+                daemon.pending.set()
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(socket_path,
+                                                             Handler)
+        self.server.daemon_threads = True
+
+    def flush(self):
+        try:
+            flush_spool(self.spool, self.remote.send, self.batch_size)
+        except SpoolBusy:
+            pass
+        return not any(True for _ in self.spool.records())
+
+    def flusher(self):
+        # Anything left over from before the daemon started goes out first.
+        self.pending.set()
+        while not self.stopped.is_set():
+            self.pending.wait()
+            self.stopped.wait(self.linger)
+            self.pending.clear()
+            if not self.flush():
+                # A busy server says when to come back.
+                retry = self.remote.retry_after or self.retry
+                log.warning('flush failed, retrying in %s seconds', retry)
+                self.stopped.wait(retry)
+                self.pending.set()
+
+    def serve_forever(self):
+        thread = threading.Thread(target=self.flusher, daemon=True)
+        thread.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.pending.set()
+            thread.join()
+            self.server.server_close()
+            os.unlink(self.socket_path)
+            self.session.close()
+
+    def shutdown(self):
+        self.server.shutdown()
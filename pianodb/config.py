@@ -0,0 +1,61 @@
+"""
+Loading the pianodb config on the hot path of every eventcmd.
+
+Parsing YAML is one of the most expensive parts of starting up, so the parsed
+config is pickled into the user's cache directory and reused for as long as
+the config file itself is unchanged.
+"""
+
+import os
+import pickle
+import hashlib
+
+
+def default_config_path():
+    return os.path.join(os.environ['HOME'], '.config', 'pianobar',
+                        'pianodb.yml')
+
+
+def cache_path(path):
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.environ['HOME'], '.cache'))
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_home, 'pianodb', "config-{}.pickle".format(digest))
+
+
+def load_config(path=None):
+    """
+    Return the config at ``path``, parsing it with ``get_config`` only if it
+    has changed since it was last cached.
+    """
+    path = path if path else default_config_path()
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        stat = None
+    stamp = (stat.st_mtime_ns, stat.st_size) if stat else None
+
+    cached = cache_path(path)
+    if stamp:
+        try:
+            with open(cached, 'rb') as cache_file:
+                cached_stamp, config = pickle.load(cache_file)
+            if cached_stamp == stamp:
+                return config
+        except Exception:  # A missing or unreadable cache is just a miss.
+            pass
+
+    from pianodb.pianodb import get_config
+    config = get_config(path)
+
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp_path = "{}.{}".format(cached, os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump((stamp, config), cache_file)
+        os.replace(tmp_path, cached)
+    except OSError:
+        pass
+
+    return config
@@ -0,0 +1,145 @@
+"""
+Deduplication of retried songfinish records.
+
+Every record that can be told apart from a replay of itself has a key: the
+client's own ``key`` field or ``Idempotency-Key`` header if it sent one, and
+otherwise a hash of its artist, title, station and ``timestamp``. Records
+with neither a key nor a timestamp are always written, as before.
+
+Keys are kept for a TTL in two tiers, like ``pianodb.cache.FeatureCache``: a
+bounded LRU in each process and a table every process shares. Requests look
+their keys up before any write work and skip records already written. The
+keys of the rest are inserted in the transaction that writes them, so a
+record is recorded as seen if and only if it was written.
+"""
+
+import hashlib
+from datetime import datetime, timedelta
+
+import pianodb.model as model
+from pianodb.cache import MISSING, LRUCache
+from pianodb.pianodb import chunked, insert_rows
+
+# Fields that tell one play from another, along with its timestamp.
+IDENTITY_FIELDS = ('artist', 'title', 'stationName')
+
+
+def record_key(songfinish):
+    """
+    The dedup key of ``songfinish``, a 32 character hex digest, or ``None``
+    if it can't be told apart from a replay. ``songfinish`` must have passed
+    ``pianodb.routes.validate_songfinish``.
+    """
+    if songfinish.get('key') is not None:
+        material = "key\x1f{}".format(songfinish['key'])
+    elif songfinish.get('timestamp') is not None:
+        material = '\x1f'.join([str(songfinish[f]) for f in IDENTITY_FIELDS] +
+                               [str(int(songfinish['timestamp']))])
+    else:
+        return None
+    return hashlib.md5(material.encode('utf-8')).hexdigest()
+
+
+class DedupIndex:
+    """
+    The keys of the records written in at least the last ``ttl`` seconds. Up
+    to ``maxsize`` of them are also kept in memory. Expired keys are deleted
+    after every ``purge_interval`` writes.
+    """
+
+    def __init__(self, ttl=7 * 24 * 60 * 60, maxsize=65536,
+                 purge_interval=1000):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._claims = 0
+
+    @classmethod
+    def from_config(cls, config):
+        options = ('ttl', 'maxsize', 'purge_interval')
+        return cls(**{k: v for k, v in (config or {}).items() if k in options})
+
+    def stored(self, keys):
+        """
+        The subset of ``keys`` in the shared tier.
+        """
+        found = set()
+        for chunk in chunked(keys):
+            query = (model.IngestKey
+                     .select(model.IngestKey.digest)
+                     .where(model.IngestKey.digest << chunk)
+                     .tuples())
+            found.update(key for key, in query)
+        return found
+
+    def duplicates(self, songfinishes):
+        """
+        Whether each of ``songfinishes`` has been written already or repeats
+        an earlier record of the same list. Takes at most one query, and
+        none when every key is remembered by this process.
+        """
+        keys = [record_key(s) if isinstance(s, dict) else None
+                for s in songfinishes]
+
+        unknown = {key for key in keys
+                   if key is not None and self.local.get(key) is MISSING}
+        seen = self.stored(unknown) if unknown else set()
+        for key in seen:
+            self.local.set(key, True)
+
+        flags = []
+        for key in keys:
+            if key is None:
+                flags.append(False)
+                continue
+            flags.append(key in seen or key not in unknown)
+            seen.add(key)
+        return flags
+
+    def claim(self, songfinishes):
+        """
+        Drop the records among ``songfinishes`` written since they were
+        checked, such as replays submitted concurrently, and record the keys
+        of the rest. Must run in the transaction that writes them. Returns
+        the records to write and their keys.
+
+        A replay written by a concurrent transaction on another connection
+        makes the insert fail with an ``IntegrityError``. Retrying then skips
+        it.
+        """
+        keyed = [(record_key(s), s) for s in songfinishes]
+        stored = self.stored({key for key, _ in keyed if key is not None})
+
+        fresh, keys = [], []
+        for key, songfinish in keyed:
+            if key is not None:
+                if key in stored:
+                    continue
+                stored.add(key)
+                keys.append(key)
+            fresh.append(songfinish)
+
+        expires = datetime.now() + timedelta(seconds=self.ttl)
+        insert_rows(model.IngestKey,
+                    [{'digest': key, 'expires': expires} for key in keys])
+
+        self._claims += 1
+        if self._claims % self.purge_interval == 0:
+            self.purge()
+        return fresh, keys
+
+    def remember(self, keys):
+        """
+        Remember ``keys`` once the transaction that claimed them commits.
+        """
+        for key in keys:
+            self.local.set(key, True)
+
+    def purge(self):
+        """
+        Delete expired keys from the shared tier.
+        """
+        (model.IngestKey
+         .delete()
+         .where(model.IngestKey.expires <= datetime.now())
+         .execute())
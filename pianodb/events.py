@@ -0,0 +1,40 @@
+"""
+The pianobar events pianodb is invoked for. This module is imported before
+anything else on every event, so it must stay free of heavy imports.
+"""
+
+# Notice the conspicuously absent 'songfinish' event.
+EVENTS = (
+    'artistbookmark',
+    'songban',
+    'songbookmark',
+    'songexplain',
+    'songlove',
+    'songmove',
+    'songshelf',
+    'songstart',
+    'stationaddgenre',
+    'stationaddmusic',
+    'stationaddshared',
+    'stationcreate',
+    'stationdelete',
+    'stationdeleteartistseed',
+    'stationdeletefeedback',
+    'stationdeletesongseed',
+    'stationfetchgenre',
+    'stationfetchinfo',
+    'stationfetchplaylist',
+    'stationquickmixtoggle',
+    'stationrename',
+    'usergetstations',
+    'userlogin',
+)
+
+
+def gen_dummy_cmd(name):
+    from click import Command
+
+    return Command(name,
+                   help=("This is an unimplimented pianobar eventcmd handler. "
+                         "Calling this subcommand will do absolutely nothing."),
+                   short_help='unimplimented pianobar eventcmd')
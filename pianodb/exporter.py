@@ -0,0 +1,116 @@
+"""
+Export of the play history for analysis outside pianodb.
+
+Plays are read in chunks with the keyset pagination of ``pianodb.queries``,
+so memory use is bounded by the chunk size however large the database is,
+and every chunk is an indexed range scan on any of the supported backends.
+Each row is denormalized with its station, song, album, artist and features.
+
+Rows are written as JSON lines, CSV or, with the optional pyarrow, Parquet.
+Exports can be limited to plays since a timestamp, so that a nightly job only
+moves what is new.
+"""
+
+import io
+import csv
+import json
+
+import pianodb.model as model
+from pianodb.pianodb import chunked
+from pianodb.queries import plays, parse_datetime
+
+FORMATS = ('jsonl', 'csv', 'parquet')
+
+COLUMNS = ('id', 'timestamp', 'station', 'artist', 'album', 'title', 'song',
+           'duration', 'song_duration', 'features')
+
+# Separates features in the single CSV column they share.
+FEATURE_SEPARATOR = '|'
+
+
+def song_features(song_ids):
+    """
+    Map each of ``song_ids`` that has features to their sorted texts.
+    """
+    features = {}
+    for ids in chunked(song_ids):
+        query = (model.SongFeature
+                 .select(model.SongFeature.song, model.Feature.text)
+                 .join(model.Feature)
+                 .where(model.SongFeature.song << ids)
+                 .order_by(model.Feature.text)
+                 .tuples())
+        for song, text in query:
+            features.setdefault(song, []).append(text)
+    return features
+
+
+def export_plays(since=None, chunk_size=1000):
+    """
+    Yield lists of at most ``chunk_size`` play rows, oldest first, of the
+    plays at or after ``since``.
+    """
+    cursor = None
+    while True:
+        rows, cursor = plays(since=since, cursor=cursor, limit=chunk_size)
+        features = song_features({row['song'] for row in rows})
+        for row in rows:
+            row['features'] = features.get(row['song'], [])
+        if rows:
+            yield rows
+        if cursor is None:
+            return
+
+
+def jsonl_lines(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def csv_lines(chunks):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, COLUMNS)
+    writer.writeheader()
+    for rows in chunks:
+        writer.writerows(dict(row, features=FEATURE_SEPARATOR.join(
+            row['features'])) for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+# Encoders of the formats that can be streamed, e.g. to stdout or a client.
+ENCODERS = {
+    'jsonl': jsonl_lines,
+    'csv': csv_lines,
+}
+
+
+def write_parquet(chunks, path):
+    """
+    Write play rows to a Parquet file at ``path``, one row group per chunk.
+    Requires pyarrow.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('timestamp', pyarrow.timestamp('us')),
+        ('station', pyarrow.string()),
+        ('artist', pyarrow.string()),
+        ('album', pyarrow.string()),
+        ('title', pyarrow.string()),
+        ('song', pyarrow.int64()),
+        ('duration', pyarrow.int32()),
+        ('song_duration', pyarrow.int32()),
+        ('features', pyarrow.list_(pyarrow.string())),
+    ])
+
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            for row in rows:
+                row['timestamp'] = parse_datetime(row['timestamp'])
+            columns = {column: [row[column] for row in rows]
+                       for column in COLUMNS}
+            writer.write_table(pyarrow.Table.from_pydict(columns, schema))
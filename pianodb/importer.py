@@ -0,0 +1,162 @@
+"""
+Bulk import of past plays from pianobar logs and listening exports.
+
+Files are streamed through a pipeline of generators: a reader parses records
+one at a time, each is normalized into a songfinish record, and batches of
+them are written by ``bulk_update_db``, which resolves artists, albums and
+stations set-wise and inserts everything else in multi-row INSERTs. Only one
+batch is ever held in memory.
+
+Every batch is committed together with an ``ImportCheckpoint`` counting the
+records consumed so far, so an interrupted import resumes after the last
+committed batch without duplicating plays. Feature scraping is left to
+``pianodb scrape``; importing only queues the new songs.
+"""
+
+import os
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+
+import pianodb.model as model
+from pianodb.pianodb import atomic, bulk_update_db, chunked
+from pianodb.routes import validate_songfinish
+
+FORMATS = ('keyvalue', 'jsonl', 'csv')
+
+# Fields a record must have to be imported.
+REQUIRED_FIELDS = ('artist', 'title', 'album', 'stationName', 'songDuration')
+
+
+def read_keyvalue(lines):
+    """
+    Parse pianobar-style ``key=value`` lines, as the eventcmd receives them on
+    stdin, into records separated by blank lines.
+    """
+    record = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            if record:
+                yield record
+            record = {}
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            record[key] = value
+    if record:
+        yield record
+
+
+def read_jsonl(lines):
+    """
+    Parse one JSON record per line. Malformed lines are yielded as ``None``,
+    so they are skipped like incomplete records and still counted by the
+    checkpoint.
+    """
+    for line in lines:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def read_csv(lines):
+    return csv.DictReader(lines)
+
+
+READERS = {
+    'keyvalue': read_keyvalue,
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def guess_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.json', '.ndjson'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    return 'keyvalue'
+
+
+def parse_timestamp(value):
+    """
+    Convert a UNIX or ISO 8601 timestamp to a UNIX timestamp.
+    """
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+                   .timestamp())
+
+
+def normalize(record):
+    """
+    Turn an imported record into a songfinish record, or ``None`` if it isn't
+    one the server would accept: if it lacks a required field or has
+    malformed or out of range durations or timestamps.
+    """
+    if not isinstance(record, dict) or \
+            not all(record.get(field) for field in REQUIRED_FIELDS):
+        return None
+
+    try:
+        songfinish = {
+            'artist': record['artist'],
+            'title': record['title'],
+            'album': record['album'],
+            'coverArt': record.get('coverArt') or '',
+            'stationName': record['stationName'],
+            'songDuration': str(int(record['songDuration'])),
+            'songPlayed': str(int(record.get('songPlayed') or
+                                  record['songDuration'])),
+            'rating': record.get('rating') or '0',
+            'detailUrl': (record.get('detailUrl') or '').split('?')[0],
+        }
+        if record.get('timestamp'):
+            songfinish['timestamp'] = parse_timestamp(record['timestamp'])
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+    if validate_songfinish(songfinish) is not None:
+        return None
+    return songfinish
+
+
+def checkpoint(source):
+    entry, _ = model.ImportCheckpoint.get_or_create(source=source)
+    return entry
+
+
+def import_file(path, file_format=None, batch_size=1000, restart=False):
+    """
+    Import the records in ``path``, resuming after the last batch committed
+    by a previous import of it unless ``restart``. Yields the number of
+    records imported and skipped after each batch.
+    """
+    source = os.path.abspath(path)
+    read = READERS[file_format or guess_format(path)]
+
+    entry = checkpoint(source)
+    if restart:
+        entry.records = 0
+        entry.save()
+
+    imported = skipped = 0
+    with open(path, newline='', encoding='utf-8') as lines:
+        records = islice(read(lines), entry.records, None)
+        for batch in chunked(records, batch_size):
+            songfinishes = [s for s in map(normalize, batch) if s is not None]
+            with atomic():
+                bulk_update_db(songfinishes)
+                (model.ImportCheckpoint
+                 .update(records=model.ImportCheckpoint.records + len(batch),
+                         updated=datetime.now())
+                 .where(model.ImportCheckpoint.id == entry.id)
+                 .execute())
+            imported += len(songfinishes)
+            skipped += len(batch) - len(songfinishes)
+            yield imported, skipped
@@ -0,0 +1,398 @@
+"""
+Metrics of the hot paths in the Prometheus text exposition format.
+
+Requests, the stages of handling songfinish records and scraping features,
+and database queries are counted and timed in process by the metrics of
+``registry``. Gunicorn serves from several worker processes and scrapes from
+another, so each process periodically writes a snapshot of its metrics to a
+shared directory and ``/metrics`` merges the snapshots of every process.
+Counters and histograms are summed over every process that has run, gauges
+only over the processes still running.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pianodb.model as model
+from pianodb.cache import identity_map
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the buckets of timing histograms.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def merge(self, total, value):
+        return total + value
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, or that ``function`` computes when the
+    gauge is collected as a mapping of label value tuples to values.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def snapshot(self):
+        if self.function is None:
+            return super().snapshot()
+        return [[list(key), value] for key, value in self.function().items()]
+
+
+class Histogram(Metric):
+    """
+    Observations counted into buckets. Each value is the count of every
+    bucket, the last one unbounded, followed by the sum of the observations.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), list(counts)]
+                    for key, counts in self.values.items()]
+
+    def merge(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escape(value):
+    return (value.replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, escape(value))
+        for name, value in zip(names, values)))
+
+
+class Registry:
+    """
+    The metrics of this process. Once ``configure``d with a directory, the
+    process started with ``start`` shares its metrics with the others writing
+    there every ``interval`` seconds.
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.directory = None
+        self.interval = 5
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def configure(self, directory, interval=5):
+        """
+        Share metrics through ``directory``, forgetting the snapshots of any
+        processes that wrote there before.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                os.remove(os.path.join(directory, name))
+        self.directory = directory
+        self.interval = interval
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def start(self):
+        """
+        Start sharing this process' metrics. A forked process forgets what it
+        inherited from its parent, which counts its metrics itself.
+        """
+        with self._lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self._thread = None
+                self.reset()
+            if self.directory is None or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+        atexit.register(self.write)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def snapshot(self):
+        return {name: metric.snapshot()
+                for name, metric in self.metrics.items()}
+
+    def write(self):
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, "{}.json".format(os.getpid()))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def snapshots(self):
+        """
+        Yield the snapshot of every process sharing metrics, and whether the
+        process is still running, starting with this one.
+        """
+        yield self.snapshot(), True
+        if self.directory is None:
+            return
+
+        own = "{}.json".format(os.getpid())
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # Gone or being replaced.
+            yield snapshot, is_running(int(name[:-len('.json')]))
+
+    def collect(self):
+        """
+        Merge the values of every metric across processes.
+        """
+        totals = {name: {} for name in self.metrics}
+        for snapshot, running in self.snapshots():
+            for name, metric in self.metrics.items():
+                if metric.kind == 'gauge' and not running:
+                    continue
+                values = totals[name]
+                for key, value in snapshot.get(name, ()):
+                    key = tuple(key)
+                    values[key] = (metric.merge(values[key], value)
+                                   if key in values else value)
+        return totals
+
+    def exposition(self):
+        """
+        Render every metric in the Prometheus text format.
+        """
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for key, value in sorted(values.items()):
+                if metric.kind != 'histogram':
+                    lines.append('{}{} {}'.format(
+                        name, format_labels(metric.labels, key), value))
+                    continue
+
+                cumulative = 0
+                bounds = [repr(float(b)) for b in metric.buckets] + ['+Inf']
+                for bound, count in zip(bounds, value):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(metric.labels + ('le',),
+                                            key + (bound,)),
+                        cumulative))
+                labels = format_labels(metric.labels, key)
+                lines.append('{}_sum{} {}'.format(name, labels, value[-1]))
+                lines.append('{}_count{} {}'.format(name, labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def pool_connections():
+    database = model.db.obj
+    if not hasattr(database, '_in_use'):
+        return {}
+    return {('in_use',): len(database._in_use),
+            ('idle',): len(database._connections)}
+
+
+def identity_map_lookups():
+    return {(name, result): stats[result]
+            for name, stats in identity_map.stats().items()
+            for result in ('hits', 'misses')}
+
+
+def identity_map_size():
+    return {(name,): stats['size']
+            for name, stats in identity_map.stats().items()}
+
+
+REQUESTS_IN_FLIGHT = registry.gauge(
+    'pianodb_requests_in_flight', 'Requests being served.')
+REQUEST_DURATION = registry.histogram(
+    'pianodb_request_duration_seconds', 'Time taken to serve requests.',
+    ('route', 'method', 'status'))
+REQUEST_QUERIES = registry.histogram(
+    'pianodb_request_queries', 'Database queries made serving requests.',
+    ('route',), buckets=QUERY_BUCKETS)
+STAGE_DURATION = registry.histogram(
+    'pianodb_stage_duration_seconds',
+    'Time spent unpacking and writing songfinish records and fetching and '
+    'parsing detail pages.', ('stage',))
+QUERY_DURATION = registry.histogram(
+    'pianodb_db_query_duration_seconds', 'Time taken by database queries.')
+POOL_CONNECTIONS = registry.gauge(
+    'pianodb_db_pool_connections', 'Pooled database connections.',
+    ('state',), function=pool_connections)
+SCRAPE_CACHE_LOOKUPS = registry.counter(
+    'pianodb_scrape_cache_lookups_total',
+    'Feature cache lookups of detail pages to scrape.', ('result',))
+SCRAPE_ERRORS = registry.counter(
+    'pianodb_scrape_errors_total', 'Failed fetches of detail pages.')
+REJECTED_REQUESTS = registry.counter(
+    'pianodb_rejected_requests_total',
+    'Requests turned away by admission control.', ('reason',))
+DUPLICATES = registry.counter(
+    'pianodb_duplicate_songfinishes_total',
+    'Songfinish records skipped as replays of ones already written.')
+IDENTITY_MAP_LOOKUPS = registry.gauge(
+    'pianodb_identity_map_lookups',
+    'Natural key lookups answered or missed by the identity map since the '
+    'process started.', ('model', 'result'), function=identity_map_lookups)
+IDENTITY_MAP_SIZE = registry.gauge(
+    'pianodb_identity_map_size', 'Natural keys held by the identity map.',
+    ('model',), function=identity_map_size)
+
+_thread = threading.local()
+
+
+def instrument_database(database):
+    """
+    Time every query ``database`` runs and count it towards the request being
+    served by the thread running it.
+    """
+    if getattr(database, 'instrumented', False):
+        return
+
+    execute_sql = database.execute_sql
+
+    def timed_execute_sql(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return execute_sql(*args, **kwargs)
+        finally:
+            QUERY_DURATION.observe(time.perf_counter() - start)
+            _thread.queries = getattr(_thread, 'queries', 0) + 1
+
+    database.execute_sql = timed_execute_sql
+    database.instrumented = True
+
+
+def count_queries():
+    """
+    Start counting the queries of this thread from zero, returning how many
+    there were since the last time.
+    """
+    queries = getattr(_thread, 'queries', 0)
+    _thread.queries = 0
+    return queries
+
+
+def add_queries(count):
+    """
+    Count ``count`` queries that another thread ran on behalf of this one
+    towards the request it is serving.
+    """
+    _thread.queries = getattr(_thread, 'queries', 0) + count
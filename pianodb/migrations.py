@@ -0,0 +1,167 @@
+"""
+Versioned schema migrations.
+
+``create_database`` only creates tables that don't exist yet, so changes to
+existing tables are made here instead. Each migration is a function taking a
+``playhouse.migrate`` migrator, and its version is its position in
+``MIGRATIONS``. Applied versions are recorded in the ``SchemaVersion`` table;
+databases created from scratch already have the current schema and are
+stamped with the latest version.
+"""
+
+from peewee import fn
+from playhouse.migrate import SchemaMigrator, migrate as run_operations
+
+import pianodb.model as model
+from pianodb.pianodb import atomic, chunked, insert_or_ignore
+from pianodb.search import create_search_index
+from pianodb.stats import rebuild_stats
+
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def latest_version():
+    return len(MIGRATIONS)
+
+
+def current_version():
+    return model.SchemaVersion.select(
+        fn.MAX(model.SchemaVersion.version)).scalar() or 0
+
+
+def pending_migrations():
+    """
+    The ``(version, migration)`` pairs not yet applied to the database.
+    """
+    current = current_version()
+    return [(version, func)
+            for version, func in enumerate(MIGRATIONS, start=1)
+            if version > current]
+
+
+def stamp(version=None):
+    """
+    Record every migration up to ``version``, the latest by default, as
+    applied without running it.
+    """
+    version = latest_version() if version is None else version
+    current = current_version()
+    if version > current:
+        model.SchemaVersion.insert_many(
+            {'version': v} for v in range(current + 1, version + 1)).execute()
+
+
+def migrate():
+    """
+    Apply pending migrations in order, each in its own transaction. Returns the
+    versions applied.
+    """
+    migrator = SchemaMigrator.from_database(model.db.obj)
+    applied = []
+    for version, func in pending_migrations():
+        with atomic():
+            func(migrator)
+            model.SchemaVersion.create(version=version)
+        applied.append(version)
+    return applied
+
+
+def duplicates(model_class, fields):
+    """
+    Map the id of each row that duplicates another on ``fields`` to the id of
+    the row kept in its place, the lowest.
+    """
+    groups = (model_class
+              .select(fn.MIN(model_class.id), *fields)
+              .group_by(*fields)
+              .having(fn.COUNT(model_class.id) > 1)
+              .tuples())
+
+    merged = {}
+    for keep, *key in groups:
+        query = model_class.select(model_class.id).where(
+            *(field == value for field, value in zip(fields, key)))
+        merged.update((pk, keep) for pk, in query.tuples() if pk != keep)
+    return merged
+
+
+def merge_through(through_model, field, merged):
+    """
+    Repoint ``field`` of a many-to-many ``through_model`` from merged rows to
+    the rows kept, dropping pairs the kept row already has.
+    """
+    other, = (f for f in through_model._meta.sorted_fields
+              if f.name not in ('id', field.name))
+    for ids in chunked(merged):
+        rows = (through_model
+                .select(other, field)
+                .where(field << ids)
+                .tuples())
+        insert_or_ignore(through_model, [
+            {other.name: pk, field.name: merged[merged_id]}
+            for pk, merged_id in rows])
+        through_model.delete().where(field << ids).execute()
+
+
+def merge_songs(merged):
+    for merged_id, keep in merged.items():
+        model.Play.update(song=keep).where(
+            model.Play.song == merged_id).execute()
+
+    merge_through(model.SongFeature, model.SongFeature.song, merged)
+    merge_through(model.StationSong, model.StationSong.song, merged)
+
+    for ids in chunked(merged):
+        model.ScrapeJob.delete().where(model.ScrapeJob.song << ids).execute()
+        model.SongStats.delete().where(model.SongStats.song << ids).execute()
+        model.StationSongStats.delete().where(
+            model.StationSongStats.song << ids).execute()
+        model.Song.delete().where(model.Song.id << ids).execute()
+
+
+@migration
+def index_lookup_columns(migrator):
+    """
+    Make albums unique per artist and songs unique per album, and index the
+    columns ingest and the read API look rows up by. Existing duplicates are
+    merged into their oldest row first.
+    """
+    albums = duplicates(model.Album, (model.Album.artist, model.Album.title))
+    for merged_id, keep in albums.items():
+        model.Song.update(album=keep).where(
+            model.Song.album == merged_id).execute()
+    for ids in chunked(albums):
+        model.Album.delete().where(model.Album.id << ids).execute()
+
+    songs = duplicates(model.Song, (model.Song.album, model.Song.title))
+    merge_songs(songs)
+
+    run_operations(
+        migrator.add_index('album', ('artist_id', 'title'), True),
+        migrator.add_index('song', ('album_id', 'title'), True),
+        migrator.add_index('song', ('detail_url',), False),
+        migrator.add_index('play', ('timestamp', 'station_id'), False),
+    )
+
+
+@migration
+def add_search_index(migrator):
+    """
+    Index the names of artists, albums, songs and features for full-text
+    search.
+    """
+    create_search_index()
+
+
+@migration
+def fill_rollups(migrator):
+    """
+    Compute the listening statistics rollups from the Plays recorded before
+    they existed, and from scratch for the songs merged above.
+    """
+    rebuild_stats()
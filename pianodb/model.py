@@ -1,5 +1,6 @@
 import datetime
-from peewee import Model, CharField, ForeignKeyField, TimeField, DateTimeField, Proxy
+from peewee import (Model, CharField, ForeignKeyField, TimeField, DateTimeField,
+                    DateField, IntegerField, TextField, Proxy)
 from playhouse.fields import ManyToManyField
 
 db = Proxy()
@@ -19,12 +20,22 @@ class Album(BaseModel):
     artist = ForeignKeyField(Artist, related_name='albums')
     cover_art = CharField(null=True)
 
+    class Meta:
+        indexes = (
+            (('artist', 'title'), True),
+        )
+
 
 class Song(BaseModel):
     title = CharField()
     album = ForeignKeyField(Album, related_name='songs')
     duration = TimeField()
-    detail_url = CharField()
+    detail_url = CharField(index=True)
+
+    class Meta:
+        indexes = (
+            (('album', 'title'), True),
+        )
 
 
 class Feature(BaseModel):
@@ -50,3 +61,98 @@ class Play(BaseModel):
     station = ForeignKeyField(Station, related_name='plays')
     song = ForeignKeyField(Song, related_name='plays')
     duration = TimeField()
+
+    class Meta:
+        indexes = (
+            (('timestamp', 'station'), False),
+        )
+
+
+class ScrapeJob(BaseModel):
+    """
+    The feature scraping state of a Song. Rows are queued on ingest and
+    drained by ``pianodb.scraper``. A job is done once ``finished`` is set,
+    whether its Features were attached or it ran out of attempts.
+    """
+    song = ForeignKeyField(Song, related_name='scrape_jobs', unique=True)
+    detail_url = CharField()
+    attempts = IntegerField(default=0)
+    next_attempt = DateTimeField(default=datetime.datetime.now, index=True)
+    claimed_until = DateTimeField(null=True)
+    finished = DateTimeField(null=True)
+    last_error = CharField(null=True)
+
+
+class FeatureCacheEntry(BaseModel):
+    """
+    The shared tier of ``pianodb.cache.FeatureCache``. ``features`` holds a
+    JSON list of scraped features and ``error`` the reason a fetch failed.
+    """
+    url = CharField(unique=True)
+    features = TextField(null=True)
+    error = CharField(null=True)
+    expires = DateTimeField(index=True)
+
+
+class SongStats(BaseModel):
+    song = ForeignKeyField(Song, related_name='stats', unique=True)
+    plays = IntegerField(default=0, index=True)
+    seconds = IntegerField(default=0)
+
+
+class ArtistStats(BaseModel):
+    artist = ForeignKeyField(Artist, related_name='stats', unique=True)
+    plays = IntegerField(default=0, index=True)
+    seconds = IntegerField(default=0)
+
+
+class StationStats(BaseModel):
+    station = ForeignKeyField(Station, related_name='stats', unique=True)
+    plays = IntegerField(default=0, index=True)
+    seconds = IntegerField(default=0)
+
+
+class StationSongStats(BaseModel):
+    station = ForeignKeyField(Station, related_name='song_stats')
+    song = ForeignKeyField(Song, related_name='station_stats')
+    plays = IntegerField(default=0)
+    seconds = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('station', 'song'), True),
+            (('station', 'plays'), False),
+        )
+
+
+class DailyStats(BaseModel):
+    day = DateField(unique=True)
+    plays = IntegerField(default=0)
+    seconds = IntegerField(default=0)
+
+
+class IngestKey(BaseModel):
+    """
+    The dedup key of a recently written songfinish record, kept by
+    ``pianodb.dedup`` until it ``expires``.
+    """
+    digest = CharField(max_length=32, unique=True)
+    expires = DateTimeField(index=True)
+
+
+class ImportCheckpoint(BaseModel):
+    """
+    How many records of a file ``pianodb import`` has committed, so that an
+    interrupted import resumes where it stopped.
+    """
+    source = CharField(unique=True)
+    records = IntegerField(default=0)
+    updated = DateTimeField(default=datetime.datetime.now)
+
+
+class SchemaVersion(BaseModel):
+    """
+    The migrations from ``pianodb.migrations`` applied to the database.
+    """
+    version = IntegerField(primary_key=True)
+    applied = DateTimeField(default=datetime.datetime.now)
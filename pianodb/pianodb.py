@@ -1,48 +1,78 @@
 import sys
 import os.path
 import tempfile
+import threading
 import multiprocessing
-from datetime import timedelta
+from datetime import datetime, timedelta
+from functools import reduce
+from contextlib import contextmanager
+from operator import and_
+from itertools import islice
 from collections import ChainMap
 
-import requests
-import ruamel.yaml
-from lxml import html
-from click import Command
-from gunicorn.app.base import BaseApplication
-from gunicorn.six import iteritems
+from peewee import (SqliteDatabase, MySQLDatabase, DatabaseError,
+                    InterfaceError)
+from playhouse.db_url import connect
 
 import pianodb.model as model
-
-
-class PianoDBApplication(BaseApplication):
-    """http://docs.gunicorn.org/en/latest/custom.html"""
-    def __init__(self, app, options=None):
-        self.options = options or {}
-        self.application = app
-        super().__init__()
-
-    def load_config(self):
-        config = dict([(key, value) for key, value in iteritems(self.options)
-                       if key in self.cfg.settings and value is not None])
-        for key, value in iteritems(config):
-            self.cfg.set(key.lower(), value)
-
-    def load(self):
-        return self.application
+from pianodb.cache import identity_map
+from pianodb.events import gen_dummy_cmd  # noqa: F401
+
+# Keep multi-row INSERTs and IN clauses comfortably below SQLite's default
+# limit of 999 bound parameters per statement.
+CHUNK_SIZE = 100
+
+# The natural keys of the models whose primary keys are kept in identity_map.
+NATURAL_KEYS = {
+    model.Artist: (model.Artist.name,),
+    model.Album: (model.Album.artist, model.Album.title),
+    model.Station: (model.Station.name,),
+    model.Feature: (model.Feature.text,),
+}
+
+
+# Pragmas of the write-optimized SQLite mode, overridden by the ``pragmas`` of
+# the ``sqlite`` configuration block.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',  # With WAL, only a power loss can undo a commit.
+    'cache_size': -16000,  # KiB
+    'mmap_size': 64 * 1024 * 1024,
+}
+
+
+# Schemes of the client-server databases whose connections can be pooled.
+POOLED_SCHEMES = ('mysql', 'postgres', 'postgresql', 'postgresext',
+                  'postgresqlext')
+
+# Every table of the current schema, in an order that respects foreign keys.
+TABLES = (
+    model.Artist,
+    model.Album,
+    model.Song,
+    model.Feature,
+    model.SongFeature,
+    model.Station,
+    model.StationArtist,
+    model.StationSong,
+    model.Play,
+    model.ScrapeJob,
+    model.FeatureCacheEntry,
+    model.SongStats,
+    model.ArtistStats,
+    model.StationStats,
+    model.StationSongStats,
+    model.DailyStats,
+    model.IngestKey,
+    model.ImportCheckpoint,
+    model.SchemaVersion,
+)
 
 
 def number_of_workers():
     return (multiprocessing.cpu_count() * 2) + 1
 
 
-def gen_dummy_cmd(name):
-    return Command(name,
-                   help=("This is an unimplimented pianobar eventcmd handler. "
-                         "Calling this subcommand will do absolutely nothing."),
-                   short_help='unimplimented pianobar eventcmd')
-
-
 def get_config(path=None):
     home = os.environ['HOME']
     pianobar_path = os.path.join(home, '.config', 'pianobar')
@@ -50,6 +80,8 @@ def get_config(path=None):
 
     path = path if path else pianodb_config_path
 
+    import ruamel.yaml
+
     try:
         with open(path, 'r') as config_path:
             config = ruamel.yaml.safe_load(config_path)
@@ -74,96 +106,465 @@ def get_config(path=None):
     return ChainMap(config, defaults) if config else defaults
 
 
-def get_track_features(detail_url):
+def parse_track_features(content):
+    from lxml import html
+
     xpath = ('//div[@class="song_features clearfix"]/text()|'
              '//div[@style="display: none;"]/text()')
+    tree = html.fromstring(content)
+    return [e.strip() for e in tree.xpath(xpath) if e.strip() != '']
+
+
+def get_track_features(detail_url):
+    import requests
+
     try:
         page = requests.get(detail_url)
         if page.status_code == 200:
-            tree = html.fromstring(page.content)
-            return [e.strip() for e in tree.xpath(xpath) if e.strip() != '']
+            return parse_track_features(page.content)
         else:
             return []
     except requests.ConnectionError:
         return []
 
 
-def create_database(database):
-    tables = (
-        model.Artist,
-        model.Album,
-        model.Song,
-        model.Feature,
-        model.SongFeature,
-        model.Station,
-        model.StationArtist,
-        model.StationSong,
-        model.Play
-    )
+def connect_database(url, sqlite=None, pool=None):
+    """
+    Connect to the database at ``url``. SQLite databases are tuned with the
+    ``sqlite`` configuration block and MySQL and PostgreSQL connections are
+    pooled according to the ``pool`` block, when there are ones.
+    """
+    scheme = url.split('://', 1)[0]
+
+    if pool is not None and scheme in POOLED_SCHEMES:
+        return connect(url.replace(scheme, scheme + '+pool', 1),
+                       max_connections=pool.get('max_connections', 20),
+                       stale_timeout=pool.get('stale_timeout', 300))
+
+    if sqlite is None or not url.startswith('sqlite'):
+        return connect(url)
+
+    pragmas = dict(SQLITE_PRAGMAS, **sqlite.get('pragmas', {}))
+    return connect(url, pragmas=list(pragmas.items()),
+                   timeout=sqlite.get('busy_timeout', 30))
+
 
+def create_database(database):
     model.db.initialize(database)
     model.db.connect()
-    model.db.create_tables(tables, safe=True)
 
+    # Existing tables are left alone, so only a brand new database can be
+    # assumed to have the current schema. Others are upgraded by migrations.
+    fresh = not model.Artist.table_exists()
+    model.db.create_tables(TABLES, safe=True)
+    if fresh:
+        from pianodb.migrations import stamp
+        from pianodb.search import create_search_index
+        create_search_index()
+        stamp()
+
+
+def chunked(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def select_ids(model_class, fields, keys):
+    """
+    Map each key tuple in ``keys`` to the primary key of the ``model_class``
+    row whose ``fields`` match it. Keys without a matching row are omitted.
+    """
+    ids = {}
+    for chunk in chunked(keys):
+        clauses = [field << list({key[i] for key in chunk})
+                   for i, field in enumerate(fields)]
+        query = (model_class
+                 .select(model_class._meta.primary_key, *fields)
+                 .where(reduce(and_, clauses))
+                 .tuples())
+        wanted = set(chunk)
+        for pk, *key in query:
+            if tuple(key) in wanted:
+                ids[tuple(key)] = pk
+    return ids
+
+
+def select_each(model_class, fields, keys):
+    """
+    ``select_ids`` one key at a time, leaving the comparison to the database.
+    Under MySQL's case-insensitive collations, for instance, a key may match
+    a row that spells it differently, so reading rows back and comparing
+    them to the keys in Python would miss it.
+    """
+    primary_key = model_class._meta.primary_key
+    ids = {}
+    for key in keys:
+        pk = (model_class
+              .select(primary_key)
+              .where(reduce(and_, (field == value
+                                   for field, value in zip(fields, key))))
+              .order_by(primary_key)
+              .limit(1)
+              .scalar())
+        if pk is not None:
+            ids[key] = pk
+    return ids
+
+
+def is_unique(model_class, fields):
+    """
+    Determine whether ``fields`` are covered by a unique constraint on
+    ``model_class``.
+    """
+    names = tuple(f.name for f in fields)
+    if len(fields) == 1 and fields[0].unique:
+        return True
+    return any(unique and tuple(columns) == names
+               for columns, unique in model_class._meta.indexes)
+
+
+def insert_rows(model_class, rows, ignore=False):
+    """
+    Insert ``rows``, dicts with the same keys, into ``model_class`` with
+    multi-row INSERTs. With ``ignore``, rows that would violate a unique
+    constraint are silently skipped: ``INSERT OR IGNORE`` on SQLite, ``INSERT
+    IGNORE`` on MySQL and ``ON CONFLICT DO NOTHING`` on PostgreSQL.
+
+    The statements are assembled directly rather than with peewee's query
+    builder, which costs several times more than running them.
+    """
+    database = model.db.obj
+    compiler = database.compiler()
+    meta = model_class._meta
+
+    if not ignore:
+        statement, suffix = 'INSERT INTO', ''
+    elif isinstance(database, SqliteDatabase):
+        statement, suffix = 'INSERT OR IGNORE INTO', ''
+    elif isinstance(database, MySQLDatabase):
+        statement, suffix = 'INSERT IGNORE INTO', ''
+    else:
+        statement, suffix = 'INSERT INTO', ' ON CONFLICT DO NOTHING'
+
+    for chunk in chunked(rows):
+        # Columns left out of the rows get their defaults, as with peewee.
+        defaults = meta.get_default_dict()
+        names = set(chunk[0]) | set(defaults)
+        fields = sorted((meta.fields[name] for name in names),
+                        key=lambda field: field._sort_key)
+
+        values = '({})'.format(', '.join(compiler.interpolation
+                                         for _ in fields))
+        sql = '{} {} ({}) VALUES {}{}'.format(
+            statement, compiler.quote(meta.db_table),
+            ', '.join(compiler.quote(field.db_column) for field in fields),
+            ', '.join(values for _ in chunk), suffix)
+        params = [field.db_value(row[field.name] if field.name in row
+                                 else defaults[field.name])
+                  for row in chunk for field in fields]
+        database.execute_sql(sql, params)
+
+
+def update_many(field, values):
+    """
+    Set ``field`` of the row with each primary key to a value, for the
+    ``(primary key, value)`` pairs in ``values``, with one ``UPDATE`` per
+    chunk. The values are picked by a ``CASE`` on the primary key, so the
+    statements go through ``execute_sql`` like every other and are seen by
+    the metrics and the profiler.
+    """
+    compiler = model.db.compiler()
+    meta = field.model_class._meta
+    param = compiler.interpolation
+    pk_column = compiler.quote(meta.primary_key.db_column)
+    for chunk in chunked(values):
+        sql = 'UPDATE {} SET {} = CASE {} {} END WHERE {} IN ({})'.format(
+            compiler.quote(meta.db_table), compiler.quote(field.db_column),
+            pk_column, ' '.join('WHEN {0} THEN {0}'.format(param)
+                                for _ in chunk),
+            pk_column, ', '.join(param for _ in chunk))
+        params = [p for pk, value in chunk for p in (pk, field.db_value(value))]
+        params.extend(pk for pk, _ in chunk)
+        model.db.execute_sql(sql, params)
+
+
+def insert_or_ignore(model_class, rows):
+    """
+    Insert ``rows`` into ``model_class``, silently skipping any row that would
+    violate a unique constraint.
+    """
+    insert_rows(model_class, rows, ignore=True)
+
+
+def get_or_create_many(model_class, fields, keys, defaults=None):
+    """
+    Set-wise ``get_or_create``. Map each key tuple in ``keys`` to the primary
+    key of the ``model_class`` row whose ``fields`` match it, inserting the
+    rows that are missing. ``defaults`` optionally maps a key to extra column
+    values used only when that key has to be created.
+
+    When ``fields`` are unique the rows are upserted blindly and read back, so
+    the cost is two statements no matter how many of the keys already exist.
+    """
+    keys = set(keys)
+    defaults = defaults or {}
+
+    def rows(keys):
+        for key in keys:
+            row = dict(zip((f.name for f in fields), key))
+            row.update(defaults.get(key, {}))
+            yield row
+
+    if is_unique(model_class, fields):
+        insert_or_ignore(model_class, rows(keys))
+        ids = select_ids(model_class, fields, keys)
+    else:
+        ids = select_ids(model_class, fields, keys)
+        missing = keys - ids.keys()
+        insert_rows(model_class, rows(missing))
+        ids.update(select_ids(model_class, fields, missing))
+
+    # Every key has a row by now. Those not read back exactly were matched by
+    # the database's collation to rows spelled differently.
+    ids.update(select_each(model_class, fields, keys - ids.keys()))
+    return ids
+
+
+def resolve_ids(model_class, keys, defaults=None):
+    """
+    ``get_or_create_many`` on the ``NATURAL_KEYS`` of ``model_class`` that
+    consults ``identity_map`` first. Only keys that aren't cached in this
+    process reach the database. The ids it resolves are cached once the
+    transaction creating their rows commits.
+    """
+    keys = set(keys)
+    ids = identity_map.get_many(model_class, keys)
+    missing = keys - ids.keys()
+    if missing:
+        resolved = get_or_create_many(model_class, NATURAL_KEYS[model_class],
+                                      missing, defaults)
+        after_commit(lambda: identity_map.set_many(model_class, resolved))
+        ids.update(resolved)
+    return ids
+
+
+def warm_identity_map():
+    identity_map.warm(NATURAL_KEYS)
+
+
+def ensure_connection(ping=False):
+    """
+    Open this thread's connection unless it is open already. With ``ping``
+    the connection is checked with a trivial query first and replaced if the
+    server has dropped it, as servers do with idle connections.
+    """
+    if model.db.is_closed():
+        model.db.connect()
+
+    if ping:
+        try:
+            model.db.execute_sql('SELECT 1')
+        except (DatabaseError, InterfaceError):
+            if hasattr(model.db.obj, 'manual_close'):
+                model.db.manual_close()  # Keep it out of the pool.
+            else:
+                model.db.close()
+            model.db.connect()
+
+
+def disconnect():
+    """
+    Close this process' connections, including idle pooled ones, so that
+    processes forked from it open their own instead of sharing sockets.
+    """
+    if not model.db.is_closed():
+        model.db.close()
+    if hasattr(model.db.obj, 'close_all'):
+        model.db.close_all()
+
+
+# The callbacks registered with after_commit by this thread's transaction.
+_transaction = threading.local()
+
+
+@contextmanager
+def atomic():
+    """
+    ``model.db.atomic`` that runs the callbacks registered with
+    ``after_commit`` once the outermost transaction commits. Those registered
+    inside a transaction or savepoint that rolls back are dropped.
+    """
+    callbacks = getattr(_transaction, 'callbacks', None)
+    outermost = callbacks is None
+    if outermost:
+        callbacks = _transaction.callbacks = []
+    mark = len(callbacks)
+    try:
+        with model.db.atomic():
+            yield
+    except BaseException:
+        del callbacks[mark:]
+        raise
+    finally:
+        if outermost:
+            _transaction.callbacks = None
+
+    if outermost:
+        for callback in callbacks:
+            callback()
+
+
+def after_commit(callback):
+    """
+    Call ``callback`` once the ``atomic`` block in progress on this thread
+    commits, or right away outside of one. Use it for anything other threads
+    may act on, since they must not see rows that could still roll back.
+    """
+    callbacks = getattr(_transaction, 'callbacks', None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+def add_many(through_model, lhs, rhs, pairs):
+    """
+    Set-wise ``ManyToManyField.add``. Every ``(lhs, rhs)`` id pair is inserted
+    into ``through_model`` and pairs that already exist are ignored by its
+    unique index, so no membership check is needed.
+    """
+    insert_or_ignore(through_model, ({lhs.name: left, rhs.name: right}
+                                     for left, right in set(pairs)))
+
+
+def add_track_features(song_id, features):
+    """
+    Attach the scraped ``features`` to the Song with primary key ``song_id``.
+    """
+    feature_ids = resolve_ids(model.Feature, ((f,) for f in features))
+    add_many(model.SongFeature,
+             model.SongFeature.song, model.SongFeature.feature,
+             ((song_id, pk) for pk in feature_ids.values()))
+
+    from pianodb.search import index_new_rows
+    index_new_rows(('feature',))
+
+
+def play_timestamp(songfinish):
+    """
+    Honor the optional UNIX ``timestamp`` of a songfinish record so that plays
+    delivered late are still recorded when they happened. Without one, a Play
+    happened when it is written.
+    """
+    if 'timestamp' in songfinish:
+        return datetime.fromtimestamp(int(songfinish['timestamp']))
+    return datetime.now()
 
-def update_db(songfinish):
-    # Search for the Artist, create it if necessary.
-    artist = model.Artist.get_or_create(name=songfinish['artist'])[0]
 
-    # Search for the Album, create it if necessary.
-    # Take into account that cover_art is always subject to change and we want
-    # to prefer whatever Pandora says is most recent.
-    try:
-        album = model.Album.get(model.Album.title == songfinish['album']
-                                and model.Album.artist == artist)
-        album.cover_art = songfinish['coverArt']
-        album.save()
-    except model.Album.DoesNotExist:
-        album = model.Album.create(
-            title=songfinish['album'],
-            artist=artist,
-            cover_art=songfinish['coverArt'])
-
-    detail_url = songfinish['detailUrl']
-
-    # Search for the Song, create it if necessary.
-    song = model.Song.get_or_create(
-        title=songfinish['title'],
-        album=album,
-        duration=str(timedelta(seconds=int(songfinish['songDuration']))),
-        detail_url=detail_url)[0]
-
-    # Search for the Features, create them if necessary.
-    features = [model.Feature.get_or_create(text=f)[0]
-                for f in get_track_features(detail_url)]
-
-    # Add the Features to Song.features if necessary.
-    for feature in features:
-        if feature not in song.features:
-            song.features.add(feature)
-
-    # Search for the Station, create it if necessary.
-    # TODO: Investigate whether Station is correct at time of songfinish.
-    #       Something appears to be wrong when switching stations. It causes
-    #       crap like this to end up in the DB.
-    #
-    #       sqlite> select * from song;
-    #       ...
-    #       8||8|0:02:26
-    #       ...
-    #       42||8|0:03:05
-    station = model.Station.get_or_create(name=songfinish['stationName'])[0]
-
-    # Add the Artist to Station.artists if necessary.
-    if artist not in station.artists:
-        station.artists.add(artist)
-
-    # Add the Song to Station.songs if necessary.
-    if song not in station.songs:
-        station.songs.add(song)
-
-    # Create a new Play with an implicit timestamp of datetime.now()
-    model.Play.create(
-        station=station,
-        song=song,
-        duration=str(timedelta(seconds=int(songfinish['songPlayed']))))
+def update_db(songfinish):
+    """
+    Write a single songfinish record. This is the bulk write path applied to
+    a batch of one, so each play costs a constant number of statements.
+    """
+    bulk_update_db([songfinish])
+
+
+def bulk_update_db(songfinishes, dedup=None):
+    """
+    Write many songfinish records at once. Artists, Albums, Songs, Features and
+    Stations are resolved set-wise rather than per record and everything,
+    including the Plays and their ``pianodb.stats`` rollups, is written inside
+    a single transaction. With a ``pianodb.dedup.DedupIndex`` records already
+    written are skipped.
+    """
+    songfinishes = list(songfinishes)
+    if not songfinishes:
+        return
+
+    keys = []
+    with atomic():
+        if dedup is not None:
+            songfinishes, keys = dedup.claim(songfinishes)
+            if not songfinishes:
+                return
+        artists = resolve_ids(model.Artist,
+                              ((s['artist'],) for s in songfinishes))
+
+        # Later records win when the same Album shows up with different cover
+        # art since Pandora's most recent cover art is preferred.
+        album_keys = [(artists[(s['artist'],)], s['album'])
+                      for s in songfinishes]
+        cover_art = {key: s['coverArt']
+                     for key, s in zip(album_keys, songfinishes)}
+        albums = resolve_ids(model.Album, album_keys,
+                             defaults={key: {'cover_art': art}
+                                       for key, art in cover_art.items()})
+        update_many(model.Album.cover_art,
+                    ((albums[key], art) for key, art in cover_art.items()))
+
+        song_keys = [(albums[album_key], s['title'])
+                     for album_key, s in zip(album_keys, songfinishes)]
+        songs = get_or_create_many(
+            model.Song, (model.Song.album, model.Song.title), song_keys,
+            defaults={key: {
+                'duration': str(timedelta(seconds=int(s['songDuration']))),
+                'detail_url': s['detailUrl'],
+            } for key, s in zip(song_keys, songfinishes)})
+
+        # Features are scraped in the background by pianodb.scraper. Songs
+        # that already have a job are ignored, so each Song is only ever
+        # queued once. Imported songs may have no detail page to scrape.
+        detail_urls = {songs[key]: s['detailUrl']
+                       for key, s in zip(song_keys, songfinishes)
+                       if s['detailUrl']}
+        insert_or_ignore(model.ScrapeJob, (
+            {'song': song, 'detail_url': url}
+            for song, url in detail_urls.items()))
+
+        # TODO: Investigate whether Station is correct at time of songfinish.
+        #       Something appears to be wrong when switching stations. It causes
+        #       crap like this to end up in the DB.
+        #
+        #       sqlite> select * from song;
+        #       ...
+        #       8||8|0:02:26
+        #       ...
+        #       42||8|0:03:05
+        stations = resolve_ids(model.Station,
+                               ((s['stationName'],) for s in songfinishes))
+        station_ids = [stations[(s['stationName'],)] for s in songfinishes]
+        add_many(model.StationArtist,
+                 model.StationArtist.station, model.StationArtist.artist,
+                 ((station, artists[(s['artist'],)])
+                  for station, s in zip(station_ids, songfinishes)))
+        add_many(model.StationSong,
+                 model.StationSong.station, model.StationSong.song,
+                 ((station, songs[key])
+                  for station, key in zip(station_ids, song_keys)))
+
+        plays = [{
+            'timestamp': play_timestamp(s),
+            'station': station,
+            'song': songs[key],
+            'duration': str(timedelta(seconds=int(s['songPlayed']))),
+        } for station, key, s in zip(station_ids, song_keys, songfinishes)]
+        insert_rows(model.Play, plays)
+
+        # pianodb.stats and pianodb.search build on this module, hence the
+        # deferred imports.
+        from pianodb.search import index_new_rows
+        from pianodb.stats import Deltas, apply_deltas
+
+        index_new_rows(('artist', 'album', 'song'))
+
+        deltas = Deltas()
+        for play, s in zip(plays, songfinishes):
+            deltas.add(play['timestamp'], artists[(s['artist'],)],
+                       play['station'], play['song'], int(s['songPlayed']))
+        apply_deltas(deltas)
+
+        if dedup is not None:
+            after_commit(lambda: dedup.remember(keys))
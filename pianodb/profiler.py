@@ -0,0 +1,165 @@
+"""
+Opt-in profiling of the SQL run by each request, enabled by ``--debug``.
+
+Every statement a request's thread sends through the database is recorded
+with its duration and the rows it returned or changed. Statements that run
+many times in one request with the same shape, such as a lookup per Feature
+of a Song, are reported as repeated: the signature of an N+1 query pattern.
+Requests slower than a threshold or with repeated statements are written to
+the ``pianodb.profiler`` log as one JSON object per line.
+"""
+
+import re
+import json
+import time
+import logging
+import threading
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+# Lists of placeholders, as in IN clauses and multi-row VALUES, vary in
+# length with the data but not with the shape of the statement.
+PLACEHOLDERS = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)')
+ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+
+
+def statement_shape(sql):
+    return ROWS.sub('(...)', PLACEHOLDERS.sub('(...)', sql))
+
+
+class CountingCursor:
+    """
+    A cursor that counts the rows fetched through it.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.fetched = 0
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self.fetched += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self.fetched += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.fetched += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self.fetched += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class QueryProfiler:
+    """
+    Record the statements of the requests between ``start`` and ``stop`` on
+    each thread. Requests taking at least ``slow`` seconds, or running a
+    statement of the same shape at least ``repeated`` times, are logged.
+    """
+
+    def __init__(self, slow=0.5, repeated=5):
+        self.slow = slow
+        self.repeated = repeated
+        self._thread = threading.local()
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        if config.get('log'):
+            handler = logging.FileHandler(config['log'])
+        else:
+            handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        return cls(slow=config.get('slow_request', 0.5),
+                   repeated=config.get('repeated', 5))
+
+    def instrument(self, database):
+        """
+        Record the statements ``database`` runs on threads being profiled.
+        """
+        if getattr(database, 'profiled', False):
+            return
+
+        execute_sql = database.execute_sql
+        local = self._thread
+
+        def profiled_execute_sql(sql, params=None, *args, **kwargs):
+            statements = getattr(local, 'statements', None)
+            if statements is None:
+                return execute_sql(sql, params, *args, **kwargs)
+
+            start = time.perf_counter()
+            cursor = CountingCursor(execute_sql(sql, params, *args, **kwargs))
+            statements.append((sql, time.perf_counter() - start, cursor,
+                               cursor.description is not None))
+            return cursor
+
+        database.execute_sql = profiled_execute_sql
+        database.profiled = True
+
+    def start(self):
+        self._thread.statements = []
+        self._thread.started = time.perf_counter()
+
+    def collect(self):
+        """
+        Stop recording this thread's statements and return them without
+        reporting them.
+        """
+        statements = getattr(self._thread, 'statements', None)
+        self._thread.statements = None
+        return statements or []
+
+    def record(self, statements):
+        """
+        Add ``statements`` another thread ran on behalf of this one to the
+        request being profiled, if there is one.
+        """
+        current = getattr(self._thread, 'statements', None)
+        if current is not None:
+            current.extend(statements)
+
+    def stop(self, name):
+        """
+        Stop recording this thread's statements and return the profile of the
+        request called ``name``, logging it if it was slow or repetitive.
+        """
+        statements = getattr(self._thread, 'statements', None)
+        if statements is None:
+            return None  # Never started.
+        elapsed = time.perf_counter() - self._thread.started
+        self._thread.statements = None
+
+        shapes = Counter(statement_shape(sql) for sql, *_ in statements)
+        profile = {
+            'request': name,
+            'seconds': round(elapsed, 6),
+            'queries': len(statements),
+            'query_seconds': round(sum(s[1] for s in statements), 6),
+            'repeated': [{'sql': shape, 'count': count}
+                         for shape, count in shapes.most_common()
+                         if count >= self.repeated],
+            'statements': [{
+                'sql': sql,
+                'seconds': round(seconds, 6),
+                'rows': cursor.fetched if returns_rows else cursor.rowcount,
+            } for sql, seconds, cursor, returns_rows in statements],
+        }
+
+        if elapsed >= self.slow or profile['repeated']:
+            log.warning(json.dumps(profile))
+        return profile
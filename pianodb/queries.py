@@ -0,0 +1,234 @@
+"""
+Read queries over the play history.
+
+Listings are paginated with keyset cursors instead of OFFSET: each page
+resumes strictly after the last row of the previous one using an indexed
+comparison, so fetching page 10,000 costs the same as fetching page one.
+Cursors are opaque, URL-safe strings.
+"""
+
+import json
+import base64
+import binascii
+from datetime import datetime
+
+import pianodb.model as model
+from pianodb.pianodb import chunked
+from pianodb.stats import seconds
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+class InvalidQuery(ValueError):
+    """A malformed cursor or filter."""
+
+
+def encode_cursor(*values):
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        return json.loads(data.decode('utf-8'))
+    except (ValueError, binascii.Error, UnicodeError):
+        raise InvalidQuery('Invalid cursor')
+
+
+def parse_datetime(value):
+    for datetime_format in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    raise InvalidQuery("Invalid datetime '{}'".format(value))
+
+
+def page(query, limit, key):
+    """
+    Fetch one page of at most ``limit`` rows from ``query``, which must be
+    ordered by the values ``key`` extracts from a row. Returns the rows and
+    the cursor for the next page, or ``None`` on the last page.
+    """
+    rows = list(query.limit(limit + 1))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*key(rows[-1]))
+
+
+def plays(station=None, since=None, until=None, cursor=None, limit=100):
+    """
+    Plays in chronological order, optionally only those on the Station named
+    ``station`` and played within ``[since, until)``.
+    """
+    query = (model.Play
+             .select(model.Play.id, model.Play.timestamp,
+                     model.Station.name, model.Song.id, model.Song.title,
+                     model.Album.title, model.Artist.name,
+                     model.Play.duration, model.Song.duration)
+             .join(model.Station)
+             .switch(model.Play)
+             .join(model.Song)
+             .join(model.Album)
+             .join(model.Artist)
+             .order_by(model.Play.timestamp, model.Play.id)
+             .tuples())
+
+    if station:
+        query = query.where(model.Station.name == station)
+    if since:
+        query = query.where(model.Play.timestamp >= since)
+    if until:
+        query = query.where(model.Play.timestamp < until)
+    if cursor:
+        try:
+            timestamp, play_id = decode_cursor(cursor)
+            timestamp = parse_datetime(timestamp)
+        except (TypeError, ValueError):
+            raise InvalidQuery('Invalid cursor')
+        query = query.where(
+            (model.Play.timestamp > timestamp) |
+            ((model.Play.timestamp == timestamp) & (model.Play.id > play_id)))
+
+    rows, next_cursor = page(query, limit,
+                             lambda row: (row[1].isoformat(), row[0]))
+    return [{
+        'id': play_id,
+        'timestamp': timestamp.isoformat(),
+        'station': station,
+        'song': song_id,
+        'title': title,
+        'album': album,
+        'artist': artist,
+        'duration': seconds(duration),
+        'song_duration': seconds(song_duration),
+    } for (play_id, timestamp, station, song_id, title, album, artist,
+           duration, song_duration) in rows], next_cursor
+
+
+def after_id(query, field, cursor):
+    if not cursor:
+        return query
+    try:
+        last_id, = decode_cursor(cursor)
+        return query.where(field > int(last_id))
+    except (TypeError, ValueError):
+        raise InvalidQuery('Invalid cursor')
+
+
+def artists(cursor=None, limit=100):
+    query = (model.Artist
+             .select(model.Artist.id, model.Artist.name)
+             .order_by(model.Artist.id)
+             .tuples())
+    rows, next_cursor = page(after_id(query, model.Artist.id, cursor), limit,
+                             lambda row: (row[0],))
+    return [{'id': pk, 'name': name} for pk, name in rows], next_cursor
+
+
+def station_songs(station_id, cursor=None, limit=100):
+    query = (model.StationSong
+             .select(model.Song.id, model.Song.title, model.Album.title,
+                     model.Artist.name, model.Song.duration)
+             .join(model.Song)
+             .join(model.Album)
+             .join(model.Artist)
+             .where(model.StationSong.station == station_id)
+             .order_by(model.Song.id)
+             .tuples())
+    rows, next_cursor = page(after_id(query, model.Song.id, cursor), limit,
+                             lambda row: (row[0],))
+    return [{
+        'id': pk,
+        'title': title,
+        'album': album,
+        'artist': artist,
+        'duration': seconds(duration),
+    } for pk, title, album, artist, duration in rows], next_cursor
+
+
+def song_features(song_id):
+    query = (model.Feature
+             .select(model.Feature.text)
+             .join(model.SongFeature)
+             .where(model.SongFeature.song == song_id)
+             .order_by(model.Feature.text)
+             .tuples())
+    return [text for text, in query]
+
+
+def station_song_ids(station_id):
+    query = (model.StationSong
+             .select(model.StationSong.song)
+             .where(model.StationSong.station == station_id)
+             .tuples())
+    return [song for song, in query]
+
+
+def scored_songs(scores):
+    """
+    Describe the Songs of ``scores``, (song id, score) pairs, in order.
+    """
+    songs = {}
+    for ids in chunked([pk for pk, _ in scores]):
+        query = (model.Song
+                 .select(model.Song.id, model.Song.title, model.Album.title,
+                         model.Artist.name)
+                 .join(model.Album)
+                 .join(model.Artist)
+                 .where(model.Song.id << ids)
+                 .tuples())
+        for pk, title, album, artist in query:
+            songs[pk] = {'id': pk, 'title': title, 'album': album,
+                         'artist': artist}
+    return [dict(songs[pk], score=score) for pk, score in scores
+            if pk in songs]
+
+
+def scored_artists(scores):
+    """
+    Describe the Artists of ``scores``, (artist id, score) pairs, in order.
+    """
+    names = {}
+    for ids in chunked([pk for pk, _ in scores]):
+        query = (model.Artist
+                 .select(model.Artist.id, model.Artist.name)
+                 .where(model.Artist.id << ids)
+                 .tuples())
+        names.update(query)
+    return [{'id': pk, 'name': names[pk], 'score': score}
+            for pk, score in scores if pk in names]
+
+
+def scored_albums(scores):
+    """
+    Describe the Albums of ``scores``, (album id, score) pairs, in order.
+    """
+    albums = {}
+    for ids in chunked([pk for pk, _ in scores]):
+        query = (model.Album
+                 .select(model.Album.id, model.Album.title, model.Artist.name)
+                 .join(model.Artist)
+                 .where(model.Album.id << ids)
+                 .tuples())
+        for pk, title, artist in query:
+            albums[pk] = {'id': pk, 'title': title, 'artist': artist}
+    return [dict(albums[pk], score=score) for pk, score in scores
+            if pk in albums]
+
+
+def scored_features(scores):
+    """
+    Describe the Features of ``scores``, (feature id, score) pairs, in order.
+    """
+    texts = {}
+    for ids in chunked([pk for pk, _ in scores]):
+        query = (model.Feature
+                 .select(model.Feature.id, model.Feature.text)
+                 .where(model.Feature.id << ids)
+                 .tuples())
+        texts.update(query)
+    return [{'id': pk, 'text': texts[pk], 'score': score}
+            for pk, score in scores if pk in texts]
@@ -1,57 +1,601 @@
+import gzip
+import json
+import time
+from datetime import datetime
+
 import falcon
 import msgpack
+from peewee import IntegrityError
 
-from pianodb.pianodb import update_db
+import pianodb.model as model
+import pianodb.queries as queries
+import pianodb.wire as wire
+from pianodb import metrics
+from pianodb.admission import write_latency
+from pianodb.exporter import ENCODERS, export_plays
+from pianodb.pianodb import bulk_update_db, ensure_connection
+from pianodb.search import KINDS, InvalidSearch, search
 
+SONG_FINISH_FIELDS = (
+    'artist',
+    'title',
+    'album',
+    'coverArt',
+    'stationName',
+    'songDuration',
+    'songPlayed',
+    'rating',
+    'detailUrl'
+)
+TEXT_FIELDS = ('artist', 'title', 'album', 'coverArt', 'stationName',
+               'detailUrl')
+DURATION_FIELDS = ('songDuration', 'songPlayed')
+
+# Durations are stored as times of day, so they must be shorter than one.
+MAX_DURATION = 24 * 60 * 60
+
+# Media types read routes can respond with. When the client accepts both
+# equally, or sends no Accept header, client_prefers picks the last, so
+# responses are JSON unless msgpack is asked for.
+MEDIA_TYPES = ('application/msgpack', 'application/json')
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+EXPORT_MEDIA_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def read_body(req):
+    """
+    Read the request body, decompressing it if the client gzipped it.
+    """
+    data = req.stream.read()
+
+    if req.get_header('Content-Encoding') == 'gzip':
+        try:
+            data = gzip.decompress(data)
+        except (OSError, EOFError):
+            msg = 'Could not decompress gzip data'
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+    return data
+
+
+def unpack_songfinishes(data):
+    """
+    Unpack a compact payload, a single msgpack array of songfinish records or
+    a stream of concatenated msgpack songfinish records.
+    """
+    with metrics.STAGE_DURATION.time(stage='unpack'):
+        try:
+            records = msgpack.unpackb(data, encoding='utf-8')
+        except msgpack.exceptions.ExtraData:
+            unpacker = msgpack.Unpacker(encoding='utf-8')
+            unpacker.feed(data)
+            return list(unpacker)
+
+        if wire.is_compact(records):
+            return wire.decode(records)
+
+    return records if isinstance(records, list) else [records]
+
+
+def unpack_songfinish(data):
+    """
+    Unpack a single songfinish record, a msgpack map or a compact payload of
+    one record.
+    """
+    with metrics.STAGE_DURATION.time(stage='unpack'):
+        songfinish = msgpack.unpackb(data, encoding='utf-8')
+        if not wire.is_compact(songfinish):
+            return songfinish
+
+        records = wire.decode(songfinish)
+        if len(records) != 1:
+            raise wire.InvalidPayload('Expected a single songfinish record')
+        return records[0]
+
+
+def parses(convert, value):
+    try:
+        convert(value)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return False
+    return True
+
+
+def duration(value):
+    """
+    The seconds of a duration field, which must be less than a day.
+    """
+    seconds = int(value)
+    if not 0 <= seconds < MAX_DURATION:
+        raise ValueError("Duration out of range: {}".format(seconds))
+    return seconds
+
+
+def validate_songfinish(songfinish, fields=SONG_FINISH_FIELDS):
+    """
+    Return why ``songfinish`` can't be stored, or ``None`` if it can.
+    """
+    if not isinstance(songfinish, dict):
+        return 'Invalid datatype'
+    if not all(k in songfinish for k in fields):
+        return 'Missing required songfinish field'
+
+    for field in TEXT_FIELDS:
+        if field in fields and not isinstance(songfinish[field], str):
+            return "Invalid songfinish field '{}'".format(field)
+    for field in DURATION_FIELDS:
+        if field in fields and not parses(duration, songfinish[field]):
+            return "Invalid songfinish field '{}'".format(field)
+    if 'timestamp' in songfinish and not parses(
+            lambda t: datetime.fromtimestamp(int(t)), songfinish['timestamp']):
+        return "Invalid songfinish field 'timestamp'"
+
+
+def write(writer, songfinishes, dedup=None):
+    if writer is not None:
+        writer.submit(songfinishes)
+    elif dedup is not None:
+        bulk_update_db(songfinishes, dedup)
+    else:
+        bulk_update_db(songfinishes)
+
+
+def store(writer, songfinishes, dedup=None):
+    """
+    Write ``songfinishes`` through ``writer``, a ``WriteQueue``, if the server
+    has one and directly otherwise, skipping those ``dedup`` has seen. The
+    writer must have been given the same ``dedup``.
+    """
+    started = time.perf_counter()
+    try:
+        with metrics.STAGE_DURATION.time(stage='write'):
+            try:
+                write(writer, songfinishes, dedup)
+            except IntegrityError:
+                if dedup is None:
+                    raise
+                # A replay written concurrently claimed a key first. Writing
+                # again skips it.
+                write(writer, songfinishes, dedup)
+    finally:
+        write_latency.observe(time.perf_counter() - started)
+
+
+def find_duplicates(dedup, songfinishes):
+    """
+    Whether each of ``songfinishes``, which must be valid, was written before.
+    """
+    if dedup is None:
+        return [False] * len(songfinishes)
+    duplicates = dedup.duplicates(songfinishes)
+    metrics.DUPLICATES.inc(sum(duplicates))
+    return duplicates
+
+
+class MetricsComponent:
+    """
+    Time every request and count the database queries made on its thread.
+    It must be the first component so that the others are timed too.
+    """
+
+    def process_request(self, req, resp):
+        req.context['started'] = time.perf_counter()
+        metrics.count_queries()
+        metrics.REQUESTS_IN_FLIGHT.inc()
 
-class ValidatorComponent:
     def process_response(self, req, resp, resource):
-        # Verify authentication
-        if req.get_header('X-Auth-Token') != resource.token:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        route = type(resource).__name__ if resource is not None else 'none'
+        metrics.REQUEST_DURATION.observe(
+            time.perf_counter() - req.context['started'],
+            route=route, method=req.method, status=resp.status[:3])
+        metrics.REQUEST_QUERIES.observe(metrics.count_queries(), route=route)
+
+
+class ProfilerComponent:
+    """
+    Profile the SQL of every request with a ``pianodb.profiler.QueryProfiler``.
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def process_request(self, req, resp):
+        self.profiler.start()
+
+    def process_response(self, req, resp, resource):
+        self.profiler.stop("{} {}".format(req.method, req.path))
+
+
+class AdmissionComponent:
+    """
+    Turn requests away before any work is done on them when the worker is
+    overloaded or their client has exceeded its rate. See
+    ``pianodb.admission``. Requests for public resources are always served.
+    """
+
+    errors = {
+        429: falcon.HTTPTooManyRequests,
+        503: falcon.HTTPServiceUnavailable,
+    }
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def process_resource(self, req, resp, resource, params):
+        client = req.context.get('client')
+        if client is None:
+            return
+
+        rejection = self.controller.admit(client)
+        if rejection is not None:
+            raise self.errors[rejection.status](
+                title=rejection.title, description=rejection.description,
+                retry_after=rejection.retry_after)
+        req.context['admitted'] = True
+
+    def process_response(self, req, resp, resource):
+        if req.context.pop('admitted', False):
+            self.controller.release()
+
+
+class ConnectionComponent:
+    """
+    Give every request its own database connection, checked out of the pool
+    if there is one, and return it once the response is ready. Requests
+    turned away before their resource is reached never connect.
+    """
+
+    def __init__(self, ping=False):
+        self.ping = ping
+
+    def process_resource(self, req, resp, resource, params):
+        ensure_connection(self.ping)
+
+    def process_response(self, req, resp, resource):
+        if not model.db.is_closed():
+            model.db.close()
+
+
+class ValidatorComponent:
+    """
+    Authenticate requests with ``tokens``, a ``pianodb.auth.Tokens``, and
+    check that POSTed payloads are msgpack before they are routed, so that
+    rejected requests cost next to nothing. Requests for ``public`` paths
+    need no token. The client a request authenticated as is
+    ``req.context['client']``.
+    """
+
+    def __init__(self, tokens, public=()):
+        self.tokens = tokens
+        self.public = frozenset(public)
+
+    def process_request(self, req, resp):
+        if req.path in self.public:
+            return
+
+        client = self.tokens.authenticate(req.get_header('X-Auth-Token'))
+        if client is None:
             raise falcon.HTTPUnauthorized(
                 title='Authentication required',
                 description='Missing or invalid authentication token')
+        req.context['client'] = client
 
-        if not req.content_type == 'application/msgpack':
+        if req.method == 'POST' and req.content_type != 'application/msgpack':
             raise falcon.HTTPUnsupportedMediaType('Payload must be msgpack')
 
 
 class SongFinish:
 
-    def __init__(self, token):
-        self.token = token
-        self.song_finish_fields = (
-            'artist',
-            'title',
-            'album',
-            'coverArt',
-            'stationName',
-            'songDuration',
-            'songPlayed',
-            'rating',
-            'detailUrl'
-        )
+    def __init__(self, writer=None, dedup=None):
+        self.writer = writer
+        self.dedup = dedup
+        self.song_finish_fields = SONG_FINISH_FIELDS
 
     def on_post(self, req, resp):
 
         # TODO: What happens if we can't read from the stream?
+        data = read_body(req)
         try:
-            songfinish = msgpack.unpackb(req.stream.read(), encoding='utf-8')
+            songfinish = unpack_songfinish(data)
+        except wire.InvalidPayload as e:
+            raise falcon.HTTPBadRequest('Bad request', str(e))
         except msgpack.exceptions.UnpackValueError:
             msg = 'Could not unpack msgpack data'
             raise falcon.HTTPBadRequest('Bad request', msg)
 
-        # Attempt to validate the songfinish keys.
+        # Validate the songfinish before its dedup key is derived from it.
+        error = validate_songfinish(songfinish, self.song_finish_fields)
+        if error:
+            raise falcon.HTTPBadRequest('Bad request', error)
+
+        key = req.get_header('Idempotency-Key')
+        if key is not None:
+            songfinish['key'] = key
+
+        # A replay is acknowledged without writing anything.
+        if find_duplicates(self.dedup, [songfinish])[0]:
+            resp.data = msgpack.packb({'created': False, 'duplicate': True})
+            resp.content_type = 'application/msgpack'
+            resp.status = falcon.HTTP_200
+            return
+
+        store(self.writer, [songfinish], self.dedup)
+
+        resp.data = msgpack.packb({'created': True})
+        resp.content_type = 'application/msgpack'
+        resp.status = falcon.HTTP_201
+
+
+class SongFinishBatch:
+
+    def __init__(self, writer=None, dedup=None):
+        self.writer = writer
+        self.dedup = dedup
+        self.song_finish_fields = SONG_FINISH_FIELDS
+
+    def on_post(self, req, resp):
+
         try:
-            if not all(k in songfinish.keys() for k in self.song_finish_fields):
-                msg = 'Missing required songfinish field'
-                raise falcon.HTTPBadRequest('Bad request', msg)
-        except AttributeError:
-            msg = 'Invalid datatype'
+            records = unpack_songfinishes(read_body(req))
+        except wire.InvalidPayload as e:
+            raise falcon.HTTPBadRequest('Bad request', str(e))
+        except ValueError:  # Includes UnpackValueError and UnicodeDecodeError.
+            msg = 'Could not unpack msgpack data'
             raise falcon.HTTPBadRequest('Bad request', msg)
 
-        update_db(songfinish)
+        # Validate every record up front so that a bad record is reported
+        # rather than aborting the whole batch.
+        results, valid = [], []
+        for songfinish in records:
+            error = validate_songfinish(songfinish, self.song_finish_fields)
+            if error:
+                results.append({'created': False, 'error': error})
+            else:
+                results.append({'created': True})
+                valid.append((len(results) - 1, songfinish))
 
-        resp.data = msgpack.packb({'created': True})
+        songfinishes = []
+        duplicates = find_duplicates(self.dedup, [s for _, s in valid])
+        for (i, songfinish), duplicate in zip(valid, duplicates):
+            if duplicate:
+                results[i] = {'created': False, 'duplicate': True}
+            else:
+                songfinishes.append(songfinish)
+
+        store(self.writer, songfinishes, self.dedup)
+
+        resp.data = msgpack.packb({'results': results})
         resp.content_type = 'application/msgpack'
         resp.status = falcon.HTTP_201
+
+
+def get_limit(req):
+    limit = req.get_param_as_int('limit', min=1, max=MAX_LIMIT)
+    return DEFAULT_LIMIT if limit is None else limit
+
+
+def get_datetime(req, name):
+    value = req.get_param(name)
+    if value is None:
+        return None
+    try:
+        return queries.parse_datetime(value)
+    except queries.InvalidQuery as e:
+        raise falcon.HTTPBadRequest('Bad request', str(e))
+
+
+def pack_json(items, cursor):
+    yield b'{"items":['
+    for i, item in enumerate(items):
+        yield (b',' if i else b'') + json.dumps(item).encode('utf-8')
+    yield '],"next":{}}}'.format(json.dumps(cursor)).encode('utf-8')
+
+
+def pack_msgpack(items, cursor):
+    packer = msgpack.Packer(use_bin_type=True)
+    yield packer.pack_map_header(2)
+    yield packer.pack('items')
+    yield packer.pack_array_header(len(items))
+    for item in items:
+        yield packer.pack(item)
+    yield packer.pack('next')
+    yield packer.pack(cursor)
+
+
+def respond_page(req, resp, items, cursor=None):
+    """
+    Stream a page of ``items`` and the cursor of the next page as msgpack or
+    JSON, whichever the client prefers.
+    """
+    media_type = req.client_prefers(MEDIA_TYPES)
+    if media_type is None:
+        raise falcon.HTTPNotAcceptable('Response can be msgpack or JSON')
+
+    pack = pack_msgpack if media_type == 'application/msgpack' else pack_json
+    resp.stream = pack(items, cursor)
+    resp.content_type = media_type
+    resp.status = falcon.HTTP_200
+
+
+def query_page(query, **kwargs):
+    try:
+        return query(**kwargs)
+    except queries.InvalidQuery as e:
+        raise falcon.HTTPBadRequest('Bad request', str(e))
+
+
+class Plays:
+
+    def on_get(self, req, resp):
+        items, cursor = query_page(queries.plays,
+                                   station=req.get_param('station'),
+                                   since=get_datetime(req, 'since'),
+                                   until=get_datetime(req, 'until'),
+                                   cursor=req.get_param('cursor'),
+                                   limit=get_limit(req))
+        respond_page(req, resp, items, cursor)
+
+
+class Artists:
+
+    def on_get(self, req, resp):
+        items, cursor = query_page(queries.artists,
+                                   cursor=req.get_param('cursor'),
+                                   limit=get_limit(req))
+        respond_page(req, resp, items, cursor)
+
+
+class StationSongs:
+
+    def on_get(self, req, resp, station):
+        try:
+            station = model.Station.get(model.Station.name == station)
+        except model.Station.DoesNotExist:
+            raise falcon.HTTPNotFound()
+
+        items, cursor = query_page(queries.station_songs,
+                                   station_id=station.id,
+                                   cursor=req.get_param('cursor'),
+                                   limit=get_limit(req))
+        respond_page(req, resp, items, cursor)
+
+
+class SongFeatures:
+
+    def on_get(self, req, resp, song_id):
+        try:
+            song = model.Song.get(model.Song.id == int(song_id))
+        except (ValueError, model.Song.DoesNotExist):
+            raise falcon.HTTPNotFound()
+
+        respond_page(req, resp, queries.song_features(song.id))
+
+
+class Search:
+
+    def on_get(self, req, resp):
+        text = req.get_param('q', required=True)
+        kinds = req.get_param_as_list('type') or tuple(KINDS)
+        try:
+            results = search(text, kinds, get_limit(req))
+        except InvalidSearch as e:
+            raise falcon.HTTPBadRequest('Bad request', str(e))
+
+        respond_page(req, resp, results)
+
+
+def get_similarity_index(index):
+    """
+    The current similarity index of ``index``, a
+    ``pianodb.similarity.SharedIndex``.
+    """
+    current = index.get()
+    if current is None:
+        raise falcon.HTTPServiceUnavailable(
+            'Service unavailable', 'The similarity index has not been built',
+            60)
+    return current
+
+
+def get_id(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise falcon.HTTPNotFound()
+
+
+class SimilarSongs:
+
+    def __init__(self, index):
+        self.index = index
+
+    def on_get(self, req, resp, song_id):
+        index = get_similarity_index(self.index)
+        try:
+            scores = index.similar_songs(get_id(song_id), get_limit(req),
+                                         req.get_param('metric') or 'cosine')
+        except LookupError:
+            raise falcon.HTTPNotFound()
+        except ValueError as e:
+            raise falcon.HTTPBadRequest('Bad request', str(e))
+
+        respond_page(req, resp, queries.scored_songs(scores))
+
+
+class SimilarArtists:
+
+    def __init__(self, index):
+        self.index = index
+
+    def on_get(self, req, resp, artist_id):
+        index = get_similarity_index(self.index)
+        try:
+            scores = index.similar_artists(get_id(artist_id), get_limit(req))
+        except LookupError:
+            raise falcon.HTTPNotFound()
+
+        respond_page(req, resp, queries.scored_artists(scores))
+
+
+class StationProfile:
+
+    def __init__(self, index):
+        self.index = index
+
+    def on_get(self, req, resp, station):
+        index = get_similarity_index(self.index)
+        try:
+            station = model.Station.get(model.Station.name == station)
+        except model.Station.DoesNotExist:
+            raise falcon.HTTPNotFound()
+
+        profile = index.feature_profile(queries.station_song_ids(station.id),
+                                        get_limit(req))
+        respond_page(req, resp, [{'feature': text, 'share': share}
+                                 for text, share in profile])
+
+
+def stream_export(encode, since):
+    """
+    Encode the plays since ``since``. The response is streamed after
+    ConnectionComponent has returned the request's connection, so the export
+    opens one of its own and closes it when done.
+    """
+    try:
+        for text in encode(export_plays(since)):
+            yield text.encode('utf-8')
+    finally:
+        if not model.db.is_closed():
+            model.db.close()
+
+
+class Export:
+
+    def on_get(self, req, resp):
+        file_format = req.get_param('format') or 'jsonl'
+        if file_format not in ENCODERS:
+            msg = "Unsupported export format '{}'".format(file_format)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        since = get_datetime(req, 'since')
+
+        resp.stream = stream_export(ENCODERS[file_format], since)
+        resp.content_type = EXPORT_MEDIA_TYPES[file_format]
+        resp.status = falcon.HTTP_200
+
+
+class Metrics:
+    """
+    The server's metrics in the Prometheus text format.
+    """
+
+    def on_get(self, req, resp):
+        resp.data = metrics.registry.exposition().encode('utf-8')
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.status = falcon.HTTP_200
@@ -0,0 +1,257 @@
+"""
+A background worker pool that scrapes Music Genome features for queued Songs.
+
+Ingestion only records a ``ScrapeJob`` per new Song. Workers claim due jobs
+from the database with a short lease, fetch the Pandora detail page and attach
+the resulting Features. Transient failures are retried with exponential
+backoff, so slow or unavailable upstream pages never hold up a request.
+"""
+
+import logging
+import threading
+from urllib.parse import urlparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import requests
+
+import pianodb.model as model
+from pianodb import metrics
+from pianodb.pianodb import parse_track_features, add_track_features, atomic
+from pianodb.cache import MISSING, FeatureCache
+
+log = logging.getLogger(__name__)
+
+# HTTP status codes that mean a detail page is gone for good. Anything else
+# that isn't a 200 is considered transient and retried.
+PERMANENT_STATUS_CODES = (404, 410)
+
+
+class ScrapeError(Exception):
+    """A transient failure to fetch a detail page."""
+
+
+class CachedScrapeError(ScrapeError):
+    """A transient failure remembered by the feature cache."""
+
+
+def fetch_track_features(detail_url, session=requests, timeout=10):
+    """
+    Fetch and parse the features of the track at ``detail_url``. Pages that
+    no longer exist yield no features; other failures raise ``ScrapeError``.
+    """
+    try:
+        with metrics.STAGE_DURATION.time(stage='fetch'):
+            page = session.get(detail_url, timeout=timeout)
+    except requests.RequestException as exc:
+        raise ScrapeError(str(exc)) from exc
+
+    if page.status_code == 200:
+        with metrics.STAGE_DURATION.time(stage='parse'):
+            return parse_track_features(page.content)
+    if page.status_code in PERMANENT_STATUS_CODES:
+        return []
+    raise ScrapeError("HTTP {}".format(page.status_code))
+
+
+def claim_job(lease):
+    """
+    Claim the next due ``ScrapeJob`` for ``lease`` seconds. The claim is a
+    conditional UPDATE so concurrent workers, in this process or any other,
+    never process the same job twice. Returns ``None`` if no job is due.
+    """
+    now = datetime.now()
+    unclaimed = (model.ScrapeJob.claimed_until >> None) | \
+                (model.ScrapeJob.claimed_until < now)
+    due = (model.ScrapeJob
+           .select()
+           .where(model.ScrapeJob.finished >> None,
+                  model.ScrapeJob.next_attempt <= now,
+                  unclaimed)
+           .order_by(model.ScrapeJob.next_attempt)
+           .limit(10))
+
+    # Read every candidate before claiming any. Writing while the SELECT is
+    # still open would upgrade its read transaction, which SQLite refuses
+    # outright instead of waiting if another worker has written meanwhile.
+    for job in list(due):
+        claimed = (model.ScrapeJob
+                   .update(claimed_until=now + timedelta(seconds=lease))
+                   .where(model.ScrapeJob.id == job.id, unclaimed)
+                   .execute())
+        if claimed:
+            return job
+
+
+def complete_job(job, features):
+    with atomic():
+        add_track_features(job.song_id, features)
+        (model.ScrapeJob
+         .update(finished=datetime.now(), claimed_until=None, last_error=None)
+         .where(model.ScrapeJob.id == job.id)
+         .execute())
+
+
+def fail_job(job, error, max_attempts, backoff):
+    """
+    Release ``job`` to be retried after an exponentially growing delay, or
+    give up on it once it has been attempted ``max_attempts`` times.
+    """
+    now = datetime.now()
+    attempts = job.attempts + 1
+    delay = timedelta(seconds=backoff * 2 ** (attempts - 1))
+    (model.ScrapeJob
+     .update(attempts=attempts,
+             next_attempt=now + delay,
+             claimed_until=None,
+             finished=now if attempts >= max_attempts else None,
+             last_error=str(error)[:255])
+     .where(model.ScrapeJob.id == job.id)
+     .execute())
+
+
+def defer_job(job, delay):
+    """
+    Release ``job`` to be retried after ``delay`` seconds without counting an
+    attempt against it.
+    """
+    (model.ScrapeJob
+     .update(next_attempt=datetime.now() + timedelta(seconds=delay),
+             claimed_until=None)
+     .where(model.ScrapeJob.id == job.id)
+     .execute())
+
+
+class ScrapeWorkerPool:
+    """
+    A pool of threads draining the ``ScrapeJob`` queue. At most ``per_host``
+    pages are fetched concurrently from any one host by this pool. Pages found
+    in ``cache`` are never fetched.
+    """
+
+    def __init__(self, workers=4, per_host=2, max_attempts=5, backoff=30,
+                 lease=300, poll_interval=5, timeout=10, cache=None):
+        self.workers = workers
+        self.cache = cache if cache is not None else FeatureCache()
+        self.per_host = per_host
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self._stop = threading.Event()
+        self._threads = []
+        self._host_lock = threading.Lock()
+        self._host_limits = defaultdict(
+            lambda: threading.BoundedSemaphore(self.per_host))
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        options = ('workers', 'per_host', 'max_attempts', 'backoff', 'lease',
+                   'poll_interval', 'timeout')
+        return cls(cache=FeatureCache.from_config(config.get('cache')),
+                   **{k: v for k, v in config.items() if k in options})
+
+    def host_limit(self, detail_url):
+        with self._host_lock:
+            return self._host_limits[urlparse(detail_url).netloc]
+
+    def fetch(self, detail_url, session):
+        """
+        Fetch the features at ``detail_url`` through the cache. Cached
+        failures are raised again without touching the network.
+        """
+        entry = self.cache.get(detail_url)
+        if entry is not MISSING:
+            metrics.SCRAPE_CACHE_LOOKUPS.inc(result='hit')
+            features, error = entry
+            if error is not None:
+                raise CachedScrapeError(error)
+            return features
+
+        metrics.SCRAPE_CACHE_LOOKUPS.inc(result='miss')
+        try:
+            with self.host_limit(detail_url):
+                features = fetch_track_features(detail_url, session,
+                                                self.timeout)
+        except ScrapeError as exc:
+            metrics.SCRAPE_ERRORS.inc()
+            self.cache.set(detail_url, error=str(exc))
+            raise
+
+        self.cache.set(detail_url, features)
+        return features
+
+    def attempt(self, job, session):
+        try:
+            features = self.fetch(job.detail_url, session)
+        except CachedScrapeError:
+            # Nothing was fetched, so try again once the failure expires.
+            defer_job(job, self.cache.negative_ttl)
+        except ScrapeError as exc:
+            log.warning('scraping %s failed: %s', job.detail_url, exc)
+            fail_job(job, exc, self.max_attempts, self.backoff)
+        else:
+            complete_job(job, features)
+
+    def scrape(self, job, session):
+        """
+        Scrape ``job``. Anything unexpected, such as a page that can't be
+        parsed or a failed write, counts as a failed attempt too, so that a
+        bad page is given up on like an unavailable one.
+        """
+        try:
+            self.attempt(job, session)
+        except Exception as exc:
+            log.exception('scraping %s failed', job.detail_url)
+            fail_job(job, exc, self.max_attempts, self.backoff)
+
+    def work(self, once):
+        session = requests.Session()
+        try:
+            while not self._stop.is_set():
+                try:
+                    job = claim_job(self.lease)
+                    if job is not None:
+                        self.scrape(job, session)
+                        continue
+                except Exception:
+                    # A thread that dies is never restarted. Jobs it claimed
+                    # are released once their lease expires.
+                    log.exception('scraping failed')
+                if once:
+                    break
+                self._stop.wait(self.poll_interval)
+        finally:
+            session.close()
+            if not model.db.is_closed():
+                model.db.close()
+
+    def start(self, once=False):
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self.work, args=(once,),
+                                          daemon=True)
+                         for _ in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def run(self, once=False):
+        """
+        Run the pool in the foreground. With ``once`` the pool returns as soon
+        as no job is due instead of polling forever.
+        """
+        self.start(once)
+        try:
+            self.join()
+        except KeyboardInterrupt:
+            self.stop()
+            self.join()
@@ -0,0 +1,205 @@
+"""
+Full-text search over the names of artists, albums, songs and features.
+
+On SQLite each searchable model has an FTS5 table of its own, keyed by the
+model's primary key. Rows are never updated in place, so the ingestion
+transaction keeps the tables current by copying the rows past the highest
+key already indexed, a range scan of the primary key. On PostgreSQL each
+model has a GIN index on the ``tsvector`` of its name, which the database
+maintains itself. Other databases, and SQLite builds without FTS5, fall back
+to ``LIKE`` scans.
+
+Every word of a query must match, each as a prefix, and results are ranked
+by BM25 on SQLite and ``ts_rank`` on PostgreSQL.
+"""
+
+import re
+import logging
+
+from peewee import OperationalError, SqliteDatabase, PostgresqlDatabase
+
+import pianodb.model as model
+from pianodb.queries import (scored_albums, scored_artists, scored_features,
+                             scored_songs)
+
+# The searchable models by the name results report them under, with the
+# column searched.
+KINDS = {
+    'artist': model.Artist.name,
+    'album': model.Album.title,
+    'song': model.Song.title,
+    'feature': model.Feature.text,
+}
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+log = logging.getLogger(__name__)
+
+
+class InvalidSearch(ValueError):
+    """A query without words or of unknown kinds."""
+
+
+def fts_table(kind):
+    return "search_{}".format(kind)
+
+
+def gin_index(kind):
+    return "{}_search".format(kind)
+
+
+def backend(refresh=False):
+    """
+    ``'fts5'`` or ``'tsvector'`` if the database has search indexes, or
+    ``None``. Worked out once per database.
+    """
+    database = model.db.obj
+    if refresh or not hasattr(database, 'search_backend'):
+        name = None
+        if isinstance(database, SqliteDatabase):
+            if fts_table('artist') in database.get_tables():
+                name = 'fts5'
+        elif isinstance(database, PostgresqlDatabase):
+            indexes = database.get_indexes(model.Artist._meta.db_table)
+            if any(index.name == gin_index('artist') for index in indexes):
+                name = 'tsvector'
+        database.search_backend = name
+    return database.search_backend
+
+
+def create_search_index():
+    """
+    Create the search indexes the database supports and index every row.
+    SQLite builds without FTS5 get none, and searches scan instead.
+    """
+    database = model.db.obj
+    if isinstance(database, SqliteDatabase):
+        try:
+            for kind in KINDS:
+                # Prefix indexes make short prefix queries as fast as whole
+                # words.
+                database.execute_sql(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(text, "
+                    "tokenize = 'unicode61 remove_diacritics 1', "
+                    "prefix = '2 3')".format(fts_table(kind)))
+        except OperationalError as exc:
+            if 'no such module' not in str(exc):
+                raise
+            log.warning('SQLite lacks FTS5, search will scan: %s', exc)
+    elif isinstance(database, PostgresqlDatabase):
+        quote = database.compiler().quote
+        for kind, field in KINDS.items():
+            database.execute_sql(
+                "CREATE INDEX IF NOT EXISTS {} ON {} USING gin "
+                "(to_tsvector('simple', {}))".format(
+                    gin_index(kind), quote(field.model_class._meta.db_table),
+                    quote(field.db_column)))
+
+    backend(refresh=True)
+    index_new_rows()
+
+
+def index_new_rows(kinds=tuple(KINDS)):
+    """
+    Add the rows of ``kinds`` written since they were last indexed to their
+    FTS5 tables. Other backends need no help.
+    """
+    if backend() != 'fts5':
+        return
+
+    quote = model.db.compiler().quote
+    for kind in kinds:
+        field = KINDS[kind]
+        meta = field.model_class._meta
+        model.db.execute_sql(
+            "INSERT INTO {fts} (rowid, text) SELECT {pk}, {column} FROM "
+            "{table} WHERE {pk} > coalesce((SELECT rowid FROM {fts} ORDER BY "
+            "rowid DESC LIMIT 1), 0)".format(
+                fts=fts_table(kind), table=quote(meta.db_table),
+                pk=quote(meta.primary_key.db_column),
+                column=quote(field.db_column)))
+
+
+def rebuild_search_index():
+    """
+    Index every row again, dropping those of rows since deleted.
+    """
+    if backend() == 'fts5':
+        for kind in KINDS:
+            model.db.execute_sql("DELETE FROM {}".format(fts_table(kind)))
+    index_new_rows()
+
+
+def search_sql(kind, words):
+    """
+    The statement ranking the rows of ``kind`` matching every one of
+    ``words`` as a prefix, best first, and its parameters. Rows are returned
+    as ``(primary key, score)`` pairs.
+    """
+    field = KINDS[kind]
+    meta = field.model_class._meta
+    quote = model.db.compiler().quote
+    table, pk, column = (quote(meta.db_table),
+                         quote(meta.primary_key.db_column),
+                         quote(field.db_column))
+
+    name = backend()
+    if name == 'fts5':
+        fts = fts_table(kind)
+        # bm25 is negative, and lower is better. Between equally good
+        # matches the shortest name is the closest. Rows of deleted records
+        # drop out of the join.
+        sql = ("SELECT {fts}.rowid, -bm25({fts}) FROM {fts} "
+               "JOIN {table} ON {table}.{pk} = {fts}.rowid "
+               "WHERE {fts} MATCH ? "
+               "ORDER BY bm25({fts}), length({fts}.text) LIMIT ?").format(
+                   fts=fts, table=table, pk=pk)
+        return sql, [' '.join('"{}"*'.format(w) for w in words)]
+    elif name == 'tsvector':
+        vector = "to_tsvector('simple', {})".format(column)
+        sql = ("SELECT {pk}, ts_rank({vector}, query) FROM {table}, "
+               "to_tsquery('simple', %s) query WHERE {vector} @@ query "
+               "ORDER BY 2 DESC, length({column}), {pk} LIMIT %s").format(
+                   pk=pk, vector=vector, table=table, column=column)
+        return sql, [' & '.join("{}:*".format(w) for w in words)]
+
+    param = model.db.compiler().interpolation
+    where = ' AND '.join('{} LIKE {}'.format(column, param) for _ in words)
+    sql = ("SELECT {pk}, 0 FROM {table} WHERE {where} "
+           "ORDER BY length({column}), {pk} LIMIT {param}").format(
+               pk=pk, table=table, where=where, column=column, param=param)
+    return sql, ['%{}%'.format(w) for w in words]
+
+
+DESCRIBE = {
+    'artist': scored_artists,
+    'album': scored_albums,
+    'song': scored_songs,
+    'feature': scored_features,
+}
+
+
+def search(text, kinds=tuple(KINDS), limit=20):
+    """
+    The ``limit`` best matches of ``text`` among ``kinds``, best first. Each
+    result names its ``type`` and has a ``score``, higher being better.
+    """
+    words = WORDS.findall(text.lower())
+    if not words:
+        raise InvalidSearch('Search query has no words')
+    unknown = set(kinds) - KINDS.keys()
+    if unknown:
+        raise InvalidSearch("Unknown search type '{}'".format(
+            sorted(unknown)[0]))
+
+    results = []
+    for kind in kinds:
+        sql, params = search_sql(kind, words)
+        scores = [(pk, round(float(score), 6)) for pk, score in
+                  model.db.execute_sql(sql, params + [limit]).fetchall()]
+        if scores:
+            results.extend(dict(result, type=kind)
+                           for result in DESCRIBE[kind](scores))
+
+    results.sort(key=lambda result: -result['score'])
+    return results[:limit]
@@ -0,0 +1,111 @@
+"""
+The pianodb webserver: a Falcon WSGI application run by Gunicorn.
+"""
+
+import falcon
+from gunicorn.app.base import BaseApplication
+from gunicorn.six import iteritems
+
+import pianodb.model as model
+from pianodb.admission import AdmissionController
+from pianodb.auth import Tokens
+from pianodb.metrics import registry, instrument_database
+from pianodb.pianodb import warm_identity_map, disconnect
+from pianodb.routes import (MetricsComponent, ProfilerComponent,
+                            AdmissionComponent, ConnectionComponent,
+                            ValidatorComponent,
+                            SongFinish, SongFinishBatch, Plays, Artists,
+                            StationSongs, SongFeatures, Export, Search,
+                            Metrics, SimilarSongs, SimilarArtists,
+                            StationProfile)
+from pianodb.scraper import ScrapeWorkerPool
+
+
+class PianoDBApplication(BaseApplication):
+    """http://docs.gunicorn.org/en/latest/custom.html"""
+    def __init__(self, app, options=None):
+        self.options = options or {}
+        self.application = app
+        super().__init__()
+
+    def load_config(self):
+        config = dict([(key, value) for key, value in iteritems(self.options)
+                       if key in self.cfg.settings and value is not None])
+        for key, value in iteritems(config):
+            self.cfg.set(key.lower(), value)
+
+    def load(self):
+        return self.application
+
+
+def create_app(config, writer=None, profiler=None, dedup=None):
+    prefix = config['api_prefix']
+    songfinish_route = "{}/songfinish".format(prefix)
+
+    pool = config.get('pool')
+    ping = pool is not None and pool.get('ping', True)
+    public_metrics = (config.get('metrics') or {}).get('public', True)
+
+    # Tokens are checked before anything else is done with a request.
+    public = ['/metrics'] if public_metrics else []
+    validator = ValidatorComponent(Tokens.from_config(config), public)
+    middleware = [MetricsComponent(), validator, ConnectionComponent(ping)]
+
+    admission = config.get('admission')
+    if admission:
+        controller = AdmissionController.from_config(
+            admission, writer.depth if writer is not None else None)
+        middleware.insert(2, AdmissionComponent(controller))
+
+    if model.db.obj is not None:
+        instrument_database(model.db.obj)
+        if profiler is not None:
+            profiler.instrument(model.db.obj)
+            middleware.insert(1, ProfilerComponent(profiler))
+
+    api = falcon.API(middleware=middleware)
+    api.add_route(songfinish_route, SongFinish(writer, dedup))
+    api.add_route(songfinish_route + '/batch', SongFinishBatch(writer, dedup))
+
+    api.add_route(prefix + '/plays', Plays())
+    api.add_route(prefix + '/artists', Artists())
+    api.add_route(prefix + '/stations/{station}/songs', StationSongs())
+    api.add_route(prefix + '/songs/{song_id}/features', SongFeatures())
+    api.add_route(prefix + '/export', Export())
+    api.add_route(prefix + '/search', Search())
+    api.add_route('/metrics', Metrics())
+
+    similarity = config.get('similarity')
+    if similarity:
+        from pianodb.similarity import SharedIndex
+
+        index = SharedIndex(similarity['path'])
+        api.add_route(prefix + '/songs/{song_id}/similar',
+                      SimilarSongs(index))
+        api.add_route(prefix + '/artists/{artist_id}/similar',
+                      SimilarArtists(index))
+        api.add_route(prefix + '/stations/{station}/profile',
+                      StationProfile(index))
+
+    return api
+
+
+def post_fork(server, worker):
+    """
+    Gunicorn hook run in each worker after it is forked from the master.
+    """
+    registry.start()
+    warm_identity_map()
+    # Request threads check out connections of their own.
+    disconnect()
+
+
+def run_scraper(config, similarity=None):
+    registry.start()
+    instrument_database(model.db.obj)
+    if similarity:
+        from pianodb.similarity import IndexUpdater
+
+        # Fold newly scraped features into the index workers read.
+        IndexUpdater.from_config(similarity).start()
+    ScrapeWorkerPool.from_config(config).run()
@@ -0,0 +1,428 @@
+"""
+Song and artist similarity over scraped Music Genome features.
+
+The index is a song by feature matrix with one bit per cell, packed eight
+features to a byte, alongside the ids of its songs, their artists and
+features and how many features each song has. Songs are compared against
+every other song at once with vectorized cosine or Jaccard scores, counting
+shared features with a byte-wise popcount table. Artists are compared by the
+normalized sum of their songs' rows, and a station is profiled by the share
+of its songs having each feature.
+
+The index is brought up to date by reading the ``SongFeature`` rows with ids
+past the highest it has seen, its watermark. Rows can also turn up below the
+watermark, when transactions commit out of id order, or disappear, when
+songs are merged, so the count and sum of the ids up to the watermark are
+checked first and the index is rebuilt from scratch should they have
+changed. It is persisted as
+``.npy`` files, which processes map into memory rather than querying the
+join table. Each save writes a new generation of files and then atomically
+replaces ``index.json``, which names the current generation, so readers
+never see a partly written index. Requires numpy.
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+
+import numpy as np
+from peewee import fn
+
+import pianodb.model as model
+from pianodb.pianodb import chunked
+
+log = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+METRICS = ('cosine', 'jaccard')
+
+# The arrays of an index, each saved to a file of its own.
+ARRAYS = ('songs', 'artists', 'features', 'counts', 'bits')
+ARRAY_FILE = re.compile(r'^({})-(\d+)\.npy$'.format('|'.join(ARRAYS)))
+
+# Songs scored at once, which bounds the temporary arrays of a query.
+CHUNK_ROWS = 65536
+
+# The number of set bits in each byte value.
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class NotIndexed(LookupError):
+    """A song or artist without features in the index."""
+
+
+def metadata_path(path):
+    return os.path.join(path, 'index.json')
+
+
+def array_path(path, name, generation):
+    return os.path.join(path, "{}-{}.npy".format(name, generation))
+
+
+class SimilarityIndex:
+    """
+    An in-memory, or memory-mapped, song by feature index. ``songs`` are
+    sorted so that rows are found by binary search. Feature columns are in
+    the order the features were first indexed, so adding features never
+    moves existing bits.
+    """
+
+    def __init__(self, songs=None, artists=None, features=None, counts=None,
+                 bits=None, texts=None, watermark=0, rows=0, checksum=0,
+                 generation=0):
+        self.songs = np.zeros(0, dtype=np.int64) if songs is None else songs
+        self.artists = np.zeros(0, dtype=np.int64) if artists is None \
+            else artists
+        self.features = np.zeros(0, dtype=np.int64) if features is None \
+            else features
+        self.counts = np.zeros(0, dtype=np.int32) if counts is None else counts
+        self.bits = np.zeros((0, 0), dtype=np.uint8) if bits is None else bits
+        self.texts = texts or []
+        self.watermark = watermark
+        self.rows = rows
+        self.checksum = checksum
+        self.generation = generation
+        self._profiles = None
+
+    def __len__(self):
+        return len(self.songs)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map the current generation of the index saved at ``path`` into
+        memory.
+        """
+        with open(metadata_path(path)) as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError("Unsupported similarity index version {}".format(
+                meta['version']))
+
+        arrays = {}
+        for name in ARRAYS:
+            filename = array_path(path, name, meta['generation'])
+            # Empty files can't be mapped.
+            arrays[name] = np.load(filename, mmap_mode='r' if meta['songs']
+                                   else None)
+        # Indexes saved without a checksum are rebuilt on their next update.
+        return cls(texts=meta['texts'], watermark=meta['watermark'],
+                   rows=meta.get('rows'), checksum=meta.get('checksum'),
+                   generation=meta['generation'], **arrays)
+
+    def save(self, path):
+        """
+        Save the index to ``path`` as its next generation and remove the files
+        of older ones. Processes that mapped them keep reading them until
+        they reload.
+        """
+        os.makedirs(path, exist_ok=True)
+        generation = self.generation + 1
+
+        for name in ARRAYS:
+            np.save(array_path(path, name, generation), getattr(self, name))
+
+        meta = {
+            'version': FORMAT_VERSION,
+            'generation': generation,
+            'watermark': self.watermark,
+            'rows': self.rows,
+            'checksum': self.checksum,
+            'songs': len(self.songs),
+            'texts': self.texts,
+        }
+        temporary = metadata_path(path) + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temporary, metadata_path(path))
+        self.generation = generation
+
+        for filename in os.listdir(path):
+            match = ARRAY_FILE.match(filename)
+            if match and int(match.group(2)) != generation:
+                os.remove(os.path.join(path, filename))
+
+    def indexed(self):
+        """
+        The number and sum of the ids of the ``SongFeature`` rows up to the
+        watermark, which match ``rows`` and ``checksum`` as long as no row
+        has been added or removed below it since it was indexed.
+        """
+        rows, checksum = (model.SongFeature
+                          .select(fn.COUNT(model.SongFeature.id),
+                                  fn.SUM(model.SongFeature.id))
+                          .where(model.SongFeature.id <= self.watermark)
+                          .tuples()
+                          .get())
+        return rows, int(checksum or 0)
+
+    def update(self):
+        """
+        Add the ``SongFeature`` rows written since the index was last updated,
+        rebuilding it if rows were added or removed below its watermark.
+        Returns whether the index changed.
+        """
+        rebuilt = False
+        if self.watermark and self.indexed() != (self.rows, self.checksum):
+            log.info('similarity index is out of date, rebuilding it')
+            vars(self).update(vars(SimilarityIndex(
+                generation=self.generation)))
+            rebuilt = True
+
+        query = (model.SongFeature
+                 .select(model.SongFeature.id, model.SongFeature.song,
+                         model.SongFeature.feature)
+                 .where(model.SongFeature.id > self.watermark)
+                 .order_by(model.SongFeature.id)
+                 .tuples())
+        added = np.array(list(query), dtype=np.int64).reshape(-1, 3)
+        if not len(added):
+            return rebuilt
+
+        pairs = added[:, 1:]
+        new_songs = np.setdiff1d(pairs[:, 0], self.songs)
+        new_features = np.setdiff1d(pairs[:, 1], self.features)
+
+        songs = np.union1d(self.songs, new_songs)
+        features = np.concatenate([self.features, new_features])
+
+        # Copy the existing rows into a matrix wide enough for the new
+        # features, then set the new bits.
+        bits = np.zeros((len(songs), (len(features) + 7) // 8), dtype=np.uint8)
+        old_rows = np.searchsorted(songs, self.songs)
+        bits[old_rows, :self.bits.shape[1]] = self.bits
+
+        order = np.argsort(features)
+        rows = np.searchsorted(songs, pairs[:, 0])
+        columns = order[np.searchsorted(features[order], pairs[:, 1])]
+        np.bitwise_or.at(bits, (rows, columns >> 3),
+                         (128 >> (columns & 7)).astype(np.uint8))
+
+        artists = np.zeros(len(songs), dtype=np.int64)
+        artists[old_rows] = self.artists
+        for song, artist in song_artists(new_songs.tolist()):
+            artists[np.searchsorted(songs, song)] = artist
+
+        self.texts = self.texts + feature_texts(new_features.tolist())
+        self.songs, self.artists, self.features = songs, artists, features
+        self.bits = bits
+        self.counts = POPCOUNT[bits].sum(axis=1, dtype=np.int32)
+        self.watermark = int(added[-1, 0])
+        self.rows += len(added)
+        self.checksum += int(added[:, 0].sum())
+        self._profiles = None
+        return True
+
+    def row(self, song_id):
+        i = np.searchsorted(self.songs, song_id)
+        if i == len(self.songs) or self.songs[i] != song_id:
+            raise NotIndexed("Song {} has no indexed features".format(song_id))
+        return int(i)
+
+    def overlaps(self, row):
+        """
+        The number of features each song shares with the song at ``row``.
+        """
+        target = self.bits[row]
+        shared = np.empty(len(self.songs), dtype=np.int32)
+        for start in range(0, len(shared), CHUNK_ROWS):
+            chunk = self.bits[start:start + CHUNK_ROWS]
+            shared[start:start + CHUNK_ROWS] = POPCOUNT[chunk & target].sum(
+                axis=1)
+        return shared
+
+    def similar_songs(self, song_id, limit=10, metric='cosine'):
+        """
+        The ``limit`` songs most similar to ``song_id``, as (song id, score)
+        pairs, best first.
+        """
+        if metric not in METRICS:
+            raise ValueError("Unknown similarity metric '{}'".format(metric))
+
+        row = self.row(song_id)
+        shared = self.overlaps(row).astype(np.float64)
+        if metric == 'cosine':
+            scores = shared / np.sqrt(self.counts * float(self.counts[row]))
+        else:
+            scores = shared / (self.counts + self.counts[row] - shared)
+        scores[row] = -1  # Never similar to itself.
+
+        return top(self.songs, scores, limit)
+
+    def artist_profiles(self):
+        """
+        The artists of the index and the normalized sums of their songs'
+        rows, computed once per loaded index.
+        """
+        if self._profiles is None:
+            artists, inverse = np.unique(self.artists, return_inverse=True)
+            profiles = np.zeros((len(artists), len(self.features)),
+                                dtype=np.float32)
+            for start in range(0, len(self.songs), CHUNK_ROWS):
+                dense = np.unpackbits(self.bits[start:start + CHUNK_ROWS],
+                                      axis=1)[:, :len(self.features)]
+                np.add.at(profiles, inverse[start:start + CHUNK_ROWS], dense)
+            profiles /= np.linalg.norm(profiles, axis=1, keepdims=True)
+            self._profiles = artists, profiles
+        return self._profiles
+
+    def similar_artists(self, artist_id, limit=10):
+        """
+        The ``limit`` artists whose songs' features are most like those of
+        ``artist_id``'s songs, as (artist id, score) pairs, best first.
+        """
+        artists, profiles = self.artist_profiles()
+        i = np.searchsorted(artists, artist_id)
+        if i == len(artists) or artists[i] != artist_id:
+            raise NotIndexed(
+                "Artist {} has no indexed features".format(artist_id))
+
+        scores = profiles.dot(profiles[i]).astype(np.float64)
+        scores[i] = -1
+        return top(artists, scores, limit)
+
+    def feature_profile(self, song_ids, limit=10):
+        """
+        The ``limit`` features most common among ``song_ids``, as (feature
+        text, share of the indexed songs having it) pairs, most common first.
+        """
+        ids = np.unique(np.asarray(list(song_ids), dtype=np.int64))
+        rows = np.searchsorted(self.songs, ids)
+        rows = rows[(rows < len(self.songs)) &
+                    (self.songs[np.minimum(rows, len(self.songs) - 1)] == ids)]
+        if not len(rows):
+            return []
+
+        dense = np.unpackbits(self.bits[np.sort(rows)],
+                              axis=1)[:, :len(self.features)]
+        shares = dense.mean(axis=0)
+        profile = [(self.texts[i], score) for i, score
+                   in top(np.arange(len(shares)), shares, limit)]
+        return sorted(profile, key=lambda pair: (-pair[1], pair[0]))
+
+
+def top(ids, scores, limit):
+    """
+    The ``limit`` (id, score) pairs with the highest positive ``scores``,
+    best first and ties broken by id.
+    """
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > limit:
+        best = np.argpartition(-scores[candidates], limit - 1)[:limit]
+        candidates = candidates[best]
+    ranked = sorted(candidates, key=lambda i: (-scores[i], ids[i]))
+    return [(int(ids[i]), round(float(scores[i]), 6)) for i in ranked]
+
+
+def song_artists(song_ids):
+    for ids in chunked(song_ids):
+        query = (model.Song
+                 .select(model.Song.id, model.Album.artist)
+                 .join(model.Album)
+                 .where(model.Song.id << ids)
+                 .tuples())
+        yield from query
+
+
+def feature_texts(feature_ids):
+    texts = {}
+    for ids in chunked(feature_ids):
+        query = (model.Feature
+                 .select(model.Feature.id, model.Feature.text)
+                 .where(model.Feature.id << ids)
+                 .tuples())
+        texts.update(query)
+    return [texts[pk] for pk in feature_ids]
+
+
+def update_index(path, rebuild=False):
+    """
+    Bring the index saved at ``path`` up to date with the database, building
+    it from scratch if there is none or ``rebuild`` is set. Returns the
+    index.
+    """
+    index = SimilarityIndex()
+    if not rebuild and os.path.exists(metadata_path(path)):
+        index = SimilarityIndex.load(path)
+    elif os.path.exists(metadata_path(path)):
+        # Keep counting generations so readers notice the new files.
+        index.generation = SimilarityIndex.load(path).generation
+
+    if index.update() or index.generation == 0:
+        index.save(path)
+    return index
+
+
+class SharedIndex:
+    """
+    The index saved at ``path`` as seen by a server process, reloaded
+    whenever it has been saved again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        The current index, or ``None`` if it hasn't been built yet.
+        """
+        try:
+            mtime = os.stat(metadata_path(self.path)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._index = self.load()
+                    self._mtime = mtime
+        return self._index
+
+    def load(self):
+        # A save may remove the files of the generation just read.
+        for _ in range(3):
+            try:
+                return SimilarityIndex.load(self.path)
+            except FileNotFoundError:
+                continue
+        return SimilarityIndex.load(self.path)
+
+
+class IndexUpdater:
+    """
+    Update the index saved at ``path`` every ``interval`` seconds on a
+    thread of its own, as the scraper attaches new features.
+    """
+
+    def __init__(self, path, interval=300):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['path'], config.get('interval', 300))
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                update_index(self.path)
+            except Exception:
+                log.exception('updating the similarity index failed')
+            finally:
+                if not model.db.is_closed():
+                    model.db.close()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,148 @@
+"""
+An append-only spool of songfinish records for the remote client.
+
+Records are framed as a 4-byte big-endian length followed by a msgpack map.
+The eventcmd only ever appends to the spool, which is cheap and never touches
+the network. ``flush_spool`` later ships the spooled records to the server's
+batch route and discards them once the server has acknowledged them.
+"""
+
+import os
+import fcntl
+import struct
+from contextlib import contextmanager
+
+import msgpack
+
+HEADER = struct.Struct('>I')
+
+
+def default_spool_path():
+    return os.path.join(os.environ['HOME'], '.config', 'pianobar',
+                        'pianodb.spool')
+
+
+def pack_frame(record):
+    payload = msgpack.packb(record)
+    return HEADER.pack(len(payload)) + payload
+
+
+def unpack_frames(data):
+    """
+    Yield ``(end, record)`` for each complete frame in ``data``, where ``end``
+    is the offset just past the frame. A trailing partial frame, e.g. from an
+    interrupted write, is ignored.
+    """
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        if end > len(data):
+            break
+        yield end, msgpack.unpackb(data[offset + HEADER.size:end],
+                                   encoding='utf-8')
+        offset = end
+
+
+class Spool:
+    """
+    A spool file at ``path``. Appending and discarding are serialized by an
+    exclusive lock on ``path + '.lock'``, which lets ``discard`` atomically
+    replace the spool file without racing concurrent appends.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    @contextmanager
+    def locked(self, operation=fcntl.LOCK_EX):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, operation)
+            yield lock
+
+    def append(self, record):
+        frame = pack_frame(record)
+        with self.locked():
+            with open(self.path, 'ab') as spool:
+                spool.write(frame)
+                spool.flush()
+                os.fsync(spool.fileno())
+
+    def read(self):
+        """
+        Return the raw contents of the spool.
+        """
+        with self.locked():
+            try:
+                with open(self.path, 'rb') as spool:
+                    return spool.read()
+            except FileNotFoundError:
+                return b''
+
+    def records(self):
+        return unpack_frames(self.read())
+
+    def discard(self, offset):
+        """
+        Drop the first ``offset`` bytes of the spool, keeping anything that
+        was appended after they were read.
+        """
+        with self.locked():
+            try:
+                with open(self.path, 'rb') as spool:
+                    spool.seek(offset)
+                    remainder = spool.read()
+            except FileNotFoundError:
+                return
+
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as tmp:
+                tmp.write(remainder)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, self.path)
+
+
+class SpoolBusy(Exception):
+    """Another process is already flushing the spool."""
+
+
+@contextmanager
+def flushing(spool):
+    """
+    Hold the right to flush ``spool``. Only one flush runs at a time so that
+    records are never shipped twice; appends are not blocked meanwhile.
+    """
+    with open(spool.path + '.flush', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise SpoolBusy(spool.path)
+        yield
+
+
+def flush_spool(spool, send, batch_size=500):
+    """
+    Ship the records in ``spool`` in batches of ``batch_size`` by calling
+    ``send`` with a list of records. A batch is discarded once ``send``
+    returns truthy; flushing stops at the first batch that isn't acknowledged.
+    Returns the number of records flushed.
+    """
+    flushed = discarded = 0
+    with flushing(spool):
+        batch, end = [], 0
+        for end, record in spool.records():
+            batch.append(record)
+            if len(batch) < batch_size:
+                continue
+            if not send(batch):
+                return flushed
+            spool.discard(end - discarded)
+            flushed, discarded, batch = flushed + len(batch), end, []
+
+        if batch and send(batch):
+            spool.discard(end - discarded)
+            flushed += len(batch)
+
+    return flushed
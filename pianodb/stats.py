@@ -0,0 +1,183 @@
+"""
+Pre-aggregated listening statistics.
+
+Play counts and listened seconds are rolled up per song, artist, station,
+station and song, and day. The rollups are updated incrementally in the same
+transaction that records the Plays, so dashboard queries read a handful of
+rows instead of scanning the whole play history. ``rebuild_stats`` recomputes
+them from the raw Plays should they ever drift.
+"""
+
+from collections import Counter
+
+import pianodb.model as model
+from pianodb.pianodb import atomic, chunked, insert_or_ignore
+
+# Each rollup model and the names of the columns that make up its key.
+ROLLUPS = (
+    (model.SongStats, ('song',)),
+    (model.ArtistStats, ('artist',)),
+    (model.StationStats, ('station',)),
+    (model.StationSongStats, ('station', 'song')),
+    (model.DailyStats, ('day',)),
+)
+
+
+def seconds(duration):
+    """
+    Convert a Play duration, a ``datetime.time`` or 'H:MM:SS' string, to
+    seconds. Durations of a day or more, or negative ones, were once stored
+    as ``timedelta`` strings such as '-1 day, 23:59:55', which are read as
+    what they say.
+    """
+    if not isinstance(duration, str):
+        return duration.hour * 3600 + duration.minute * 60 + duration.second
+
+    days = 0
+    if ',' in duration:
+        day_part, duration = duration.split(',')
+        days = int(day_part.split()[0])
+    hours, minutes, secs = (int(part) for part in duration.split(':'))
+    return days * 24 * 60 * 60 + hours * 3600 + minutes * 60 + secs
+
+
+class Deltas:
+    """
+    Play count and listened seconds increments, accumulated per rollup key.
+    """
+
+    def __init__(self):
+        self.plays = {rollup: Counter() for rollup, _ in ROLLUPS}
+        self.seconds = {rollup: Counter() for rollup, _ in ROLLUPS}
+
+    def add(self, timestamp, artist, station, song, played):
+        keys = {
+            model.SongStats: (song,),
+            model.ArtistStats: (artist,),
+            model.StationStats: (station,),
+            model.StationSongStats: (station, song),
+            model.DailyStats: (timestamp.date(),),
+        }
+        for rollup, key in keys.items():
+            self.plays[rollup][key] += 1
+            self.seconds[rollup][key] += played
+
+
+def increment_statement(rollup, fields, size):
+    """
+    The UPDATE adding to the counters of ``size`` ``rollup`` rows keyed by
+    ``fields``. As in ``pianodb.pianodb.update_many`` the increment of each
+    row is picked by a ``CASE`` on its key, so a whole chunk of rows costs a
+    single statement.
+    """
+    compiler = model.db.compiler()
+    param = compiler.interpolation
+    match = ' AND '.join('{} = {}'.format(compiler.quote(field.db_column),
+                                          param)
+                         for field in fields)
+    cases = ' '.join('WHEN {} THEN {}'.format(match, param)
+                     for _ in range(size))
+    counters = ', '.join('{0} = {0} + CASE {1} END'.format(
+        compiler.quote(column), cases) for column in ('plays', 'seconds'))
+    where = ' OR '.join('({})'.format(match) for _ in range(size))
+    return 'UPDATE {} SET {} WHERE {}'.format(
+        compiler.quote(rollup._meta.db_table), counters, where)
+
+
+def apply_deltas(deltas):
+    """
+    Add ``deltas`` to the rollup tables with two statements per chunk of
+    keys of each rollup: the rows that don't exist yet are inserted with
+    zeroed counters, then every row is incremented in place. This stays
+    correct when another writer inserts the same rows concurrently.
+    """
+    for rollup, columns in ROLLUPS:
+        fields = [getattr(rollup, c) for c in columns]
+        counters = (deltas.plays[rollup], deltas.seconds[rollup])
+        for chunk in chunked(counters[0]):
+            insert_or_ignore(rollup, (dict(zip(columns, key))
+                                      for key in chunk))
+
+            keys = [[f.db_value(v) for f, v in zip(fields, key)]
+                    for key in chunk]
+            params = []
+            for counter in counters:
+                for key, values in zip(chunk, keys):
+                    params.extend(values)
+                    params.append(counter[key])
+            for values in keys:
+                params.extend(values)
+            model.db.execute_sql(
+                increment_statement(rollup, fields, len(chunk)), params)
+
+
+def rebuild_stats():
+    """
+    Recompute every rollup from the raw Plays.
+    """
+    query = (model.Play
+             .select(model.Play.timestamp, model.Album.artist,
+                     model.Play.station, model.Play.song, model.Play.duration)
+             .join(model.Song)
+             .join(model.Album)
+             .tuples()
+             .iterator())
+
+    deltas = Deltas()
+    for timestamp, artist, station, song, duration in query:
+        deltas.add(timestamp, artist, station, song, seconds(duration))
+
+    with atomic():
+        for rollup, _ in ROLLUPS:
+            rollup.delete().execute()
+        apply_deltas(deltas)
+
+
+def top_artists(limit=10):
+    return (model.ArtistStats
+            .select(model.Artist.name, model.ArtistStats.plays,
+                    model.ArtistStats.seconds)
+            .join(model.Artist)
+            .order_by(model.ArtistStats.plays.desc())
+            .limit(limit)
+            .tuples())
+
+
+def top_songs(station=None, limit=10):
+    """
+    The most played songs overall, or on the Station named ``station``.
+    """
+    rollup = model.StationSongStats if station else model.SongStats
+    query = (rollup
+             .select(model.Song.title, model.Artist.name, rollup.plays,
+                     rollup.seconds)
+             .join(model.Song)
+             .join(model.Album)
+             .join(model.Artist))
+    if station:
+        query = (query
+                 .switch(rollup)
+                 .join(model.Station)
+                 .where(model.Station.name == station))
+    return query.order_by(rollup.plays.desc()).limit(limit).tuples()
+
+
+def top_stations(limit=10):
+    return (model.StationStats
+            .select(model.Station.name, model.StationStats.plays,
+                    model.StationStats.seconds)
+            .join(model.Station)
+            .order_by(model.StationStats.plays.desc())
+            .limit(limit)
+            .tuples())
+
+
+def plays_per_day(start=None, end=None):
+    query = model.DailyStats.select(model.DailyStats.day,
+                                    model.DailyStats.plays,
+                                    model.DailyStats.seconds)
+    if start:
+        query = query.where(model.DailyStats.day >= start)
+    if end:
+        query = query.where(model.DailyStats.day <= end)
+    return query.order_by(model.DailyStats.day).tuples()
@@ -0,0 +1,113 @@
+"""
+The compact wire format of songfinish batches.
+
+A legacy payload is a msgpack map per record, repeating all nine keys and
+every URL verbatim. A compact payload is a single msgpack array
+
+    [schema version, strings, rows]
+
+in which each row is an array of a record's fields in the order of its
+schema version. String fields are indexes into ``strings``, where each
+distinct string appears once, so an artist, album, station or cover art URL
+shared by many records in a batch is only sent once. Durations and ratings
+are sent as integers.
+
+Legacy records are maps, so a payload whose first element is an integer is
+unambiguously compact, and servers accept both.
+"""
+
+import msgpack
+
+SCHEMA_VERSION = 1
+
+# The fields of a row in schema version 1. Strings are interned.
+STRING_FIELDS = ('artist', 'title', 'album', 'coverArt', 'stationName')
+INTEGER_FIELDS = ('songDuration', 'songPlayed', 'rating')
+
+
+class InvalidPayload(ValueError):
+    """A compact payload that doesn't follow its schema."""
+
+
+def is_compact(payload):
+    return isinstance(payload, list) and bool(payload) and \
+        isinstance(payload[0], int)
+
+
+def encode_v1(records):
+    strings, index = [], {}
+
+    def intern(value):
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(strings)
+            strings.append(value)
+        return i
+
+    rows = []
+    for record in records:
+        row = [intern(record[f]) for f in STRING_FIELDS]
+        row += [int(record[f]) for f in INTEGER_FIELDS]
+        row += [intern(record['detailUrl']), record.get('timestamp')]
+        rows.append(row)
+
+    return [1, strings, rows]
+
+
+def decode_v1(strings, rows):
+    records = []
+    for row in rows:
+        (artist, title, album, cover_art, station, duration, played, rating,
+         detail_url, timestamp) = row
+        record = {
+            'artist': strings[artist],
+            'title': strings[title],
+            'album': strings[album],
+            'coverArt': strings[cover_art],
+            'stationName': strings[station],
+            'songDuration': str(int(duration)),
+            'songPlayed': str(int(played)),
+            'rating': str(int(rating)),
+            'detailUrl': strings[detail_url],
+        }
+        if timestamp is not None:
+            record['timestamp'] = int(timestamp)
+        records.append(record)
+    return records
+
+
+DECODERS = {
+    1: decode_v1,
+}
+
+
+def decode(payload):
+    """
+    Turn an unpacked compact payload back into songfinish records.
+    """
+    try:
+        version, strings, rows = payload
+    except (TypeError, ValueError):
+        raise InvalidPayload('Invalid compact songfinish data')
+
+    try:
+        decoder = DECODERS[version]
+    except KeyError:
+        raise InvalidPayload("Unsupported schema version {}".format(version))
+
+    try:
+        return decoder(strings, rows)
+    except (TypeError, ValueError, IndexError, KeyError):
+        raise InvalidPayload('Invalid compact songfinish data')
+
+
+def pack(records):
+    """
+    Pack songfinish records in the current compact format, or as legacy maps
+    if any of them lacks a field the format needs.
+    """
+    try:
+        payload = encode_v1(records)
+    except (KeyError, TypeError, ValueError):
+        payload = records
+    return msgpack.packb(payload)
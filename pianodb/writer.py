@@ -0,0 +1,133 @@
+"""
+A single writer for SQLite.
+
+SQLite allows one writer at a time, so concurrent requests writing through
+their own connections spend their time waiting on the database lock and
+syncing one small transaction each. The server instead hands songfinish
+records to a ``WriteQueue``, whose thread commits whatever has queued up
+since its last transaction in a single one: a group commit. Submitters block
+until their records are committed, so a 201 still means the data is on disk.
+
+The queries of a group commit are counted towards, and with a profiler
+recorded for, every request that submitted records to it.
+"""
+
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from pianodb import metrics
+from pianodb.pianodb import bulk_update_db
+
+
+class WriteQueue:
+    """
+    Funnel writes through one thread. Up to ``max_batch`` records submitted
+    within ``linger`` seconds of each other are committed together.
+    """
+
+    def __init__(self, write=bulk_update_db, max_batch=500, linger=0.005,
+                 profiler=None):
+        self.write = write
+        self.profiler = profiler
+        self.max_batch = max_batch
+        self.linger = linger
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        """
+        Start the writer thread unless it is already running in this process.
+        Threads don't survive a fork, so a forked worker starts its own.
+        """
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join()
+
+    def depth(self):
+        """
+        The number of submissions waiting to be written.
+        """
+        return self.queue.qsize()
+
+    def submit(self, songfinishes, timeout=None):
+        """
+        Queue ``songfinishes`` for writing and wait until they are committed,
+        re-raising whatever writing them raised.
+        """
+        self.start()
+        future = Future()
+        self.queue.put((songfinishes, future))
+        queries, statements = future.result(timeout)
+
+        metrics.add_queries(queries)
+        if self.profiler is not None:
+            self.profiler.record(statements)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            batch, size = [item], len(item[0])
+            deadline = time.monotonic() + self.linger
+            while size < self.max_batch:
+                try:
+                    item = self.queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.commit(batch)
+                    return
+                batch.append(item)
+                size += len(item[0])
+
+            self.commit(batch)
+
+    def traced_write(self, songfinishes):
+        """
+        Write ``songfinishes``, returning how many queries that took and the
+        statements the profiler, if any, recorded.
+        """
+        metrics.count_queries()
+        if self.profiler is not None:
+            self.profiler.start()
+        try:
+            self.write(songfinishes)
+        finally:
+            statements = [] if self.profiler is None else \
+                self.profiler.collect()
+        return metrics.count_queries(), statements
+
+    def commit(self, batch):
+        try:
+            work = self.traced_write([songfinish
+                                      for songfinishes, _ in batch
+                                      for songfinish in songfinishes])
+        except Exception as exc:
+            if len(batch) == 1:
+                batch[0][1].set_exception(exc)
+                return
+            # Retry submissions one by one so that a bad one fails alone.
+            for item in batch:
+                self.commit([item])
+            return
+
+        for _, future in batch:
+            future.set_result(work)
@@ -54,10 +54,13 @@ setup(
     tests_require=test_requirements,
     extras_require={
         'dev': test_requirements,
+        'async': ['aiohttp'],
+        'parquet': ['pyarrow'],
+        'similarity': ['numpy'],
     },
     entry_points={
         'console_scripts': [
-            'pianodb=pianodb.__main__:cli',
+            'pianodb=pianodb.__main__:main',
         ],
     },
 )
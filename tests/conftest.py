@@ -0,0 +1,20 @@
+import pytest
+from playhouse.db_url import connect
+
+from pianodb.cache import identity_map
+from pianodb.pianodb import create_database
+
+
+@pytest.fixture
+def sqlite_database(tmpdir):
+    """
+    A fixture for a throwaway SQLite database with every ``pianodb`` table
+    created. Cached identities from other databases are forgotten.
+    """
+    identity_map.invalidate()
+    database = connect("sqlite:///{}".format(tmpdir.join('piano.db')))
+    create_database(database)
+
+    yield database
+
+    database.close()
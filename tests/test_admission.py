@@ -0,0 +1,122 @@
+import time
+
+import msgpack
+import pytest
+from falcon import API, testing
+
+import pianodb.routes
+from pianodb.admission import AdmissionController, Latency
+from pianodb.auth import Tokens
+from pianodb.routes import AdmissionComponent, SongFinish, ValidatorComponent
+
+TOKEN = 'CB80CB12CC0F41FC87CA6F2AC989E27E'
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+
+def test_requests_in_flight_and_queued_writes_are_bounded():
+    """
+    Test that requests are refused with a 503 while too many are in progress
+    or too many writes are queued, and admitted again once they clear.
+    """
+    depth = [0]
+    controller = AdmissionController(max_in_flight=2, max_queue=10,
+                                     retry_after=3,
+                                     queue_depth=lambda: depth[0])
+
+    assert controller.admit() is None
+    assert controller.admit() is None
+    rejection = controller.admit()
+    assert (rejection.status, rejection.reason, rejection.retry_after) == \
+        (503, 'in_flight', 3)
+
+    controller.release()
+    depth[0] = 10
+    assert controller.admit().reason == 'queue'
+    depth[0] = 9
+    assert controller.admit() is None
+
+
+def test_tokens_are_rate_limited_separately():
+    """
+    Test that each token gets its own burst and rate, and that a refused
+    request says when the next would be admitted.
+    """
+    controller = AdmissionController(rate=0.5, burst=2)
+
+    assert controller.admit('a') is None
+    assert controller.admit('a') is None
+    rejection = controller.admit('a')
+    assert (rejection.status, rejection.reason) == (429, 'rate')
+    assert rejection.retry_after == 2
+    assert controller.admit('b') is None
+
+
+def test_rates_below_one_request_a_second_admit_requests():
+    """
+    Test that a client limited to less than a request a second is still
+    admitted once per interval when no burst is configured, and that limits
+    nothing could be admitted under are refused.
+    """
+    controller = AdmissionController(rate=0.5)
+
+    assert controller.burst == 1
+    assert controller.admit('a') is None
+    assert controller.admit('a').retry_after == 2
+
+    with pytest.raises(ValueError):
+        AdmissionController.from_config({'rate': 5, 'burst': 0.5})
+    with pytest.raises(ValueError):
+        AdmissionController.from_config({'rate': 0})
+
+
+def test_slow_writes_shed_load_until_forgotten():
+    """
+    Test that requests are refused while writes are slow on average and
+    admitted again once no write has been seen for a while.
+    """
+    latency = Latency(window=0.05)
+    controller = AdmissionController(max_latency=1, latency=latency)
+
+    latency.observe(0.5)
+    assert controller.admit() is None
+    latency.observe(5)
+    assert controller.admit().reason == 'latency'
+
+    time.sleep(0.1)
+    assert controller.admit() is None
+
+
+def test_refused_requests_skip_the_responder(monkeypatch):
+    """
+    Test that the admission component refuses requests before their
+    responder runs, with a ``Retry-After`` header, and releases the ones it
+    admits.
+    """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
+
+    controller = AdmissionController(rate=1, burst=1, retry_after=5)
+    api = API(middleware=[AdmissionComponent(controller),
+                          ValidatorComponent(Tokens({'default': TOKEN}))])
+    api.add_route('/songfinish', SongFinish())
+    client = testing.TestClient(api)
+    headers = {'X-Auth-Token': TOKEN, 'Content-Type': 'application/msgpack'}
+
+    results = [client.simulate_post(path='/songfinish', headers=headers,
+                                    body=msgpack.packb(SONGFINISH))
+               for _ in range(2)]
+
+    assert [r.status_code for r in results] == [201, 429]
+    assert results[1].headers['Retry-After'] == '1'
+    assert written == [[SONGFINISH]]
+    assert controller.in_flight == 0
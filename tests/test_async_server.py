@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+import msgpack
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+import pianodb.async_server  # noqa: E402
+
+TOKEN = 'CB80CB12CC0F41FC87CA6F2AC989E27E'
+CONFIG = {
+    'api_prefix': '/api/v1',
+    'token': TOKEN,
+    'workers': 2,
+    'database': 'sqlite:////tmp/piano.db',
+    'scraper': {'workers': 0},
+}
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+
+def post(path, data, headers):
+    """
+    POST ``data`` to a throwaway async server and return the response status
+    and body.
+    """
+    async def request():
+        client = TestClient(TestServer(
+            pianodb.async_server.create_app(CONFIG)))
+        await client.start_server()
+        try:
+            response = await client.post(path, data=data, headers=headers)
+            return response.status, await response.read()
+        finally:
+            await client.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(request())
+    finally:
+        loop.close()
+
+
+def test_async_songfinish_matches_the_wsgi_contract(sqlite_database,
+                                                    monkeypatch):
+    """
+    Test that the async engine authenticates, validates and stores songfinish
+    records like the Falcon routes do.
+    """
+
+    written = []
+
+    def store(writer, songfinishes, dedup=None):
+        written.extend(songfinishes)
+
+    monkeypatch.setattr(pianodb.async_server, 'store', store)
+    headers = {'X-Auth-Token': TOKEN, 'Content-Type': 'application/msgpack'}
+
+    status, _ = post('/api/v1/songfinish', msgpack.packb(SONGFINISH), {})
+    assert status == 401
+
+    status, _ = post('/api/v1/songfinish', msgpack.packb({}), headers)
+    assert status == 400
+
+    status, body = post('/api/v1/songfinish/batch',
+                        msgpack.packb([SONGFINISH, 'bogus']), headers)
+    assert status == 201
+    assert msgpack.unpackb(body, encoding='utf-8') == {'results': [
+        {'created': True},
+        {'created': False, 'error': 'Invalid datatype'},
+    ]}
+    assert written == [SONGFINISH]
@@ -0,0 +1,20 @@
+from pianodb.auth import Tokens
+
+
+def test_tokens_authenticate_their_clients():
+    """
+    Test that a config's ``token`` and each of its ``tokens`` authenticate
+    the client they belong to, and that nothing else does.
+    """
+    tokens = Tokens.from_config({
+        'token': 'CB80CB12CC0F41FC87CA6F2AC989E27E',
+        'tokens': {'laptop': '0B4F7E1D9A2C4F6B8E3D5A7C9B1E2F40', 'phone': 1234},
+    })
+
+    assert len(tokens) == 3
+    assert tokens.authenticate('CB80CB12CC0F41FC87CA6F2AC989E27E') == 'default'
+    assert tokens.authenticate('0B4F7E1D9A2C4F6B8E3D5A7C9B1E2F40') == 'laptop'
+    assert tokens.authenticate('1234') == 'phone'
+
+    for token in (None, '', 'CB80CB12CC0F41FC87CA6F2AC989E27', 'spam'):
+        assert tokens.authenticate(token) is None
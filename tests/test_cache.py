@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+from peewee import UpdateQuery
+
+import pianodb.model as model
+from pianodb.pianodb import (atomic, bulk_update_db, resolve_ids,
+                             warm_identity_map)
+from pianodb.cache import (MISSING, LRUCache, FeatureCache, identity_map,
+                           normalize_url)
+
+
+@pytest.mark.parametrize('url', [
+    'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+    'HTTP://WWW.Pandora.com/great-jazz-trio/s-wonderful/take-5/',
+    'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5?dc=1#top',
+])
+def test_cache_normalizes_detail_urls(url):
+    """
+    Test that trivially different spellings of a detail URL normalize to the
+    same cache key.
+    """
+    expected = 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5'
+
+    assert normalize_url(url) == expected
+
+
+def test_lru_cache_evicts_least_recently_used_entries():
+    """
+    Test that the LRU cache stays within ``maxsize`` by evicting the least
+    recently used entry and counts hits and misses.
+    """
+    cache = LRUCache(maxsize=2)
+    cache.set('spam', 1)
+    cache.set('eggs', 2)
+    cache.get('spam')
+    cache.set('ham', 3)
+
+    assert cache.get('eggs') is MISSING
+    assert cache.get('spam') == 1
+    assert cache.get('ham') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_cache_expires_entries():
+    """
+    Test that LRU cache entries are not returned once their TTL has passed.
+    """
+    cache = LRUCache(ttl=60)
+    cache.set('spam', 1)
+
+    later = datetime.now() + timedelta(seconds=61)
+    with mock.patch('pianodb.cache.datetime') as mock_datetime:
+        mock_datetime.now.return_value = later
+        assert cache.get('spam') is MISSING
+
+
+def test_feature_cache_is_shared_through_the_database(sqlite_database):
+    """
+    Test that features stored by one ``FeatureCache`` are found by another,
+    as they would be by another process, and that failures get the shorter
+    negative TTL.
+    """
+    url = 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5'
+    dead_url = 'http://www.pandora.com/nobody/nothing/nada'
+
+    FeatureCache().set(url, ['a piano solo'])
+    FeatureCache(negative_ttl=60).set(dead_url, error='HTTP 503')
+
+    cache = FeatureCache()
+    dead_entry = model.FeatureCacheEntry.get(
+        model.FeatureCacheEntry.url == dead_url)
+
+    assert cache.get(url + '?dc=1') == (['a piano solo'], None)
+    assert cache.get(dead_url) == ([], 'HTTP 503')
+    assert dead_entry.expires < datetime.now() + timedelta(seconds=61)
+    assert cache.get('http://www.pandora.com/unknown') is MISSING
+
+
+def test_feature_cache_overwrites_entries_stored_concurrently(
+        sqlite_database, monkeypatch):
+    """
+    Test that an entry stored by another process after this one found none
+    to update is overwritten rather than failing on the unique URL.
+    """
+    url = 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5'
+    FeatureCache().set(url, error='HTTP 503')
+
+    # The first UPDATE runs before the other process's entry exists.
+    execute = UpdateQuery.execute
+    missed = []
+
+    def racing_execute(query):
+        if not missed:
+            missed.append(query)
+            return 0
+        return execute(query)
+
+    monkeypatch.setattr(UpdateQuery, 'execute', racing_execute)
+    FeatureCache().set(url, ['a piano solo'])
+
+    entry, = model.FeatureCacheEntry.select()
+    assert (entry.features, entry.error) == ('["a piano solo"]', None)
+
+
+def test_identity_map_resolves_known_keys_without_queries(sqlite_database):
+    """
+    Test that natural keys resolved once, or loaded by warming, are served
+    from the identity map and that hits and misses are counted.
+    """
+    artist = model.Artist.create(name='The Great Jazz Trio')
+    warm_identity_map()
+
+    with mock.patch('pianodb.pianodb.get_or_create_many') as get_or_create:
+        ids = resolve_ids(model.Artist, [('The Great Jazz Trio',)])
+
+    assert ids == {('The Great Jazz Trio',): artist.id}
+    assert not get_or_create.called
+
+    before = identity_map.stats().get('Station', {'hits': 0, 'misses': 0})
+    resolve_ids(model.Station, [('Jazz Radio',)])
+    resolve_ids(model.Station, [('Jazz Radio',)])
+    after = identity_map.stats()['Station']
+
+    assert after['size'] == 1
+    assert after['hits'] - before['hits'] == 1
+    assert after['misses'] - before['misses'] == 1
+
+
+def test_identity_map_is_cleared_when_a_transaction_rolls_back(
+        sqlite_database):
+    """
+    Test that ids resolved inside a transaction that rolls back are
+    forgotten.
+    """
+    with pytest.raises(RuntimeError):
+        with atomic():
+            resolve_ids(model.Station, [('Jazz Radio',)])
+            raise RuntimeError
+
+    assert identity_map.get_many(model.Station, [('Jazz Radio',)]) == {}
+    assert model.Station.select().count() == 0
+
+
+def test_identity_map_only_holds_ids_of_committed_rows(sqlite_database):
+    """
+    Test that the ids a batch resolves are cached only once its transaction
+    commits, so a batch that rolls back leaves the identity map empty.
+    """
+    songfinish = {
+        'artist': 'The Great Jazz Trio',
+        'title': 'Take 5',
+        'album': "'S Wonderful",
+        'coverArt': '',
+        'stationName': 'Jazz Radio',
+        'songDuration': '310',
+        'songPlayed': '310',
+        'rating': '0',
+        'detailUrl': '',
+        'timestamp': '1500000000',
+    }
+    artist_key = [('The Great Jazz Trio',)]
+    seen = []
+
+    def apply_deltas(deltas):
+        seen.append(identity_map.get_many(model.Artist, artist_key))
+        raise RuntimeError
+
+    with mock.patch('pianodb.stats.apply_deltas', apply_deltas):
+        with pytest.raises(RuntimeError):
+            bulk_update_db([songfinish])
+
+    assert seen == [{}]
+    assert identity_map.get_many(model.Artist, artist_key) == {}
+    assert identity_map.get_many(model.Station, [('Jazz Radio',)]) == {}
+    assert model.Artist.select().count() == 0
+
+    bulk_update_db([songfinish])
+
+    artist = model.Artist.get()
+    assert identity_map.get_many(model.Artist, artist_key) == \
+        {('The Great Jazz Trio',): artist.id}
+
+
+def test_identity_map_keeps_ids_resolved_outside_a_rolled_back_savepoint(
+        sqlite_database):
+    """
+    Test that rolling back a nested transaction only drops the ids resolved
+    inside it and that nothing is cached before the outer one commits.
+    """
+    with atomic():
+        resolve_ids(model.Station, [('Jazz Radio',)])
+        with pytest.raises(RuntimeError):
+            with atomic():
+                resolve_ids(model.Station, [('Blues Radio',)])
+                raise RuntimeError
+        assert identity_map.get_many(model.Station, [('Jazz Radio',)]) == {}
+
+    cached = identity_map.get_many(model.Station,
+                                   [('Jazz Radio',), ('Blues Radio',)])
+    assert list(cached) == [('Jazz Radio',)]
@@ -0,0 +1,101 @@
+import gzip
+import threading
+
+import msgpack
+
+from pianodb.client import ClientDaemon, RemoteClient, send_to_daemon
+from pianodb.spool import Spool
+
+CONFIG = {
+    'remote': {
+        'host': 'pianodb.example.tld',
+        'port': 8080,
+        'compress': True,
+    },
+    'token': 'CB80CB12CC0F41FC87CA6F2AC989E27E',
+}
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+    'timestamp': 1478563200,
+}
+
+
+class MockResponse:
+    ok = True
+    status_code = 201
+    content = msgpack.packb({'results': [{'created': True}]})
+
+
+class MockSession:
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, data, headers, timeout):
+        self.posts.append((url, data, headers))
+        return MockResponse()
+
+
+def test_remote_client_can_compress_batches():
+    """
+    Test that the remote client gzips payloads when configured to and labels
+    them with a ``Content-Encoding`` header.
+    """
+    session = MockSession()
+
+    assert RemoteClient(CONFIG, session=session).send([SONGFINISH])
+
+    url, data, headers = session.posts[0]
+
+    assert url == 'http://pianodb.example.tld:8080/api/v1/songfinish/batch'
+    assert headers['Content-Encoding'] == 'gzip'
+    assert msgpack.unpackb(gzip.decompress(data),
+                           encoding='utf-8') == [SONGFINISH]
+
+
+def test_client_daemon_spools_and_sends_records(tmpdir):
+    """
+    Test that records handed to the client daemon are acknowledged, then sent
+    to the server in a single coalesced batch and removed from the spool.
+    """
+    spool = Spool(str(tmpdir.join('pianodb.spool')))
+    socket_path = str(tmpdir.join('pianodb.sock'))
+    sent = threading.Event()
+
+    daemon = ClientDaemon(CONFIG, spool, socket_path, linger=0.2)
+    batches = []
+
+    def _send(batch):
+        batches.append(batch)
+        sent.set()
+        return True
+
+    daemon.remote.send = _send
+
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    try:
+        assert send_to_daemon(socket_path, SONGFINISH)
+        assert send_to_daemon(socket_path, SONGFINISH)
+        assert sent.wait(5)
+    finally:
+        daemon.shutdown()
+        thread.join()
+
+    assert batches == [[SONGFINISH, SONGFINISH]]
+    assert list(spool.records()) == []
+
+
+def test_client_falls_back_without_a_daemon(tmpdir):
+    """
+    Test that handing a record to a daemon that isn't running fails cleanly.
+    """
+    assert not send_to_daemon(str(tmpdir.join('pianodb.sock')), SONGFINISH)
@@ -2,7 +2,22 @@ import os
 from urllib.parse import urlparse
 import pytest
 from playhouse.db_url import connect
-from pianodb.pianodb import create_database
+
+import pianodb.model as model
+from pianodb.pianodb import (create_database, update_db, bulk_update_db,
+                             connect_database, ensure_connection)
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
 
 
 @pytest.fixture(scope='module', params=[
@@ -36,3 +51,124 @@ def test_pianodb_can_create_database(database):
     Test that ``pianodb`` can create a database.
     """
     create_database(database)
+
+
+def test_pianodb_can_bulk_update_database(sqlite_database):
+    """
+    Test that ``pianodb`` can write a batch of songfinish records, resolving
+    repeated Artists, Albums, Songs, Features and Stations to single rows.
+    """
+    other_station = dict(SONGFINISH, stationName='Piano Radio')
+    other_song = dict(SONGFINISH, title='Summertime', songPlayed='100')
+
+    bulk_update_db([SONGFINISH, other_station, other_song, SONGFINISH])
+
+    assert model.Artist.select().count() == 1
+    assert model.Album.select().count() == 1
+    assert model.Song.select().count() == 2
+    assert model.ScrapeJob.select().count() == 2
+    assert model.Station.select().count() == 2
+    assert model.StationArtist.select().count() == 2
+    assert model.StationSong.select().count() == 3
+    assert model.Play.select().count() == 4
+
+    # A second batch must reuse the existing rows.
+    bulk_update_db([SONGFINISH])
+
+    assert model.Song.select().count() == 2
+    assert model.ScrapeJob.select().count() == 2
+    assert model.Play.select().count() == 5
+
+
+def test_pianodb_update_db_ignores_existing_relations(sqlite_database):
+    """
+    Test that ``pianodb`` can write the same songfinish record repeatedly
+    without duplicating Artists, Songs, scrape jobs or many-to-many relations.
+    """
+    for _ in range(3):
+        update_db(SONGFINISH)
+
+    assert model.Artist.select().count() == 1
+    assert model.Song.select().count() == 1
+    assert model.ScrapeJob.select().count() == 1
+    assert model.StationArtist.select().count() == 1
+    assert model.StationSong.select().count() == 1
+    assert model.Play.select().count() == 3
+
+
+def test_pianodb_matches_keys_by_the_database_collation(sqlite_database):
+    """
+    Test that names the database considers equal to an existing row's, as
+    MySQL's case-insensitive collations do, resolve to that row.
+    """
+    sqlite_database.execute_sql('DROP TABLE station')
+    sqlite_database.execute_sql(
+        'CREATE TABLE station (id INTEGER NOT NULL PRIMARY KEY, '
+        'name VARCHAR(255) NOT NULL UNIQUE COLLATE NOCASE)')
+
+    bulk_update_db([SONGFINISH])
+    bulk_update_db([dict(SONGFINISH, stationName='JAZZ RADIO')])
+
+    station, = model.Station.select()
+    assert station.name == 'Jazz Radio'
+    assert {p.station_id for p in model.Play.select()} == {station.id}
+
+
+def test_pianodb_replaces_dropped_connections(sqlite_database):
+    """
+    Test that a pre-ping notices a connection closed from under the ORM and
+    opens a new one.
+    """
+
+    ensure_connection()
+    model.db.get_conn().close()
+
+    ensure_connection(ping=True)
+
+    assert model.Artist.select().count() == 0
+
+
+@pytest.mark.parametrize('url, pooled', [
+    ('postgres://postgres@127.0.0.1:5432/pianodb', True),
+    ('mysql://root@127.0.0.1:3306/pianodb', True),
+    ('sqlite:////tmp/piano.db', False),
+])
+def test_pianodb_pools_client_server_connections(url, pooled):
+    """
+    Test that a pool configuration pools MySQL and PostgreSQL connections
+    only.
+    """
+
+    database = connect_database(url, pool={'max_connections': 4})
+
+    assert hasattr(database, 'close_all') == pooled
+    if pooled:
+        assert database.max_connections == 4
+
+
+def test_pianodb_bulk_inserts_one_statement_per_chunk(sqlite_database,
+                                                      monkeypatch):
+    """
+    Test that the rows of a batch are inserted with one multi-row INSERT per
+    chunk, and that the latest cover art of an Album wins.
+    """
+    statements = []
+    execute_sql = sqlite_database.execute_sql
+
+    def recording_execute_sql(sql, *args, **kwargs):
+        statements.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(sqlite_database, 'execute_sql', recording_execute_sql)
+
+    songfinishes = [dict(SONGFINISH, title="Take {}".format(i))
+                    for i in range(250)]
+    songfinishes.append(dict(SONGFINISH, coverArt='http://example.com/new'))
+    bulk_update_db(songfinishes)
+
+    play_inserts = [sql for sql in statements
+                    if sql.startswith('INSERT INTO "play"')]
+    assert len(play_inserts) == 3
+    assert model.Play.select().count() == 251
+    assert model.Song.select().count() == 250
+    assert model.Album.get().cover_art == 'http://example.com/new'
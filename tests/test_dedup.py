@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+import pianodb.model as model
+from pianodb.dedup import DedupIndex, record_key
+from pianodb.pianodb import bulk_update_db
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+    'timestamp': '1500000000',
+}
+
+
+def test_records_are_keyed_by_identity_and_time():
+    """
+    Test that a record's key is its explicit ``key`` if it has one, is
+    otherwise derived from what was played where and when, and that records
+    without a timestamp have none.
+    """
+    key = record_key(SONGFINISH)
+
+    assert record_key(dict(SONGFINISH, timestamp=1500000000)) == key
+    assert record_key(dict(SONGFINISH, rating='1')) == key
+    assert record_key(dict(SONGFINISH, timestamp='1500000001')) != key
+    assert record_key(dict(SONGFINISH, stationName='Metal Radio')) != key
+    assert record_key(dict(SONGFINISH, key='abc')) == \
+        record_key(dict(SONGFINISH, key='abc', title='Take 6'))
+    assert len(key) == 32
+
+    untimed = dict(SONGFINISH)
+    del untimed['timestamp']
+    assert record_key(untimed) is None
+
+
+def test_records_are_claimed_once_per_ttl(sqlite_database):
+    """
+    Test that a replay written by another process is skipped even though this
+    one never saw it, and that expired keys are purged.
+    """
+    bulk_update_db([SONGFINISH], DedupIndex())
+
+    # A process that has not remembered the key still finds it.
+    dedup = DedupIndex(ttl=60)
+    assert dedup.duplicates([SONGFINISH]) == [True]
+    bulk_update_db([SONGFINISH, dict(SONGFINISH, timestamp='1500000310')],
+                   dedup)
+    assert model.Play.select().count() == 2
+
+    (model.IngestKey
+     .update(expires=datetime.now() - timedelta(seconds=1))
+     .execute())
+    dedup.purge()
+    assert model.IngestKey.select().count() == 0
@@ -0,0 +1,68 @@
+import csv
+import json
+from datetime import datetime
+
+import pytest
+
+import pianodb.model as model
+from pianodb.exporter import ENCODERS, export_plays, write_parquet
+from pianodb.pianodb import add_track_features, bulk_update_db
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '300',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+
+@pytest.fixture
+def history(sqlite_database):
+    bulk_update_db([dict(SONGFINISH, title='Take {}'.format(i),
+                         timestamp=int(datetime(2016, 11, 1 + i).timestamp()))
+                    for i in range(5)])
+    song = model.Song.get(model.Song.title == 'Take 0')
+    add_track_features(song.id, ['swing influences', 'acoustic sonority'])
+
+
+def test_export_streams_denormalized_plays(history):
+    """
+    Test that exported plays carry their song, album, artist, station and
+    features and can be limited to those since a timestamp.
+    """
+
+    lines = ''.join(ENCODERS['jsonl'](export_plays(chunk_size=2)))
+    rows = [json.loads(line) for line in lines.splitlines()]
+
+    assert [row['title'] for row in rows] == ['Take {}'.format(i)
+                                              for i in range(5)]
+    assert rows[0]['artist'] == 'The Great Jazz Trio'
+    assert rows[0]['song_duration'] == 310 and rows[0]['duration'] == 300
+    assert rows[0]['features'] == ['acoustic sonority', 'swing influences']
+
+    since = datetime(2016, 11, 4)
+    text = ''.join(ENCODERS['csv'](export_plays(since, chunk_size=2)))
+    rows = list(csv.DictReader(text.splitlines()))
+
+    assert [row['title'] for row in rows] == ['Take 3', 'Take 4']
+
+
+def test_export_writes_parquet(history, tmpdir):
+    """
+    Test that plays can be exported to a columnar Parquet file.
+    """
+
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    path = str(tmpdir.join('plays.parquet'))
+
+    write_parquet(export_plays(chunk_size=2), path)
+
+    table = pyarrow_parquet.read_table(path)
+    assert table.num_rows == 5
+    assert table.column('features').to_pylist()[0] == [
+        'acoustic sonority', 'swing influences']
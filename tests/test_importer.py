@@ -0,0 +1,144 @@
+import csv
+import json
+
+import pytest
+
+import pianodb.importer
+import pianodb.model as model
+from pianodb.importer import import_file
+
+RECORD = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '300',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+    'timestamp': '1478606400',
+}
+
+
+def write_records(path, file_format, records):
+    fields = list(RECORD)
+    with open(str(path), 'w', newline='') as f:
+        if file_format == 'keyvalue':
+            for record in records:
+                f.writelines("{}={}\n".format(k, record.get(k, ''))
+                             for k in fields)
+                f.write('\n')
+        elif file_format == 'jsonl':
+            f.writelines(json.dumps(record) + '\n' for record in records)
+        else:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(records)
+
+
+@pytest.mark.parametrize('file_format, filename', [
+    ('keyvalue', 'pianobar.log'),
+    ('jsonl', 'plays.jsonl'),
+    ('csv', 'plays.csv'),
+])
+def test_import_reads_every_format(sqlite_database, tmpdir, file_format,
+                                   filename):
+    """
+    Test that plays are imported from each format, guessed from the file
+    extension, and that incomplete records are skipped.
+    """
+
+    path = tmpdir.join(filename)
+    write_records(path, file_format, [
+        dict(RECORD, title='Take {}'.format(i), album='Album, {}'.format(i))
+        for i in range(5)
+    ] + [dict(RECORD, artist='')])
+
+    *_, (imported, skipped) = import_file(str(path), batch_size=2)
+
+    assert (imported, skipped) == (5, 1)
+    assert model.Play.select().count() == 5
+    assert model.Song.select().count() == 5
+    assert model.Artist.select().count() == 1
+
+
+def test_import_resumes_after_the_last_committed_batch(sqlite_database,
+                                                       tmpdir, monkeypatch):
+    """
+    Test that an interrupted import picks up after its last committed batch
+    without duplicating or losing plays.
+    """
+
+    path = tmpdir.join('plays.jsonl')
+    write_records(path, 'jsonl', [dict(RECORD, title='Take {}'.format(i))
+                                  for i in range(10)])
+
+    batches = []
+
+    def flaky_bulk_update_db(songfinishes):
+        batches.append(songfinishes)
+        if len(batches) == 3:
+            raise KeyboardInterrupt
+        model_bulk_update_db(songfinishes)
+
+    model_bulk_update_db = pianodb.importer.bulk_update_db
+    monkeypatch.setattr(pianodb.importer, 'bulk_update_db',
+                        flaky_bulk_update_db)
+
+    with pytest.raises(KeyboardInterrupt):
+        list(import_file(str(path), batch_size=3))
+    assert model.Play.select().count() == 6
+
+    list(import_file(str(path), batch_size=3))
+
+    titles = sorted(s.title for s in model.Song.select())
+    assert titles == sorted('Take {}'.format(i) for i in range(10))
+    assert model.Play.select().count() == 10
+
+
+def test_import_skips_malformed_lines(sqlite_database, tmpdir):
+    """
+    Test that lines that aren't JSON objects are skipped and counted rather
+    than aborting the import.
+    """
+    path = tmpdir.join('plays.jsonl')
+    path.write('\n'.join([
+        json.dumps(RECORD),
+        '{"artist": "The Great Jazz',
+        '["The Great Jazz Trio", "Take 5"]',
+        'null',
+        json.dumps(dict(RECORD, title='Take 6')),
+    ]) + '\n')
+
+    *_, (imported, skipped) = import_file(str(path), batch_size=2)
+
+    assert (imported, skipped) == (2, 3)
+    assert model.Play.select().count() == 2
+
+
+@pytest.mark.parametrize('field, value', [
+    ('timestamp', '1e20'),
+    ('timestamp', 'inf'),
+    ('timestamp', '-99999999999999'),
+    ('songDuration', '1e20'),
+    ('songPlayed', '86400'),
+    ('songPlayed', '-5'),
+])
+def test_import_skips_values_out_of_range(sqlite_database, tmpdir, field,
+                                          value):
+    """
+    Test that records with timestamps or durations that can't be stored are
+    skipped without rolling back the rest of their batch.
+    """
+    path = tmpdir.join('plays.jsonl')
+    write_records(path, 'jsonl', [
+        dict(RECORD, title='Take 5'),
+        dict(RECORD, title='Take 6', **{field: value}),
+        dict(RECORD, title='Take 7'),
+    ])
+
+    *_, (imported, skipped) = import_file(str(path))
+
+    assert (imported, skipped) == (2, 1)
+    assert sorted(s.title for s in model.Song.select()) == ['Take 5', 'Take 7']
@@ -0,0 +1,99 @@
+"""
+Startup benchmarks for the eventcmd entry point. pianobar runs ``pianodb``
+once per event, so process startup is paid for every song.
+
+The import budget can be adjusted for slow machines with the
+``PIANODB_IMPORT_BUDGET`` environment variable (in seconds).
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+IMPORT_BUDGET = float(os.environ.get('PIANODB_IMPORT_BUDGET', '0.25'))
+
+HEAVY_MODULES = (
+    'falcon',
+    'gunicorn',
+    'lxml',
+    'msgpack',
+    'peewee',
+    'playhouse',
+    'requests',
+    'ruamel.yaml',
+)
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+heavy = {heavy!r}
+print(json.dumps({{
+    'elapsed': elapsed,
+    'imported': sorted(m for m in heavy if m in sys.modules),
+    'click': 'click' in sys.modules,
+}}))
+"""
+
+
+def probe(statement):
+    """
+    Run ``statement`` in a fresh interpreter and report how long it took and
+    which heavy modules it imported.
+    """
+    code = PROBE.format(statement=statement, heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     env=dict(os.environ, LC_ALL='C.UTF-8',
+                                              LANG='C.UTF-8'))
+    return json.loads(output.decode('utf-8'))
+
+
+@pytest.mark.parametrize('module', ['pianodb.__main__', 'pianodb.cli'])
+def test_entry_point_imports_within_budget(module):
+    """
+    Test that importing the entry point pulls in none of the heavy modules and
+    fits within the import time budget.
+    """
+    result = probe("import {}".format(module))
+
+    assert result['imported'] == []
+    assert result['elapsed'] < IMPORT_BUDGET
+
+
+def test_dummy_events_short_circuit_before_importing_anything():
+    """
+    Test that dummy events return before even click is imported.
+    """
+    result = probe("sys.argv = ['pianodb', 'songban']\n"
+                   "import pianodb.__main__\n"
+                   "pianodb.__main__.main()")
+
+    assert not result['click']
+    assert result['imported'] == []
+
+
+def test_parsed_config_is_cached_until_the_file_changes(tmpdir, monkeypatch):
+    """
+    Test that the parsed config is reused from the cache while the config
+    file is unchanged and reparsed once it changes.
+    """
+    from unittest import mock
+    from pianodb.config import load_config
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    path = tmpdir.join('pianodb.yml')
+    path.write("---\nclient:\n    threshold: 20\n")
+
+    assert load_config(str(path))['client'] == {'threshold': 20}
+
+    with mock.patch('pianodb.pianodb.get_config') as get_config:
+        assert load_config(str(path))['client'] == {'threshold': 20}
+    assert not get_config.called
+
+    path.write("---\nclient:\n    threshold: 30\n    token: spam\n")
+
+    assert load_config(str(path))['client']['threshold'] == 30
@@ -0,0 +1,98 @@
+import json
+
+from falcon import API, testing
+
+import pianodb.model as model
+from pianodb.auth import Tokens
+from pianodb.cache import identity_map
+from pianodb.metrics import Registry, registry
+from pianodb.routes import MetricsComponent, ValidatorComponent, Metrics
+
+DEAD_PID = 2 ** 22 + 1  # Above the default pid_max, so never running.
+
+
+def test_histograms_are_exposed_with_cumulative_buckets():
+    """
+    Test that histogram observations are rendered as cumulative buckets with
+    their sum and count.
+    """
+
+    metrics = Registry()
+    histogram = metrics.histogram('latency_seconds', 'Latency.', ('stage',),
+                                  buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage='write')
+
+    lines = metrics.exposition().splitlines()
+
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{stage="write",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{stage="write",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{stage="write",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{stage="write"} 5.55' in lines
+    assert 'latency_seconds_count{stage="write"} 3' in lines
+
+
+def test_metrics_are_merged_across_processes(tmpdir):
+    """
+    Test that counters include processes that have exited but gauges only
+    count running processes.
+    """
+
+    metrics = Registry()
+    counter = metrics.counter('requests_total', 'Requests.')
+    gauge = metrics.gauge('in_flight', 'In flight.')
+    metrics.configure(str(tmpdir))
+
+    counter.inc(2)
+    gauge.inc()
+    tmpdir.join("{}.json".format(DEAD_PID)).write(json.dumps({
+        'requests_total': [[[], 3]],
+        'in_flight': [[[], 5]],
+    }))
+
+    lines = metrics.exposition().splitlines()
+
+    assert 'requests_total 5' in lines
+    assert 'in_flight 1' in lines
+
+
+def test_metrics_route_reports_requests():
+    """
+    Test that requests are timed and that /metrics is served without an
+    authentication token when public.
+    """
+
+    api = API(middleware=[MetricsComponent(),
+                          ValidatorComponent(Tokens({'default': 'secret'}),
+                                             public=['/metrics'])])
+    api.add_route('/metrics', Metrics())
+    client = testing.TestClient(api)
+
+    client.simulate_get('/metrics')
+    result = client.simulate_get('/metrics')
+
+    assert result.status_code == 200
+    assert result.headers['content-type'].startswith('text/plain')
+    assert ('pianodb_request_duration_seconds_count'
+            '{route="Metrics",method="GET",status="200"}') in result.text
+
+
+def test_identity_map_stats_are_exposed():
+    """
+    Test that the hits, misses and size of the identity map are reported per
+    model.
+    """
+
+    identity_map.invalidate(model.Station)
+    before = identity_map.stats().get('Station', {'hits': 0, 'misses': 0})
+    identity_map.set_many(model.Station, {('Jazz Radio',): 1})
+    identity_map.get_many(model.Station, [('Jazz Radio',), ('Blues Radio',)])
+
+    lines = registry.exposition().splitlines()
+    lookups = 'pianodb_identity_map_lookups{{model="Station",result="{}"}} {}'
+
+    assert '# TYPE pianodb_identity_map_lookups gauge' in lines
+    assert lookups.format('hits', before['hits'] + 1) in lines
+    assert lookups.format('misses', before['misses'] + 1) in lines
+    assert 'pianodb_identity_map_size{model="Station"} 1' in lines
@@ -0,0 +1,85 @@
+from datetime import time
+
+import pianodb.model as model
+from pianodb.migrations import (current_version, latest_version, migrate,
+                                pending_migrations)
+from pianodb.stats import top_artists, top_songs
+
+INDEXES = (
+    'album_artist_id_title',
+    'song_album_id_title',
+    'song_detail_url',
+    'play_timestamp_station_id',
+)
+
+
+def test_new_databases_need_no_migrations(sqlite_database):
+    """
+    Test that a freshly created database is stamped with the latest schema.
+    """
+
+    assert current_version() == latest_version()
+    assert not pending_migrations()
+    assert migrate() == []
+
+
+def test_migrations_merge_duplicates_before_indexing(sqlite_database):
+    """
+    Test that an old database is upgraded in place, its duplicate albums and
+    songs merged into the oldest row along with everything referencing them.
+    """
+
+    # Regress to the schema of a database created before any migrations.
+    for index in INDEXES:
+        sqlite_database.execute_sql('DROP INDEX {}'.format(index))
+    model.SchemaVersion.delete().execute()
+
+    artist = model.Artist.create(name='The Great Jazz Trio')
+    station = model.Station.create(name='Jazz Radio')
+    feature = model.Feature.create(text='swing influences')
+    albums = [model.Album.create(artist=artist, title="'S Wonderful")
+              for _ in range(2)]
+    songs = [model.Song.create(album=album, title='Take 5',
+                               duration=time(0, 5, 10), detail_url='http://x')
+             for album in albums]
+    for song in songs:
+        model.Play.create(station=station, song=song, duration=time(0, 5))
+        model.SongFeature.create(feature=feature, song=song)
+        model.StationSong.create(station=station, song=song)
+
+    assert migrate() == [1, 2, 3]
+
+    assert not pending_migrations()
+    assert [a.id for a in model.Album.select()] == [albums[0].id]
+    assert [s.id for s in model.Song.select()] == [songs[0].id]
+    assert model.SongFeature.select().count() == 1
+    assert model.StationSong.select().count() == 1
+    assert {p.song_id for p in model.Play.select()} == {songs[0].id}
+    assert list(top_songs()) == [('Take 5', 'The Great Jazz Trio', 2, 600)]
+
+    indexes = {index.name for table in ('album', 'song', 'play')
+               for index in sqlite_database.get_indexes(table)}
+    assert indexes.issuperset(INDEXES)
+
+
+def test_migrations_fill_rollups_of_existing_plays(sqlite_database):
+    """
+    Test that upgrading a database whose Plays predate the rollup tables
+    fills them in, even when there were no duplicates to merge.
+    """
+
+    artist = model.Artist.create(name='The Great Jazz Trio')
+    station = model.Station.create(name='Jazz Radio')
+    album = model.Album.create(artist=artist, title="'S Wonderful")
+    song = model.Song.create(album=album, title='Take 5',
+                             duration=time(0, 5, 10), detail_url='http://x')
+    model.Play.create(station=station, song=song, duration=time(0, 5))
+
+    # Regress to the last version before the rollups were filled.
+    model.SchemaVersion.delete().where(
+        model.SchemaVersion.version > 2).execute()
+
+    assert list(top_artists()) == []
+    assert migrate() == [3]
+    assert list(top_artists()) == [('The Great Jazz Trio', 1, 300)]
+    assert list(top_songs()) == [('Take 5', 'The Great Jazz Trio', 1, 300)]
@@ -0,0 +1,71 @@
+import json
+import logging
+
+import pianodb.model as model
+from pianodb.pianodb import bulk_update_db
+from pianodb.profiler import QueryProfiler, statement_shape
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+
+def test_statement_shapes_ignore_the_length_of_placeholder_lists():
+    """
+    Test that statements differing only in how many values they bind have
+    the same shape.
+    """
+
+    assert statement_shape('SELECT id FROM song WHERE id IN (?, ?)') == \
+        statement_shape('SELECT id FROM song WHERE id IN (?, ?, ?)')
+    assert statement_shape('INSERT INTO play (a, b) VALUES (?, ?), (?, ?)') == \
+        statement_shape('INSERT INTO play (a, b) VALUES (?, ?)')
+
+
+def test_profiler_records_statements_with_rows(sqlite_database):
+    """
+    Test that every statement of a request is recorded with the rows it
+    returned or changed.
+    """
+
+    profiler = QueryProfiler(slow=60)
+    profiler.instrument(sqlite_database)
+
+    profiler.start()
+    bulk_update_db([SONGFINISH])
+    list(model.Play.select())
+    profile = profiler.stop('test')
+
+    assert profile['queries'] == len(profile['statements']) > 1
+    assert profile['repeated'] == []
+    assert profile['statements'][-1]['rows'] == 1
+    assert any(s['sql'].startswith('INSERT') and s['rows'] == 1
+               for s in profile['statements'])
+
+
+def test_profiler_logs_repeated_statements(sqlite_database, caplog):
+    """
+    Test that a request running the same statement over and over is logged
+    as an N+1 pattern even when it is fast.
+    """
+
+    profiler = QueryProfiler(slow=60, repeated=3)
+    profiler.instrument(sqlite_database)
+
+    with caplog.at_level(logging.WARNING, logger='pianodb.profiler'):
+        profiler.start()
+        for pk in range(4):
+            list(model.SongFeature.select().where(model.SongFeature.song == pk))
+        profiler.stop('test')
+
+    profile = json.loads(caplog.records[-1].getMessage())
+    assert profile['request'] == 'test'
+    assert profile['repeated'][0]['count'] == 4
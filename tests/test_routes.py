@@ -1,38 +1,91 @@
+import gzip
+
 import pytest
 import msgpack
 from falcon import API, testing
 
-from pianodb.routes import ValidatorComponent, SongFinish
+import pianodb.model as model
+import pianodb.routes
+from pianodb.auth import Tokens
+from pianodb.dedup import DedupIndex
+from pianodb.pianodb import bulk_update_db
+from pianodb.routes import (ValidatorComponent, SongFinish, SongFinishBatch,
+                            Plays, StationSongs, Export, Search)
+from pianodb.wire import pack
 
 
 TOKEN = 'CB80CB12CC0F41FC87CA6F2AC989E27E'
+TOKENS = Tokens({'default': TOKEN, 'laptop': '0B4F7E1D9A2C4F6B8E3D5A7C9B1E2F40'})
 API_PREFIX = '/api/v1'
 SONGFINISH_ROUTE = "{API_PREFIX}/songfinish".format(API_PREFIX=API_PREFIX)
+BATCH_ROUTE = "{SONGFINISH_ROUTE}/batch".format(SONGFINISH_ROUTE=SONGFINISH_ROUTE)
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
 
 
 @pytest.fixture(scope='module')
 def client():
 
-    api = API(middleware=ValidatorComponent())
-    api.add_route(SONGFINISH_ROUTE, SongFinish(token=TOKEN))
+    api = API(middleware=ValidatorComponent(TOKENS))
+    api.add_route(SONGFINISH_ROUTE, SongFinish())
+    api.add_route(BATCH_ROUTE, SongFinishBatch())
 
     return testing.TestClient(api)
 
 
-def test_songfinish_requires_auth_token(client):
+@pytest.mark.parametrize('headers', [
+    {},
+    {'X-Auth-Token': TOKEN[:-1]},
+    {'X-Auth-Token': TOKEN + '0'},
+])
+def test_songfinish_requires_auth_token(client, monkeypatch, headers):
     """
-    TODO: Document this test.
+    Test that requests without one of the configured tokens are refused
+    before their payload is read or anything is written.
     """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
 
     expected = dict(
         title='Authentication required',
         description='Missing or invalid authentication token',
     )
 
-    result = client.simulate_post(path=SONGFINISH_ROUTE)
+    headers['Content-Type'] = 'application/msgpack'
+    result = client.simulate_post(path=SONGFINISH_ROUTE, headers=headers,
+                                  body=msgpack.packb(SONGFINISH))
 
     assert result.status_code == 401  # HTTP 401 Unauthorized
     assert result.json == expected
+    assert written == []
+
+
+def test_songfinish_accepts_every_configured_token(client, monkeypatch):
+    """
+    Test that each client's token is accepted.
+    """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
+
+    for token in (TOKEN, '0B4F7E1D9A2C4F6B8E3D5A7C9B1E2F40'):
+        result = client.simulate_post(path=SONGFINISH_ROUTE,
+                                      body=msgpack.packb(SONGFINISH),
+                                      headers={
+                                          'X-Auth-Token': token,
+                                          'Content-Type': 'application/msgpack',
+                                      })
+        assert result.status_code == 201  # HTTP 201 Created
+
+    assert written == [[SONGFINISH], [SONGFINISH]]
 
 
 def test_songfinish_requires_msgpack_payloads(client):
@@ -78,5 +131,315 @@ def test_songfinish_requires_valid_msgpack_payloads(client):
     assert result.json == expected
 
 
+@pytest.mark.parametrize('body', [
+    msgpack.packb([SONGFINISH, {'artist': 'John Cleese'}, 'spam']),
+    b''.join(msgpack.packb(r) for r in
+             [SONGFINISH, {'artist': 'John Cleese'}, 'spam']),
+])
+def test_songfinish_batch_reports_per_record_results(client, monkeypatch, body):
+    """
+    Test that the batch route accepts both a msgpack array and a stream of
+    concatenated msgpack records, writes the valid records in one call and
+    reports a result for every record.
+    """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
+
+    expected = {'results': [
+        {'created': True},
+        {'created': False, 'error': 'Missing required songfinish field'},
+        {'created': False, 'error': 'Invalid datatype'},
+    ]}
+
+    result = client.simulate_post(path=BATCH_ROUTE,
+                                  body=body,
+                                  headers={
+                                      'X-Auth-Token': TOKEN,
+                                      'Content-Type': 'application/msgpack',
+                                  })
+
+    assert result.status_code == 201  # HTTP 201 Created
+    assert msgpack.unpackb(result.content, encoding='utf-8') == expected
+    assert written == [[SONGFINISH]]
+
+
+@pytest.mark.parametrize('field, value', [
+    ('songPlayed', 'abc'),
+    ('songDuration', None),
+    ('songPlayed', '-5'),
+    ('songDuration', '86400'),
+    ('timestamp', 'yesterday'),
+    ('timestamp', 10 ** 15),
+    ('artist', None),
+    ('stationName', 42),
+])
+def test_songfinish_batch_reports_invalid_values(client, monkeypatch, field,
+                                                 value):
+    """
+    Test that a record with a malformed value is reported as such without
+    keeping the rest of the batch from being written.
+    """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
+
+    result = client.simulate_post(path=BATCH_ROUTE,
+                                  body=msgpack.packb([
+                                      SONGFINISH,
+                                      dict(SONGFINISH, **{field: value}),
+                                  ]),
+                                  headers={
+                                      'X-Auth-Token': TOKEN,
+                                      'Content-Type': 'application/msgpack',
+                                  })
+
+    assert result.status_code == 201  # HTTP 201 Created
+    assert msgpack.unpackb(result.content, encoding='utf-8') == {'results': [
+        {'created': True},
+        {'created': False,
+         'error': "Invalid songfinish field '{}'".format(field)},
+    ]}
+    assert written == [[SONGFINISH]]
+
+
+@pytest.mark.parametrize('field, value', [
+    ('songPlayed', '-5'),
+    ('songPlayed', 90000),
+    ('songDuration', '86400'),
+])
+def test_songfinish_refuses_durations_out_of_range(client, monkeypatch, field,
+                                                   value):
+    """
+    Test that durations that are negative or a day or longer, which can't be
+    stored as times of day, are refused with a 400.
+    """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
+
+    result = client.simulate_post(path=SONGFINISH_ROUTE,
+                                  body=msgpack.packb(
+                                      dict(SONGFINISH, **{field: value})),
+                                  headers={
+                                      'X-Auth-Token': TOKEN,
+                                      'Content-Type': 'application/msgpack',
+                                  })
+
+    assert result.status_code == 400
+    assert result.json['description'] == \
+        "Invalid songfinish field '{}'".format(field)
+    assert written == []
+
+
+def test_songfinish_batch_accepts_gzipped_payloads(client, monkeypatch):
+    """
+    Test that the batch route decompresses payloads sent with a gzip
+    ``Content-Encoding``.
+    """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
+
+    result = client.simulate_post(path=BATCH_ROUTE,
+                                  body=gzip.compress(msgpack.packb([SONGFINISH])),
+                                  headers={
+                                      'X-Auth-Token': TOKEN,
+                                      'Content-Type': 'application/msgpack',
+                                      'Content-Encoding': 'gzip',
+                                  })
+
+    assert result.status_code == 201  # HTTP 201 Created
+    assert written == [[SONGFINISH]]
+
+
+@pytest.mark.parametrize('route, records', [
+    (SONGFINISH_ROUTE, [SONGFINISH]),
+    (BATCH_ROUTE, [SONGFINISH, dict(SONGFINISH, title='Take 6')]),
+])
+def test_songfinish_routes_accept_compact_payloads(client, monkeypatch, route,
+                                                   records):
+    """
+    Test that both songfinish routes accept the compact wire format as well
+    as msgpack maps.
+    """
+    written = []
+    monkeypatch.setattr(pianodb.routes, 'bulk_update_db', written.append)
+
+    result = client.simulate_post(path=route,
+                                  body=pack(records),
+                                  headers={
+                                      'X-Auth-Token': TOKEN,
+                                      'Content-Type': 'application/msgpack',
+                                  })
+
+    assert result.status_code == 201  # HTTP 201 Created
+    assert [r for batch in written for r in batch] == records
+
+
+def test_retried_songfinishes_are_written_once(sqlite_database):
+    """
+    Test that replays of timestamped records, or of requests with the same
+    ``Idempotency-Key``, are acknowledged without being written again.
+    """
+    api = API(middleware=ValidatorComponent(TOKENS))
+    dedup = DedupIndex()
+    api.add_route(SONGFINISH_ROUTE, SongFinish(dedup=dedup))
+    api.add_route(BATCH_ROUTE, SongFinishBatch(dedup=dedup))
+    client = testing.TestClient(api)
+    headers = {'X-Auth-Token': TOKEN, 'Content-Type': 'application/msgpack'}
+
+    played = dict(SONGFINISH, timestamp='1500000000')
+    results = [client.simulate_post(path=SONGFINISH_ROUTE, headers=headers,
+                                    body=msgpack.packb(played))
+               for _ in range(2)]
+    assert [r.status_code for r in results] == [201, 200]
+    assert msgpack.unpackb(results[1].content, encoding='utf-8') == \
+        {'created': False, 'duplicate': True}
+
+    later = dict(played, timestamp='1500000310')
+    result = client.simulate_post(path=BATCH_ROUTE, headers=headers,
+                                  body=msgpack.packb([played, later, later]))
+    assert msgpack.unpackb(result.content, encoding='utf-8') == {'results': [
+        {'created': False, 'duplicate': True},
+        {'created': True},
+        {'created': False, 'duplicate': True},
+    ]}
+
+    headers['Idempotency-Key'] = 'retry-me'
+    results = [client.simulate_post(path=SONGFINISH_ROUTE, headers=headers,
+                                    body=msgpack.packb(SONGFINISH))
+               for _ in range(2)]
+    assert [r.status_code for r in results] == [201, 200]
+
+    assert model.Play.select().count() == 3
+
+
+def test_invalid_songfinishes_are_refused_before_dedup(sqlite_database):
+    """
+    Test that a record whose timestamp can't be keyed is refused as a bad
+    request rather than failing while its dedup key is derived.
+    """
+    api = API(middleware=ValidatorComponent(TOKENS))
+    dedup = DedupIndex()
+    api.add_route(SONGFINISH_ROUTE, SongFinish(dedup=dedup))
+    api.add_route(BATCH_ROUTE, SongFinishBatch(dedup=dedup))
+    client = testing.TestClient(api)
+    headers = {'X-Auth-Token': TOKEN, 'Content-Type': 'application/msgpack'}
+    invalid = dict(SONGFINISH, timestamp='yesterday')
+    error = "Invalid songfinish field 'timestamp'"
+
+    result = client.simulate_post(path=SONGFINISH_ROUTE, headers=headers,
+                                  body=msgpack.packb(invalid))
+    assert result.status_code == 400
+    assert result.json['description'] == error
+
+    result = client.simulate_post(path=BATCH_ROUTE, headers=headers,
+                                  body=msgpack.packb([invalid]))
+    assert msgpack.unpackb(result.content, encoding='utf-8') == \
+        {'results': [{'created': False, 'error': error}]}
+    assert model.Play.select().count() == 0
+
+
 # TODO: Test remaining branches and investigate msgpack.exceptions.ExtraData or
 # UnicodeDecodeError errors when given a non-msgpack request body.
+
+
+@pytest.fixture
+def read_client(sqlite_database):
+
+    api = API(middleware=ValidatorComponent(TOKENS))
+    api.add_route(API_PREFIX + '/plays', Plays())
+    api.add_route(API_PREFIX + '/stations/{station}/songs',
+                  StationSongs())
+    api.add_route(API_PREFIX + '/export', Export())
+    api.add_route(API_PREFIX + '/search', Search())
+
+    return testing.TestClient(api)
+
+
+def test_plays_are_paginated_with_cursors(read_client):
+    """
+    Walking the cursors visits every Play exactly once, in order, whether the
+    pages are JSON or msgpack.
+    """
+
+    bulk_update_db([dict(SONGFINISH, title='Take {}'.format(i),
+                         timestamp=str(1500000000 + i // 2))
+                    for i in range(7)])
+
+    seen, params = [], {'limit': 3}
+    for accept in ('application/json', 'application/msgpack') * 2:
+        result = read_client.simulate_get(API_PREFIX + '/plays',
+                                          params=params,
+                                          headers={'X-Auth-Token': TOKEN,
+                                                   'Accept': accept})
+        assert result.status_code == 200
+        assert result.headers['content-type'] == accept
+
+        if accept == 'application/json':
+            page = result.json
+        else:
+            page = msgpack.unpackb(result.content, encoding='utf-8')
+        seen.extend(play['title'] for play in page['items'])
+        if page['next'] is None:
+            break
+        params = {'limit': 3, 'cursor': page['next']}
+
+    assert seen == ['Take {}'.format(i) for i in range(7)]
+
+
+@pytest.mark.parametrize('accept, media_type', [
+    (None, 'application/json'),
+    ('*/*', 'application/json'),
+    ('application/msgpack, application/json', 'application/json'),
+    ('application/msgpack', 'application/msgpack'),
+    ('application/msgpack, application/json;q=0.5', 'application/msgpack'),
+])
+def test_read_routes_respond_with_json_unless_msgpack_is_preferred(
+        read_client, accept, media_type):
+    """
+    Test that pages are JSON when the client accepts either media type and
+    msgpack only when it is asked for.
+    """
+    headers = {'X-Auth-Token': TOKEN}
+    if accept is not None:
+        headers['Accept'] = accept
+
+    result = read_client.simulate_get(API_PREFIX + '/plays', headers=headers)
+
+    assert result.status_code == 200
+    assert result.headers['content-type'] == media_type
+
+
+@pytest.mark.parametrize('path, params, status', [
+    ('/plays', {'cursor': 'not a cursor'}, 400),
+    ('/plays', {'since': 'yesterday'}, 400),
+    ('/plays', {'limit': '100000'}, 400),
+    ('/stations/Nowhere/songs', {}, 404),
+    ('/export', {'format': 'xlsx'}, 400),
+    ('/search', {}, 400),
+    ('/search', {'q': 'take', 'type': 'planet'}, 400),
+])
+def test_read_routes_reject_invalid_queries(read_client, path, params, status):
+    """
+    Malformed cursors, filters and limits are client errors, as is asking for
+    the songs of a Station that does not exist.
+    """
+
+    result = read_client.simulate_get(API_PREFIX + path, params=params,
+                                      headers={'X-Auth-Token': TOKEN})
+
+    assert result.status_code == status
+
+
+def test_export_route_streams_csv(read_client):
+    """
+    The export route streams every play as CSV on request.
+    """
+
+    bulk_update_db([SONGFINISH, dict(SONGFINISH, title='Take 6')])
+
+    result = read_client.simulate_get(API_PREFIX + '/export',
+                                      params={'format': 'csv'},
+                                      headers={'X-Auth-Token': TOKEN})
+
+    assert result.status_code == 200
+    assert result.headers['content-type'] == 'text/csv'
+    assert len(result.text.splitlines()) == 3
@@ -0,0 +1,152 @@
+from datetime import datetime
+
+import pytest
+import requests
+
+import pianodb.model as model
+from pianodb.pianodb import update_db
+from pianodb.scraper import (ScrapeError, ScrapeWorkerPool, claim_job,
+                             fetch_track_features)
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+PAGE = b"""
+<div class="song_features clearfix">
+  <h2>Features of This Track</h2>
+  a piano solo<br>
+  vamping harmony<br>
+</div>
+"""
+
+
+class MockPage:
+    def __init__(self, status_code=200, content=PAGE):
+        self.status_code = status_code
+        self.content = content
+
+
+class MockSession:
+    def __init__(self, *pages):
+        self.pages = list(pages)
+        self.requested = []
+
+    def get(self, url, timeout=None):
+        self.requested.append(url)
+        page = self.pages.pop(0)
+        if isinstance(page, Exception):
+            raise page
+        return page
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('page, expected', [
+    (MockPage(), ['a piano solo', 'vamping harmony']),
+    (MockPage(status_code=404, content=b''), []),
+])
+def test_scraper_can_fetch_track_features(page, expected):
+    """
+    Test that the scraper parses detail pages and treats missing pages as
+    having no features.
+    """
+    session = MockSession(page)
+
+    assert fetch_track_features('https://fake-url.tld', session) == expected
+
+
+@pytest.mark.parametrize('page', [
+    MockPage(status_code=503, content=b''),
+    requests.ConnectionError(),
+])
+def test_scraper_raises_on_transient_failures(page):
+    """
+    Test that the scraper raises ``ScrapeError`` for failures worth retrying.
+    """
+    with pytest.raises(ScrapeError):
+        fetch_track_features('https://fake-url.tld', MockSession(page))
+
+
+def test_scraper_attaches_features_to_queued_songs(sqlite_database,
+                                                   monkeypatch):
+    """
+    Test that draining the queue attaches Features to the Song and finishes
+    its job.
+    """
+    session = MockSession(MockPage())
+    monkeypatch.setattr(requests, 'Session', lambda: session)
+
+    update_db(SONGFINISH)
+    ScrapeWorkerPool(workers=1).run(once=True)
+
+    song = model.Song.get()
+    job = model.ScrapeJob.get()
+
+    assert sorted(f.text for f in song.features) == ['a piano solo',
+                                                     'vamping harmony']
+    assert job.finished is not None
+    assert session.requested == [SONGFINISH['detailUrl']]
+
+
+def test_scraper_backs_off_after_transient_failures(sqlite_database,
+                                                    monkeypatch):
+    """
+    Test that a failed job is released with a later ``next_attempt`` and is
+    given up on after ``max_attempts``.
+    """
+    session = MockSession(requests.ConnectionError())
+    monkeypatch.setattr(requests, 'Session', lambda: session)
+
+    update_db(SONGFINISH)
+    ScrapeWorkerPool(workers=1, max_attempts=2).run(once=True)
+
+    job = model.ScrapeJob.get()
+
+    assert job.attempts == 1
+    assert job.finished is None
+    assert job.next_attempt > datetime.now()
+    assert claim_job(lease=60) is None
+
+
+def test_scraper_does_not_refetch_cached_pages(sqlite_database, monkeypatch):
+    """
+    Test that Songs sharing a detail page only cause a single fetch.
+    """
+    session = MockSession(MockPage())
+    monkeypatch.setattr(requests, 'Session', lambda: session)
+
+    update_db(SONGFINISH)
+    update_db(dict(SONGFINISH, album='Collected Works'))
+    ScrapeWorkerPool(workers=1).run(once=True)
+
+    assert model.SongFeature.select().count() == 4
+    assert session.requested == [SONGFINISH['detailUrl']]
+
+
+def test_scraper_survives_unparseable_pages(sqlite_database, monkeypatch):
+    """
+    Test that a page that can't be parsed fails its job like an unavailable
+    one would, and that the worker goes on to the next job.
+    """
+    session = MockSession(MockPage(content=b''), MockPage())
+    monkeypatch.setattr(requests, 'Session', lambda: session)
+
+    update_db(SONGFINISH)
+    update_db(dict(SONGFINISH, title='Take 6', detailUrl='http://fake/6'))
+    ScrapeWorkerPool(workers=1).run(once=True)
+
+    bad, good = model.ScrapeJob.select().order_by(model.ScrapeJob.id)
+
+    assert (bad.attempts, bad.finished, bad.claimed_until) == (1, None, None)
+    assert 'empty' in bad.last_error
+    assert good.finished is not None
@@ -0,0 +1,100 @@
+import pytest
+from peewee import OperationalError
+
+import pianodb.model as model
+from pianodb.pianodb import add_track_features, bulk_update_db
+from pianodb.search import (KINDS, InvalidSearch, backend, create_search_index,
+                            fts_table, rebuild_search_index, search)
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+
+def test_ingested_names_are_searchable_by_prefix(sqlite_database):
+    """
+    Test that names written by ingestion and scraping are found by prefixes
+    of their words, closest matches first.
+    """
+
+    bulk_update_db([SONGFINISH,
+                    dict(SONGFINISH, title='Take 50'),
+                    dict(SONGFINISH, title='Take Five', artist='Dave Brubeck',
+                         album='Time Out')])
+    song = model.Song.get(model.Song.title == 'Take 5')
+    add_track_features(song.id, ['swing influences'])
+
+    assert [(r['type'], r['title']) for r in search('tak 5')] == [
+        ('song', 'Take 5'), ('song', 'Take 50')]
+    assert [r['type'] for r in search('jazz trio')] == ['artist']
+    assert search('swing', kinds=('feature',)) == [
+        {'type': 'feature', 'id': 1, 'text': 'swing influences',
+         'score': search('swing')[0]['score']}]
+    assert search('brubeck time', kinds=('album', 'song')) == []
+
+
+def test_deleted_rows_are_not_found(sqlite_database):
+    """
+    Test that rows deleted since they were indexed are never returned, and
+    are dropped from the index by a rebuild.
+    """
+
+    bulk_update_db([SONGFINISH])
+    add_track_features(model.Song.get().id, ['swing influences'])
+    model.SongFeature.delete().execute()
+    model.Feature.delete().execute()
+
+    assert search('swing') == []
+
+    rebuild_search_index()
+
+    indexed = sqlite_database.execute_sql('SELECT count(*) FROM search_feature')
+    assert indexed.fetchone() == (0,)
+
+
+@pytest.mark.parametrize('text, kinds', [
+    ('!?', ('song',)),
+    ('take', ('planet',)),
+])
+def test_invalid_searches_are_rejected(sqlite_database, text, kinds):
+    """
+    Test that queries without words or for unknown kinds are rejected.
+    """
+
+    with pytest.raises(InvalidSearch):
+        search(text, kinds)
+
+
+def test_search_scans_without_fts5(sqlite_database, monkeypatch):
+    """
+    Test that SQLite builds without FTS5 get no search index, and that
+    searches fall back to scanning the names.
+    """
+
+    for kind in KINDS:
+        sqlite_database.execute_sql("DROP TABLE {}".format(fts_table(kind)))
+
+    execute_sql = sqlite_database.execute_sql
+
+    def without_fts5(sql, *args, **kwargs):
+        if 'USING fts5' in sql:
+            raise OperationalError('no such module: fts5')
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(sqlite_database, 'execute_sql', without_fts5)
+    create_search_index()
+
+    assert backend() is None
+
+    bulk_update_db([SONGFINISH, dict(SONGFINISH, title='Take 50')])
+
+    assert [r['title'] for r in search('tak 5', kinds=('song',))] == [
+        'Take 5', 'Take 50']
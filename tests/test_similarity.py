@@ -0,0 +1,136 @@
+import pytest
+
+import pianodb.model as model
+from pianodb.pianodb import add_track_features, bulk_update_db
+from pianodb.queries import station_song_ids
+
+similarity = pytest.importorskip('pianodb.similarity')
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+FEATURES = {
+    'Take 5': ['jazz', 'piano', 'swing', 'odd meter'],
+    'Take 6': ['jazz', 'piano', 'swing'],
+    'Take 7': ['jazz', 'brass'],
+    'Paranoid': ['rock', 'electric guitar'],
+}
+
+
+@pytest.fixture
+def songs(sqlite_database):
+    bulk_update_db([dict(SONGFINISH, title='Take 5'),
+                    dict(SONGFINISH, title='Take 6'),
+                    dict(SONGFINISH, title='Take 7'),
+                    dict(SONGFINISH, title='Paranoid', artist='Black Sabbath',
+                         album='Paranoid', stationName='Metal Radio')])
+    return {song.title: song.id for song in model.Song.select()}
+
+
+def add_features(songs, *titles):
+    for title in titles:
+        add_track_features(songs[title], FEATURES[title])
+
+
+def test_similar_songs_are_ranked_by_shared_features(songs):
+    """
+    Test that songs are scored by cosine or Jaccard similarity of their
+    features, best first, and that songs sharing nothing are left out.
+    """
+    add_features(songs, *FEATURES)
+
+    index = similarity.SimilarityIndex()
+    index.update()
+
+    assert index.similar_songs(songs['Take 5']) == [
+        (songs['Take 6'], 0.866025), (songs['Take 7'], 0.353553)]
+    assert index.similar_songs(songs['Take 5'], metric='jaccard') == [
+        (songs['Take 6'], 0.75), (songs['Take 7'], 0.2)]
+    assert index.similar_songs(songs['Take 5'], limit=1) == [
+        (songs['Take 6'], 0.866025)]
+
+    with pytest.raises(similarity.NotIndexed):
+        index.similar_songs(max(songs.values()) + 1)
+
+
+def test_updated_indexes_match_rebuilt_ones(songs, tmpdir):
+    """
+    Test that an index saved, reloaded and updated with new features answers
+    like one built from scratch.
+    """
+    path = str(tmpdir.join('similarity'))
+    add_features(songs, 'Take 5', 'Paranoid')
+    similarity.update_index(path)
+    add_features(songs, 'Take 6', 'Take 7')
+
+    updated = similarity.update_index(path)
+    rebuilt = similarity.update_index(str(tmpdir.join('rebuilt')),
+                                      rebuild=True)
+    loaded = similarity.SimilarityIndex.load(path)
+
+    for title in FEATURES:
+        assert loaded.similar_songs(songs[title]) == \
+            rebuilt.similar_songs(songs[title]) == \
+            updated.similar_songs(songs[title])
+    assert loaded.generation == 2
+
+
+def test_rows_committed_below_the_watermark_are_indexed(songs):
+    """
+    Test that rows committed after rows with higher ids, and rows removed
+    when songs are merged, are reflected by the next update.
+    """
+    add_features(songs, 'Take 5')
+    jazz = model.Feature.get(model.Feature.text == 'jazz').id
+    model.SongFeature.insert(id=100, song=songs['Take 6'],
+                             feature=jazz).execute()
+
+    index = similarity.SimilarityIndex()
+    index.update()
+    assert index.watermark == 100
+
+    # A transaction that took a lower id commits after the update.
+    model.SongFeature.insert(id=50, song=songs['Take 7'],
+                             feature=jazz).execute()
+
+    assert index.update()
+    assert index.similar_songs(songs['Take 5']) == sorted([
+        (songs['Take 6'], 0.5), (songs['Take 7'], 0.5)])
+
+    model.SongFeature.delete().where(
+        model.SongFeature.song == songs['Take 6']).execute()
+
+    assert index.update()
+    assert index.similar_songs(songs['Take 5']) == [(songs['Take 7'], 0.5)]
+    with pytest.raises(similarity.NotIndexed):
+        index.row(songs['Take 6'])
+    assert not index.update()
+
+
+def test_artists_and_stations_are_profiled(songs):
+    """
+    Test that artists are compared by their songs' features and that a
+    station's profile is the share of its songs having each feature.
+    """
+    add_features(songs, *FEATURES)
+    add_track_features(songs['Paranoid'], ['swing'])
+
+    index = similarity.SimilarityIndex()
+    index.update()
+
+    trio, sabbath = (model.Artist.get(model.Artist.name == name).id
+                     for name in ('The Great Jazz Trio', 'Black Sabbath'))
+    assert [pk for pk, _ in index.similar_artists(sabbath)] == [trio]
+
+    station = model.Station.get(model.Station.name == 'Jazz Radio')
+    assert index.feature_profile(station_song_ids(station.id), limit=3) == [
+        ('jazz', 1.0), ('piano', 0.666667), ('swing', 0.666667)]
@@ -0,0 +1,116 @@
+import msgpack
+import pytest
+
+from pianodb.client import RemoteClient, rejected_spool
+from pianodb.spool import Spool, flush_spool, pack_frame, unpack_frames
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+    'timestamp': 1478563200,
+}
+
+
+def test_spool_ignores_partial_trailing_frames():
+    """
+    Test that a frame cut short by an interrupted write is not unpacked.
+    """
+    data = pack_frame(SONGFINISH) + pack_frame(SONGFINISH)[:-3]
+
+    assert [r for _, r in unpack_frames(data)] == [SONGFINISH]
+
+
+def test_spool_flushes_in_batches_and_discards_acknowledged_records(tmpdir):
+    """
+    Test that flushing sends spooled records in batches and only discards the
+    batches that were acknowledged.
+    """
+    spool = Spool(str(tmpdir.join('pianodb.spool')))
+    for played in range(5):
+        spool.append(dict(SONGFINISH, songPlayed=str(played)))
+
+    sent = []
+
+    def _send(batch):
+        sent.append([r['songPlayed'] for r in batch])
+        return len(sent) < 3  # The third batch fails.
+
+    assert flush_spool(spool, _send, batch_size=2) == 4
+    assert sent == [['0', '1'], ['2', '3'], ['4']]
+    assert [r['songPlayed'] for _, r in spool.records()] == ['4']
+
+    assert flush_spool(spool, lambda batch: True, batch_size=2) == 1
+    assert list(spool.records()) == []
+
+
+class Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = msgpack.packb(body)
+        self.headers = {}
+
+
+class Server:
+    """
+    Answers batches like the server, refusing whole batches with a bad
+    ``album`` and single records with a bad ``songPlayed``.
+    """
+
+    def post(self, url, data, headers, timeout):
+        batch = msgpack.unpackb(data, encoding='utf-8')
+        if any(r['album'] == 'bad' for r in batch):
+            return Response(400, {'title': 'Bad request'})
+        return Response(201, {'results': [
+            {'created': False, 'error': 'Invalid songfinish field'}
+            if r['songPlayed'] == 'bad' else {'created': True}
+            for r in batch]})
+
+
+def test_spool_sets_aside_records_the_server_rejects(tmpdir):
+    """
+    Test that records the server will never accept, alone or with their
+    batch, are moved to the rejected spool instead of blocking the spool.
+    """
+    spool = Spool(str(tmpdir.join('pianodb.spool')))
+    records = [SONGFINISH, dict(SONGFINISH, songPlayed='bad'),
+               dict(SONGFINISH, album='bad'), dict(SONGFINISH, title='Take 6')]
+    for record in records:
+        spool.append(record)
+
+    remote = RemoteClient({'remote': {'host': 'localhost', 'port': 8080},
+                           'token': 'spam'},
+                          session=Server(), rejected=rejected_spool(spool))
+
+    assert flush_spool(spool, remote.send, batch_size=2) == 4
+    assert list(spool.records()) == []
+    assert [r for _, r in rejected_spool(spool).records()] == records[1:]
+
+
+@pytest.mark.parametrize('status_code', [401, 404, 405, 429, 501, 503])
+def test_spool_keeps_records_the_server_may_accept_later(tmpdir,
+                                                         status_code):
+    """
+    Test that a batch refused for reasons other than its payload, such as a
+    server without the batch endpoint, stays in the spool to be resent.
+    """
+    class Refusing:
+        def post(self, url, data, headers, timeout):
+            return Response(status_code, {'title': 'Refused'})
+
+    spool = Spool(str(tmpdir.join('pianodb.spool')))
+    spool.append(SONGFINISH)
+    remote = RemoteClient({'remote': {'host': 'localhost', 'port': 8080},
+                           'token': 'spam'},
+                          session=Refusing(), rejected=rejected_spool(spool))
+
+    assert flush_spool(spool, remote.send) == 0
+    assert [r for _, r in spool.records()] == [SONGFINISH]
+    assert list(rejected_spool(spool).records()) == []
@@ -0,0 +1,129 @@
+from datetime import date, datetime
+
+import pianodb.model as model
+from pianodb.pianodb import bulk_update_db
+from pianodb.queries import plays
+from pianodb.stats import (ROLLUPS, rebuild_stats, top_artists, top_songs,
+                           top_stations, plays_per_day)
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '300',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+    'timestamp': int(datetime(2016, 11, 8, 12).timestamp()),
+}
+
+SONGFINISHES = [
+    SONGFINISH,
+    dict(SONGFINISH, songPlayed='100'),
+    dict(SONGFINISH, title='Summertime', stationName='Piano Radio'),
+    dict(SONGFINISH, artist='Bill Evans', album='Portrait in Jazz',
+         title='Autumn Leaves',
+         timestamp=int(datetime(2016, 11, 9, 12).timestamp())),
+]
+
+
+def snapshot():
+    return (list(top_artists()), list(top_songs()),
+            list(top_songs(station='Jazz Radio')), list(top_stations()),
+            list(plays_per_day()))
+
+
+def test_stats_are_maintained_incrementally(sqlite_database):
+    """
+    Test that listening statistics are rolled up as plays are written.
+    """
+    bulk_update_db(SONGFINISHES[:2])
+    bulk_update_db(SONGFINISHES[2:])
+
+    assert list(top_artists()) == [('The Great Jazz Trio', 3, 700),
+                                   ('Bill Evans', 1, 300)]
+    assert list(top_songs(station='Jazz Radio')) == [
+        ('Take 5', 'The Great Jazz Trio', 2, 400),
+        ('Autumn Leaves', 'Bill Evans', 1, 300),
+    ]
+    assert list(top_stations()) == [('Jazz Radio', 3, 700),
+                                    ('Piano Radio', 1, 300)]
+    assert list(plays_per_day()) == [(date(2016, 11, 8), 3, 700),
+                                     (date(2016, 11, 9), 1, 300)]
+
+
+def test_stats_can_be_rebuilt_from_plays(sqlite_database):
+    """
+    Test that rebuilding the statistics from raw plays reproduces the
+    incrementally maintained statistics.
+    """
+    bulk_update_db(SONGFINISHES)
+    expected = snapshot()
+
+    model.SongStats.delete().execute()
+    model.DailyStats.update(plays=42).execute()
+    rebuild_stats()
+
+    assert snapshot() == expected
+
+
+def test_stats_are_updated_with_two_statements_per_chunk_of_keys(
+        sqlite_database, monkeypatch):
+    """
+    Test that each rollup costs one INSERT and one UPDATE per chunk of its
+    keys no matter how many rows exist already, and that the rows add up.
+    """
+    statements = []
+    execute_sql = sqlite_database.execute_sql
+
+    def recording_execute_sql(sql, *args, **kwargs):
+        statements.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    def rollup_statements():
+        tables = [rollup._meta.db_table for rollup, _ in ROLLUPS]
+        return [sql for sql in statements
+                if any('"{}"'.format(t) in sql.split('(')[0] for t in tables)]
+
+    bulk_update_db(SONGFINISHES[:2])
+    monkeypatch.setattr(sqlite_database, 'execute_sql', recording_execute_sql)
+    bulk_update_db(SONGFINISHES)
+
+    assert len(rollup_statements()) == 2 * len(ROLLUPS)
+    assert set(top_songs()) == {
+        ('Take 5', 'The Great Jazz Trio', 4, 800),
+        ('Summertime', 'The Great Jazz Trio', 1, 300),
+        ('Autumn Leaves', 'Bill Evans', 1, 300),
+    }
+
+    # 150 songs on one station, by one artist, on one day take two chunks
+    # of song and station song keys.
+    statements.clear()
+    bulk_update_db(dict(SONGFINISH, title='Take {}'.format(i))
+                   for i in range(6, 156))
+
+    assert len(rollup_statements()) == 2 * len(ROLLUPS) + 4
+    assert list(top_artists(limit=1)) == [('The Great Jazz Trio', 155, 46100)]
+    assert model.SongStats.select().count() == 153
+    assert model.StationSongStats.select().count() == 153
+
+
+def test_stats_read_durations_stored_out_of_range(sqlite_database):
+    """
+    Test that Play durations stored before they were validated, as the
+    ``timedelta`` strings of negative or day-long durations, still count.
+    """
+    bulk_update_db(SONGFINISHES[:2])
+    play_ids = [p.id for p in model.Play.select().order_by(model.Play.id)]
+    model.Play.update(duration='-1 day, 23:59:55').where(
+        model.Play.id == play_ids[0]).execute()
+    model.Play.update(duration='1 day, 1:00:00').where(
+        model.Play.id == play_ids[1]).execute()
+
+    rebuild_stats()
+
+    assert list(top_artists()) == [('The Great Jazz Trio', 2, 90000 - 5)]
+    items, _ = plays()
+    assert sorted(play['duration'] for play in items) == [-5, 90000]
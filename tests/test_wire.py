@@ -0,0 +1,59 @@
+import msgpack
+import pytest
+
+from pianodb.wire import InvalidPayload, decode, pack
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+    'timestamp': 1478563200,
+}
+
+
+def test_compact_payloads_round_trip_and_intern_strings():
+    """
+    Test that records survive the compact format unchanged and that strings
+    shared between records are sent once.
+    """
+
+    records = [dict(SONGFINISH, title="Take {}".format(i)) for i in range(50)]
+
+    data = pack(records)
+    payload = msgpack.unpackb(data, encoding='utf-8')
+
+    assert decode(payload) == records
+    assert len(payload[1]) == 50 + 5  # Titles and the shared strings.
+    assert len(data) < len(msgpack.packb(records)) / 3
+
+
+def test_records_without_compact_fields_are_packed_as_maps():
+    """
+    Test that records the compact format can't express fall back to maps.
+    """
+
+    records = [SONGFINISH, {'artist': 'John Cleese'}]
+
+    assert msgpack.unpackb(pack(records), encoding='utf-8') == records
+
+
+@pytest.mark.parametrize('payload, message', [
+    ([2, [], []], 'Unsupported schema version 2'),
+    ([1, ['a'], [[0, 0, 0]]], 'Invalid compact songfinish data'),
+    ([1, []], 'Invalid compact songfinish data'),
+])
+def test_invalid_compact_payloads_are_rejected(payload, message):
+    """
+    Test that payloads of unknown versions or malformed rows are rejected.
+    """
+
+    with pytest.raises(InvalidPayload) as excinfo:
+        decode(payload)
+
+    assert str(excinfo.value) == message
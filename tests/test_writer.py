@@ -0,0 +1,115 @@
+import threading
+
+from pianodb import metrics
+from pianodb.pianodb import bulk_update_db, connect_database
+from pianodb.profiler import QueryProfiler
+from pianodb.writer import WriteQueue
+
+SONGFINISH = {
+    'artist': 'The Great Jazz Trio',
+    'title': 'Take 5',
+    'album': "'S Wonderful",
+    'coverArt': 'http://cont-2.p-cdn.com/images/public/amz/5/2/4/1/fake.jpg',
+    'stationName': 'Jazz Radio',
+    'songDuration': '310',
+    'songPlayed': '310',
+    'rating': '0',
+    'detailUrl': 'http://www.pandora.com/great-jazz-trio/s-wonderful/take-5',
+}
+
+
+def test_write_queue_commits_concurrent_submissions_together():
+    """
+    Test that records submitted while the writer is busy are committed in one
+    group rather than one transaction each.
+    """
+
+    batches, started = [], threading.Event()
+
+    def write(songfinishes):
+        batches.append(songfinishes)
+        started.wait()
+
+    writer = WriteQueue(write, linger=0)
+    threads = [threading.Thread(target=writer.submit, args=([i],))
+               for i in range(10)]
+    for thread in threads:
+        thread.start()
+    started.set()
+    for thread in threads:
+        thread.join()
+    writer.stop()
+
+    assert sorted(i for batch in batches for i in batch) == list(range(10))
+    assert len(batches) < 10
+
+
+def test_write_queue_fails_bad_submissions_alone():
+    """
+    Test that a submission that can't be written fails without taking the
+    rest of its group with it.
+    """
+
+    written, results, release = [], {}, threading.Event()
+
+    def write(songfinishes):
+        release.wait()
+        if 'bad' in songfinishes:
+            raise ValueError('bad songfinish')
+        written.extend(songfinishes)
+
+    def submit(songfinish):
+        try:
+            results[songfinish] = writer.submit([songfinish])
+        except ValueError as exc:
+            results[songfinish] = exc
+
+    writer = WriteQueue(write, linger=0)
+    threads = [threading.Thread(target=submit, args=(songfinish,))
+               for songfinish in ('first', 'bad', 'good')]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    writer.stop()
+
+    assert sorted(written) == ['first', 'good']
+    assert isinstance(results['bad'], ValueError)
+    assert results['good'] is None
+
+
+def test_write_queue_charges_queries_to_submitters(sqlite_database):
+    """
+    Test that the queries the writer thread runs are counted and profiled for
+    the request that submitted the records, bulk updates included.
+    """
+
+    metrics.instrument_database(sqlite_database)
+    profiler = QueryProfiler(slow=60)
+    profiler.instrument(sqlite_database)
+    writer = WriteQueue(bulk_update_db, linger=0, profiler=profiler)
+
+    metrics.count_queries()
+    profiler.start()
+    writer.submit([SONGFINISH])
+    profile = profiler.stop('test')
+    queries = metrics.count_queries()
+    writer.stop()
+
+    assert queries == profile['queries'] > 1
+    assert any(s['sql'].startswith('UPDATE "album" SET "cover_art"') and
+               s['rows'] == 1 for s in profile['statements'])
+
+
+def test_sqlite_mode_enables_wal(tmpdir):
+    """
+    Test that SQLite databases are tuned with the configured pragmas.
+    """
+
+    url = "sqlite:///{}".format(tmpdir.join('piano.db'))
+    database = connect_database(url, {'pragmas': {'synchronous': 'full'}})
+
+    assert database.execute_sql('PRAGMA journal_mode').fetchone() == ('wal',)
+    assert database.execute_sql('PRAGMA synchronous').fetchone() == (2,)
+    database.close()